@@ -11,17 +11,23 @@ mimetypes.add_type('application/javascript', '.js')
 mimetypes.add_type('application/javascript', '.mjs')
 
 import flask
-from flask import request, session, jsonify, Blueprint, current_app
+from flask import request, session, jsonify, Blueprint, current_app, Response, stream_with_context
 import logging
 
 import json
 import html
+import queue
+import threading
+import time
+import datetime
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 from data_formulator.agents.agent_concept_derive import ConceptDeriveAgent
 from data_formulator.agents.agent_py_concept_derive import PyConceptDeriveAgent
 
 from data_formulator.agents.agent_py_data_transform import PythonDataTransformationAgent
-from data_formulator.agents.agent_sql_data_transform import SQLDataTransformationAgent
+from data_formulator.agents.agent_sql_data_transform import SQLDataTransformationAgent, sanitize_table_name
 from data_formulator.agents.agent_py_data_rec import PythonDataRecAgent
 from data_formulator.agents.agent_sql_data_rec import SQLDataRecAgent
 
@@ -30,9 +36,18 @@ from data_formulator.agents.agent_data_load import DataLoadAgent
 from data_formulator.agents.agent_data_clean import DataCleanAgent
 from data_formulator.agents.agent_code_explanation import CodeExplanationAgent
 from data_formulator.agents.agent_query_completion import QueryCompletionAgent
-from data_formulator.agents.client_utils import Client
-
-from data_formulator.db_manager import db_manager
+from data_formulator.agents.client_utils import Client, get_cached_client, StreamingClient
+from data_formulator.agents.llm_router import provider_health_snapshots
+from data_formulator.agents.llm_telemetry import get_llm_telemetry
+from data_formulator.agents.llm_admission import get_admission_controller, admission_snapshot, AdmissionRejected, INTERACTIVE
+from data_formulator.agents.agent_utils import dedup_data_transform_candidates, table_frame
+from data_formulator.lazy_frame import snapshot_table, release_snapshot, LAZY_FRAME_MIN_ROWS, LAZY_FRAME_SAMPLE_ROWS
+from data_formulator.agents.completion_cache import get_completion_cache
+from data_formulator.agents.repair_strategies import repair_in_parallel, select_repair_strategies, get_repair_stats
+
+from data_formulator.db_manager import db_manager, fetch_frame
+import data_formulator.py_sandbox as py_sandbox
+from data_formulator.concept_engine import derivation_signature
 
 # Configure root logger for general application logging
 logging.basicConfig(
@@ -46,9 +61,50 @@ logger = logging.getLogger(__name__)
 
 agent_bp = Blueprint('agent', __name__, url_prefix='/api/agent')
 
-def get_client(model):
+
+def admission_controlled(priority=INTERACTIVE):
+    """
+    Runs the view only once the admission controller grants it a slot (per-user and global limits);
+    answers 429 with Retry-After if the queue is full or the wait times out. Streamed responses
+    keep their slot until the stream is closed, or, for stream_agent_events responses, until their
+    worker thread finishes (it keeps running when the client disconnects).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            user = str(session.get('user_id') or session.get('session_id') or request.remote_addr)
+            controller = get_admission_controller()
+            try:
+                controller.acquire(user, priority)
+            except AdmissionRejected as e:
+                response = flask.jsonify({"status": "error", "message": str(e)})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(e.retry_after)
+                response.headers.add('Access-Control-Allow-Origin', '*')
+                return response
+
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except BaseException:
+                controller.release(user, priority)
+                raise
+            worker = getattr(response, 'worker', None)
+            if worker is not None:
+                worker.add_done_callback(lambda _: controller.release(user, priority))
+            elif response.is_streamed:
+                response.call_on_close(lambda: controller.release(user, priority))
+            else:
+                controller.release(user, priority)
+            return response
+        return wrapper
+    return decorator
+
+def get_client(model, use_fallback=True):
     """
     Returns a client for the given model config (dict) or model name (str)
+
+    use_fallback=False returns a standalone client that never fails over to LLM_FALLBACK_MODEL,
+    used when testing whether this particular model is reachable.
     """
     # Always normalize model param to dict
     def _normalize_model_config(model):
@@ -79,7 +135,8 @@ def get_client(model):
     for key in model_config:
         model_config[key] = model_config[key].strip()
 
-    client = Client(
+    client_factory = get_cached_client if use_fallback else Client
+    client = client_factory(
         model_config["endpoint"],
         model_config["model"],
         model_config["api_key"] if "api_key" in model_config else None,
@@ -89,12 +146,20 @@ def get_client(model):
     return client
 
 
-@agent_bp.route('/check-available-models', methods=['GET', 'POST'])
-def check_available_models():
-    results = []
+# model availability probes are cached, stale results are served while a background refresh runs
+MODEL_PROBE_TTL = int(os.getenv("MODEL_PROBE_TTL", "600"))
+MODEL_PROBE_TIMEOUT = float(os.getenv("MODEL_PROBE_TIMEOUT", "10"))
+
+_model_probe_cache = {"results": None, "checked_at": 0.0, "refreshing": False}
+_model_probe_lock = threading.Lock()
+
+
+def list_configured_models():
+    """Returns the model configs of all enabled providers from the environment"""
+    model_configs = []
     
     # Define configurations for different providers
-    providers = ['openai', 'azure', 'anthropic', 'gemini', 'ollama']
+    providers = ['openai', 'azure', 'anthropic', 'gemini', 'ollama', 'replay']
 
     for provider in providers:
         # Skip if provider is not enabled
@@ -118,31 +183,131 @@ def check_available_models():
             if not model:
                 continue
 
-            model_config = {
+            model_configs.append({
                 "id": f"{provider}-{model}-{api_key}-{api_base}-{api_version}",
                 "endpoint": provider,
                 "model": model,
                 "api_key": api_key,
                 "api_base": api_base,
                 "api_version": api_version
-            }
-            
+            })
+    return model_configs
+
+
+def probe_model(model_config):
+    """Sends a short test completion to the model, returns True if it answers as expected"""
+    client = get_client(dict(model_config), use_fallback=False)
+    response = client.get_completion(
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "Respond 'I can hear you.' if you can hear me."},
+        ],
+        agent="model_probe"
+    )
+    return "I can hear you." in response.choices[0].message.content
+
+
+def refresh_available_models():
+    """Probes all configured models concurrently; models that do not answer within MODEL_PROBE_TIMEOUT are unavailable"""
+    model_configs = list_configured_models()
+    results = []
+
+    if model_configs:
+        executor = ThreadPoolExecutor(max_workers=len(model_configs))
+        futures = {executor.submit(probe_model, config): config for config in model_configs}
+        done, _ = wait(futures, timeout=MODEL_PROBE_TIMEOUT)
+        # slow probes keep running in the background, their result is ignored
+        executor.shutdown(wait=False)
+
+        checked_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        for future, config in futures.items():
+            if future not in done:
+                logger.warning(f"Timed out testing {config['endpoint']} model {config['model']}")
+                continue
             try:
-                client = get_client(model_config)
-                response = client.get_completion(
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": "Respond 'I can hear you.' if you can hear me."},
-                    ]
-                )
-                
-                if "I can hear you." in response.choices[0].message.content:
-                    results.append(model_config)
+                if future.result():
+                    results.append({**config, "last_checked": checked_at})
             except Exception as e:
-                print(f"Error testing {provider} model {model}: {e}")
+                logger.warning(f"Error testing {config['endpoint']} model {config['model']}: {e}")
+
+    with _model_probe_lock:
+        _model_probe_cache.update(results=results, checked_at=time.time(), refreshing=False)
+    return results
+
+
+def _refresh_available_models_in_background():
+    with _model_probe_lock:
+        if _model_probe_cache["refreshing"]:
+            return
+        _model_probe_cache["refreshing"] = True
+
+    def refresh():
+        try:
+            refresh_available_models()
+        except Exception as e:
+            logger.error(f"Background model check failed: {e}")
+            with _model_probe_lock:
+                _model_probe_cache["refreshing"] = False
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+@agent_bp.route('/check-available-models', methods=['GET', 'POST'])
+def check_available_models():
+    force_refresh = request.args.get("refresh", "").lower() == "true"
+
+    with _model_probe_lock:
+        results = _model_probe_cache["results"]
+        age = time.time() - _model_probe_cache["checked_at"]
+
+    if results is None or force_refresh:
+        results = refresh_available_models()
+    elif age > MODEL_PROBE_TTL:
+        _refresh_available_models_in_background()
                 
     return json.dumps(results)
 
+@agent_bp.route('/llm-provider-health', methods=['GET'])
+def llm_provider_health():
+    """Latency percentiles, failure counts and circuit breaker state of each LLM provider"""
+    return jsonify({"status": "ok", "providers": provider_health_snapshots()})
+
+@agent_bp.route('/llm-metrics', methods=['GET'])
+def llm_metrics():
+    """Call counts, tokens, estimated cost and latency / time-to-first-token histograms per agent and model"""
+    telemetry = get_llm_telemetry()
+    snapshot = telemetry.snapshot()
+    if request.args.get('reset', 'false').lower() == 'true':
+        telemetry.reset()
+    return jsonify({"status": "ok", "call_log": telemetry.log_path, **snapshot})
+
+@agent_bp.route('/llm-admission-stats', methods=['GET'])
+def llm_admission_stats():
+    """Running and queued LLM requests per priority class, queue wait times and provider budget usage"""
+    return jsonify({"status": "ok", **admission_snapshot()})
+
+@agent_bp.route('/llm-cache-stats', methods=['GET'])
+def llm_cache_stats():
+    """Hit/miss metrics of the LLM completion cache, per agent"""
+    completion_cache = get_completion_cache()
+    if completion_cache is None:
+        return jsonify({"status": "ok", "enabled": False})
+    return jsonify({"status": "ok", "enabled": True, **completion_cache.stats()})
+
+@agent_bp.route('/repair-stats', methods=['GET'])
+def repair_stats():
+    """Per repair strategy: repairs it was tried in, how often its fix ran first and the mean time to that fix"""
+    repair_stats = get_repair_stats()
+    snapshot = repair_stats.stats()
+    if request.args.get("reset", "false").lower() == "true":
+        repair_stats.reset()
+    return jsonify({"status": "ok", **snapshot})
+
+@agent_bp.route('/sandbox-stats', methods=['GET'])
+def sandbox_stats():
+    """Sandbox worker pool counters and hit/miss metrics of the execution cache"""
+    return jsonify({"status": "ok", **py_sandbox.sandbox_stats()})
+
 def sanitize_model_error(error_message: str) -> str:
     """Sanitize model API error messages before sending to client."""
     # HTML escape the message
@@ -167,14 +332,15 @@ def test_model():
         logger.info("content------------------------------")
         logger.info(content)
 
-        client = get_client(content['model'])
+        client = get_client(content['model'], use_fallback=False)
         
         try:
             response = client.get_completion(
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant."},
                     {"role": "user", "content": "Respond 'I can hear you.' if you can hear me. Do not say anything other than 'I can hear you.'"},
-                ]
+                ],
+                agent="model_probe"
             )
 
             logger.info(f"model: {content['model']}")
@@ -200,6 +366,7 @@ def test_model():
     return json.dumps(result)
 
 @agent_bp.route('/process-data-on-load', methods=['GET', 'POST'])
+@admission_controlled()
 def process_data_on_load_request():
 
     if request.is_json:
@@ -227,6 +394,7 @@ def process_data_on_load_request():
 
 
 @agent_bp.route('/derive-concept-request', methods=['GET', 'POST'])
+@admission_controlled()
 def derive_concept_request():
 
     if request.is_json:
@@ -255,6 +423,7 @@ def derive_concept_request():
 
 
 @agent_bp.route('/derive-py-concept', methods=['GET', 'POST'])
+@admission_controlled()
 def derive_py_concept():
 
     if request.is_json:
@@ -267,10 +436,15 @@ def derive_py_concept():
         logger.info(f" model: {content['model']}")
         agent = PyConceptDeriveAgent(client=client)
 
-        #print(content["input_data"])
+        # {"name": xxx, "rows": [...]}, or {"name": xxx} referring to a session table
+        input_table = load_table_refs(session.get('session_id'), [content["input_data"]], content.get("row_limit"))[0]
 
-        results = agent.run(content["input_data"], [f['name'] for f in content["input_fields"]], 
+        results = agent.run(input_table, [f['name'] for f in content["input_fields"]], 
                                        content["output_name"], content["description"])
+        # accepted derivations can be applied to the full table with /api/tables/derive-column
+        for result in results:
+            if result['status'] == 'ok':
+                result['code_signature'] = derivation_signature(result['code'], session.get('session_id'), current_app.secret_key)
         
         response = flask.jsonify({ "status": "ok", "token": token, "results": results })
     else:
@@ -280,6 +454,7 @@ def derive_py_concept():
     return response
 
 @agent_bp.route('/clean-data', methods=['GET', 'POST'])
+@admission_controlled()
 def clean_data_request():
 
     if request.is_json:
@@ -306,6 +481,7 @@ def clean_data_request():
 
 
 @agent_bp.route('/sort-data', methods=['GET', 'POST'])
+@admission_controlled()
 def sort_data_request():
 
     if request.is_json:
@@ -326,68 +502,278 @@ def sort_data_request():
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
-@agent_bp.route('/derive-data', methods=['GET', 'POST'])
-def derive_data():
+def stream_agent_events(run, on_result):
+    """
+    Run `run(client_wrapper_factory, emit)` in a worker thread and stream its events as NDJSON.
 
-    if request.is_json:
-        logger.info("# request data: ")
-        content = request.get_json()        
-        token = content["token"]
+    Model tokens are sent as {"type": "token", "content": ...} while they arrive; the final
+    payload built by on_result(result) is sent as {"type": "result", ...}.
+    """
+    events = queue.Queue()
 
-        client = get_client(content['model'])
+    def emit(event):
+        events.put(event)
 
-        # each table is a dict with {"name": xxx, "rows": [...]}
-        input_tables = content["input_tables"]
-        new_fields = content["new_fields"]
-        instruction = content["extra_prompt"]
-        language = content.get("language", "python") # whether to use sql or python, default to python
-        
-        max_repair_attempts = content["max_repair_attempts"] if "max_repair_attempts" in content else 1
+    def wrap_client(client):
+        return StreamingClient(client, lambda text: emit({"type": "token", "content": text}))
 
-        if "additional_messages" in content:
-            prev_messages = content["additional_messages"]
-        else:
-            prev_messages = []
+    # completes when the worker thread is done, whether or not the client still reads the stream
+    done = Future()
 
-        logger.info("== input tables ===>")
+    def worker():
+        try:
+            emit({"type": "result", **on_result(run(wrap_client, emit))})
+        except Exception as e:
+            logger.error(f"Streaming request failed: {e}")
+            emit({"type": "error", "status": "error", "message": sanitize_model_error(str(e))})
+        finally:
+            events.put(None)
+            done.set_result(None)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    def generate():
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield json.dumps(event) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.worker = done
+    return response
+
+
+def load_table_refs(session_id, input_tables, row_limit=None, lazy=False):
+    """Load the input tables given as references to session tables ({"name": xxx} without rows) as
+    dataframes, once per request; row_limit caps the rows of every input table the sandbox runs on.
+    With lazy (and no row_limit), tables of at least LAZY_FRAME_MIN_ROWS rows are not loaded: they are
+    read by the sandbox as LazyFrames from snapshots of the tables (reused by later requests until the
+    session database changes), the data summary gets a sample of their rows. The snapshots are released
+    by release_table_refs"""
+    refs = [table for table in input_tables if 'rows' not in table and table.get('df') is None]
+    if len(refs) > 0:
+        if session_id is None:
+            raise ValueError("Table references require a session")
+        with db_manager.connection(session_id) as conn:
+            lazy_tables = []
+            for table in refs:
+                table_name = sanitize_table_name(table['name'])
+                query = f"SELECT * FROM {table_name}"
+                if row_limit:
+                    query += f" LIMIT {int(row_limit)}"
+                elif lazy:
+                    row_count = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+                    if row_count >= LAZY_FRAME_MIN_ROWS:
+                        lazy_tables.append((table, table_name))
+                        table['row_count'] = row_count
+                        query += f" LIMIT {LAZY_FRAME_SAMPLE_ROWS}"
+                table['df'] = fetch_frame(conn, query)
+            if lazy_tables:
+                db_file = db_manager.get_db_file(session_id)
+                for table, table_name in lazy_tables:
+                    table['lazy_ref'] = snapshot_table(conn, db_file, table_name)
+    if row_limit:
         for table in input_tables:
-            logger.info(f"===> Table: {table['name']} (first 5 rows)")
-            logger.info(table['rows'][:5])
+            table['df'] = table_frame(table).head(int(row_limit))
+    return input_tables
+
+
+def release_table_refs(input_tables):
+    """release the snapshots of the lazy input tables of a request"""
+    for table in input_tables:
+        if table.get('lazy_ref') is not None:
+            release_snapshot(table.pop('lazy_ref'))
+
 
-        logger.info("== user spec ===")
-        logger.info(new_fields)
-        logger.info(instruction)
+def select_candidates(results):
+    """keep the distinct successful candidates if there are any, otherwise keep the errors for the repair loop"""
+    successful = dedup_data_transform_candidates(results)
+    return successful if len(successful) > 0 else results
 
-        mode = "transform"
-        if len(new_fields) == 0:
-            mode = "recommendation"
 
-        conn = db_manager.get_connection(session['session_id']) if language == "sql" else None
+# candidates a request may ask for: each one is a model choice (or request) and a parallel sandbox execution
+MAX_CANDIDATES = int(os.getenv("MAX_CANDIDATES", "5"))
 
+
+def candidate_count(content):
+    """the request's num_candidates as an int between 1 and MAX_CANDIDATES (1 if it is not a number)"""
+    try:
+        num_candidates = int(content.get("num_candidates", 1))
+    except (TypeError, ValueError):
+        num_candidates = 1
+    return min(max(num_candidates, 1), MAX_CANDIDATES)
+
+
+def run_derive_data(client, content, session_id, exec_python_in_subprocess, emit=None):
+    """Run the transform / recommendation agent for a derive-data request, with repair attempts"""
+
+    # each table is a dict with {"name": xxx, "rows": [...]}, or {"name": xxx} referring to a session table
+    input_tables = content["input_tables"]
+    new_fields = content["new_fields"]
+    instruction = content["extra_prompt"]
+    language = content.get("language", "python") # whether to use sql or python, default to python
+    
+    max_repair_attempts = content["max_repair_attempts"] if "max_repair_attempts" in content else 1
+
+    # n candidates are generated and executed in parallel; first_success returns the first one that runs
+    num_candidates = candidate_count(content)
+    first_success = content.get("first_success", False)
+    # fixes asked at once on every repair attempt (opt-in, each one is another model call), see repair_strategies.REPAIR_STRATEGIES
+    repair_strategies = select_repair_strategies(content.get("repair_strategies"))
+
+    if "additional_messages" in content:
+        prev_messages = content["additional_messages"]
+    else:
+        prev_messages = []
+
+    # large session tables are handed to the code as lazy frames only when the request opts in with "lazy_frames"
+    if language != "sql":
+        load_table_refs(session_id, input_tables, content.get("row_limit"), lazy=content.get("lazy_frames", False))
+
+    logger.info("== input tables ===>")
+    for table in input_tables:
+        logger.info(f"===> Table: {table['name']} (first 5 rows)")
+        logger.info(table['rows'][:5] if 'rows' in table else table_frame(table).head(5))
+
+    logger.info("== user spec ===")
+    logger.info(new_fields)
+    logger.info(instruction)
+
+    mode = "transform"
+    if len(new_fields) == 0:
+        mode = "recommendation"
+
+    conn = db_manager.get_connection(session_id) if language == "sql" else None
+
+    try:
+        def make_agent(client, conn=conn):
+            if mode == "recommendation":
+                return SQLDataRecAgent(client=client, conn=conn) if language == "sql" else PythonDataRecAgent(client=client, exec_python_in_subprocess=exec_python_in_subprocess)
+            return SQLDataTransformationAgent(client=client, conn=conn) if language == "sql" else PythonDataTransformationAgent(client=client, exec_python_in_subprocess=exec_python_in_subprocess)
+
+        agent = make_agent(client)
         if mode == "recommendation":
             # now it's in recommendation mode
-            agent = SQLDataRecAgent(client=client, conn=conn) if language == "sql" else PythonDataRecAgent(client=client, exec_python_in_subprocess=current_app.config['CLI_ARGS']['exec_python_in_subprocess'])
-            results = agent.run(input_tables, instruction)
+            results = agent.run(input_tables, instruction, n=num_candidates, first_success=first_success)
         else:
-            agent = SQLDataTransformationAgent(client=client, conn=conn) if language == "sql" else PythonDataTransformationAgent(client=client, exec_python_in_subprocess=current_app.config['CLI_ARGS']['exec_python_in_subprocess'])
-            results = agent.run(input_tables, instruction, [field['name'] for field in new_fields], prev_messages)
+            results = agent.run(input_tables, instruction, [field['name'] for field in new_fields], prev_messages, n=num_candidates, first_success=first_success)
+        results = select_candidates(results)
 
         repair_attempts = 0
         while results[0]['status'] == 'error' and repair_attempts < max_repair_attempts: # try up to n times
             error_message = results[0]['content']
-            new_instruction = f"We run into the following problem executing the code, please fix it:\n\n{error_message}\n\nPlease think step by step, reflect why the error happens and fix the code so that no more errors would occur."
-
             prev_dialog = results[0]['dialog']
+            if emit:
+                emit({"type": "repair", "attempt": repair_attempts + 1, "error": error_message})
+
+            def attempt(strategy_client, new_instruction, prev_dialog=prev_dialog):
+                # strategies run in parallel threads, each on its own cursor of the session database
+                cursor = conn.cursor() if conn else None
+                try:
+                    strategy_agent = make_agent(strategy_client, cursor)
+                    if mode == "transform":
+                        return select_candidates(strategy_agent.followup(input_tables, prev_dialog, [field['name'] for field in new_fields], new_instruction, n=num_candidates, first_success=first_success))
+                    return select_candidates(strategy_agent.followup(input_tables, prev_dialog, new_instruction, n=num_candidates, first_success=first_success))
+                finally:
+                    if cursor:
+                        cursor.close()
+
+            results, strategy = repair_in_parallel(attempt, client, error_message, repair_strategies)
+            if emit and strategy:
+                emit({"type": "repair_strategy", "attempt": repair_attempts + 1, "strategy": strategy})
 
-            if mode == "transform":
-                results = agent.followup(input_tables, prev_dialog, [field['name'] for field in new_fields], new_instruction)
-            if mode == "recommendation":
-                results = agent.followup(input_tables, prev_dialog, new_instruction)
+            repair_attempts += 1
+    finally:
+        if conn:
+            conn.close()
+        release_table_refs(input_tables)
+
+    return results
+
+
+def run_refine_data(client, content, session_id, exec_python_in_subprocess, emit=None):
+    """Run the transform agent follow-up for a refine-data request, with repair attempts"""
+
+    # each table is a dict with {"name": xxx, "rows": [...]}, or {"name": xxx} referring to a session table
+    input_tables = content["input_tables"]
+    output_fields = content["output_fields"]
+    dialog = content["dialog"]
+    new_instruction = content["new_instruction"]
+    max_repair_attempts = content.get("max_repair_attempts", 1)
+    language = content.get("language", "python") # whether to use sql or python, default to python
+    num_candidates = candidate_count(content)
+    first_success = content.get("first_success", False)
+    repair_strategies = select_repair_strategies(content.get("repair_strategies"))
 
+    if language != "sql":
+        load_table_refs(session_id, input_tables, content.get("row_limit"), lazy=content.get("lazy_frames", False))
+
+    logger.info("== input tables ===>")
+    for table in input_tables:
+        logger.info(f"===> Table: {table['name']} (first 5 rows)")
+        logger.info(table['rows'][:5] if 'rows' in table else table_frame(table).head(5))
+    
+    logger.info("== user spec ===>")
+    logger.info(output_fields)
+    logger.info(new_instruction)
+
+    conn = db_manager.get_connection(session_id) if language == "sql" else None
+
+    try:
+        # always resort to the data transform agent       
+        def make_agent(client, conn=conn):
+            return SQLDataTransformationAgent(client=client, conn=conn) if language == "sql" else PythonDataTransformationAgent(client=client, exec_python_in_subprocess=exec_python_in_subprocess)
+
+        agent = make_agent(client)
+        results = select_candidates(agent.followup(input_tables, dialog, [field['name'] for field in output_fields], new_instruction, n=num_candidates, first_success=first_success))
+
+        repair_attempts = 0
+        while results[0]['status'] == 'error' and repair_attempts < max_repair_attempts: # only try once
+            error_message = results[0]['content']
+            prev_dialog = results[0]['dialog']
+            if emit:
+                emit({"type": "repair", "attempt": repair_attempts + 1, "error": error_message})
+
+            def attempt(strategy_client, new_instruction, prev_dialog=prev_dialog):
+                # strategies run in parallel threads, each on its own cursor of the session database
+                cursor = conn.cursor() if conn else None
+                try:
+                    strategy_agent = make_agent(strategy_client, cursor)
+                    return select_candidates(strategy_agent.followup(input_tables, prev_dialog, [field['name'] for field in output_fields], new_instruction, n=num_candidates, first_success=first_success))
+                finally:
+                    if cursor:
+                        cursor.close()
+
+            results, strategy = repair_in_parallel(attempt, client, error_message, repair_strategies)
+            if emit and strategy:
+                emit({"type": "repair_strategy", "attempt": repair_attempts + 1, "strategy": strategy})
             repair_attempts += 1
-        
+    finally:
         if conn:
             conn.close()
+        release_table_refs(input_tables)
+
+    return results
+
+
+@agent_bp.route('/derive-data', methods=['GET', 'POST'])
+@admission_controlled()
+def derive_data():
+
+    if request.is_json:
+        logger.info("# request data: ")
+        content = request.get_json()        
+        token = content["token"]
+
+        client = get_client(content['model'])
+
+        session_id = session.get('session_id')
+        results = run_derive_data(client, content, session_id,
+                                  current_app.config['CLI_ARGS']['exec_python_in_subprocess'])
         
         response = flask.jsonify({ "token": token, "status": "ok", "results": results })
     else:
@@ -396,7 +782,26 @@ def derive_data():
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
+@agent_bp.route('/derive-data-stream', methods=['POST'])
+@admission_controlled()
+def derive_data_stream():
+    """Streaming variant of /derive-data: NDJSON events with model tokens, repair attempts and the final results"""
+    if not request.is_json:
+        return flask.jsonify({ "token": "", "status": "error", "results": [] })
+
+    content = request.get_json()
+    token = content["token"]
+    client = get_client(content['model'])
+    session_id = session.get('session_id')
+    exec_python_in_subprocess = current_app.config['CLI_ARGS']['exec_python_in_subprocess']
+
+    return stream_agent_events(
+        lambda wrap_client, emit: run_derive_data(wrap_client(client), content, session_id, exec_python_in_subprocess, emit),
+        lambda results: { "token": token, "status": "ok", "results": results }
+    )
+
 @agent_bp.route('/refine-data', methods=['GET', 'POST'])
+@admission_controlled()
 def refine_data():
 
     if request.is_json:
@@ -407,40 +812,9 @@ def refine_data():
 
         client = get_client(content['model'])
 
-        # each table is a dict with {"name": xxx, "rows": [...]}
-        input_tables = content["input_tables"]
-        output_fields = content["output_fields"]
-        dialog = content["dialog"]
-        new_instruction = content["new_instruction"]
-        max_repair_attempts = content.get("max_repair_attempts", 1)
-        language = content.get("language", "python") # whether to use sql or python, default to python
-
-        logger.info("== input tables ===>")
-        for table in input_tables:
-            logger.info(f"===> Table: {table['name']} (first 5 rows)")
-            logger.info(table['rows'][:5])
-        
-        logger.info("== user spec ===>")
-        logger.info(output_fields)
-        logger.info(new_instruction)
-
-        conn = db_manager.get_connection(session['session_id']) if language == "sql" else None
-
-        # always resort to the data transform agent       
-        agent = SQLDataTransformationAgent(client=client, conn=conn) if language == "sql" else PythonDataTransformationAgent(client=client, exec_python_in_subprocess=current_app.config['CLI_ARGS']['exec_python_in_subprocess'])
-        results = agent.followup(input_tables, dialog, [field['name'] for field in output_fields], new_instruction)
-
-        repair_attempts = 0
-        while results[0]['status'] == 'error' and repair_attempts < max_repair_attempts: # only try once
-            error_message = results[0]['content']
-            new_instruction = f"We run into the following problem executing the code, please fix it:\n\n{error_message}\n\nPlease think step by step, reflect why the error happens and fix the code so that no more errors would occur."
-            prev_dialog = results[0]['dialog']
-
-            results = agent.followup(input_tables, prev_dialog, [field['name'] for field in output_fields], new_instruction)
-            repair_attempts += 1
-
-        if conn:
-            conn.close()
+        session_id = session.get('session_id')
+        results = run_refine_data(client, content, session_id,
+                                  current_app.config['CLI_ARGS']['exec_python_in_subprocess'])
 
         response = flask.jsonify({ "token": token, "status": "ok", "results": results})
     else:
@@ -449,7 +823,26 @@ def refine_data():
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
+@agent_bp.route('/refine-data-stream', methods=['POST'])
+@admission_controlled()
+def refine_data_stream():
+    """Streaming variant of /refine-data: NDJSON events with model tokens, repair attempts and the final results"""
+    if not request.is_json:
+        return flask.jsonify({ "token": "", "status": "error", "results": [] })
+
+    content = request.get_json()
+    token = content["token"]
+    client = get_client(content['model'])
+    session_id = session.get('session_id')
+    exec_python_in_subprocess = current_app.config['CLI_ARGS']['exec_python_in_subprocess']
+
+    return stream_agent_events(
+        lambda wrap_client, emit: run_refine_data(wrap_client(client), content, session_id, exec_python_in_subprocess, emit),
+        lambda results: { "token": token, "status": "ok", "results": results }
+    )
+
 @agent_bp.route('/code-expl', methods=['GET', 'POST'])
+@admission_controlled()
 def request_code_expl():
     if request.is_json:
         logger.info("# request data: ")
@@ -469,6 +862,7 @@ def request_code_expl():
     return expl
 
 @agent_bp.route('/query-completion', methods=['POST'])
+@admission_controlled()
 def query_completion():
     if request.is_json:
         logger.info("# request data: ")
@@ -2,6 +2,7 @@
 # Licensed under the MIT License.
 
 from data_formulator.agents.agent_utils import generate_data_summary
+from data_formulator.agents.prompt_budget import get_data_token_budget
 
 import logging
 
@@ -70,7 +71,8 @@ class CodeExplanationAgent(object):
 
     def run(self, input_tables, code):
 
-        data_summary = generate_data_summary(input_tables, include_data_samples=True)
+        data_summary = generate_data_summary(input_tables, include_data_samples=True, instruction=code,
+                                             token_budget=get_data_token_budget(self.client))
 
         user_query = f"[CONTEXT]\n\n{data_summary}\n\n[CODE]\n\here is the transformation code: {code}\n\n[EXPLANATION]\n"
 
@@ -80,7 +82,7 @@ class CodeExplanationAgent(object):
                     {"role":"user","content": user_query}]
         
         ###### the part that calls open_ai
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, cache = "code_explanation")
         
         logger.info(f"=== explanation output ===>\n{response.choices[0].message.content}\n")
         
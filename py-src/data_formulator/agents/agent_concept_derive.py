@@ -9,6 +9,7 @@ APP_ROOT = os.path.abspath('..')
 sys.path.append(os.path.abspath(APP_ROOT))
 
 from data_formulator.agents.agent_utils import generate_data_summary, field_name_to_ts_variable_name, extract_code_from_gpt_response, infer_ts_datatype
+from data_formulator.agents.prompt_budget import get_data_token_budget
 
 import logging
 
@@ -174,7 +175,9 @@ class ConceptDeriveAgent(object):
         """derive a new concept based on input table, input fields, and output field name, (and description)
         """
         
-        data_summary = generate_data_summary([input_table], include_data_samples=True)
+        data_summary = generate_data_summary([input_table], include_data_samples=True, instruction=description,
+                                             priority_fields=[*input_fields, output_field],
+                                             token_budget=get_data_token_budget(self.client))
 
         input_fields_info = [{"name": name, "type": infer_ts_datatype(pd.DataFrame(input_table['rows']), name)} for name in input_fields]
         
@@ -189,7 +192,7 @@ class ConceptDeriveAgent(object):
                     {"role":"user","content": user_query}]
         
         ###### the part that calls open_ai
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, agent = "concept_derive")
 
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
 
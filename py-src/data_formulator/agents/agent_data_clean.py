@@ -128,7 +128,7 @@ class DataCleanAgent(object):
         messages = [system_message, user_prompt]
         
         ###### the part that calls open_ai
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, agent = "data_clean")
 
         candidates = []
         for choice in response.choices:
@@ -5,6 +5,7 @@ import json
 
 from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary
 from data_formulator.agents.agent_sql_data_transform import  sanitize_table_name, get_sql_table_statistics_str
+from data_formulator.agents.prompt_budget import get_data_token_budget
 
 import logging
 
@@ -134,10 +135,12 @@ class DataLoadAgent(object):
 
         if input_data['virtual']:
             table_name = sanitize_table_name(input_data['name'])
-            table_summary_str = get_sql_table_statistics_str(self.conn, table_name, row_sample_size=5, field_sample_size=30)
+            table_summary_str = get_sql_table_statistics_str(self.conn, table_name, row_sample_size=5, field_sample_size=30,
+                                                             token_budget=get_data_token_budget(self.client))
             data_summary = f"[TABLE {table_name}]\n\n{table_summary_str}"
         else:
-            data_summary = generate_data_summary([input_data], include_data_samples=True, field_sample_size=30)
+            data_summary = generate_data_summary([input_data], include_data_samples=True, field_sample_size=30,
+                                                 token_budget=get_data_token_budget(self.client))
 
         user_query = f"[DATA]\n\n{data_summary}\n\n[OUTPUT]"
 
@@ -147,7 +150,7 @@ class DataLoadAgent(object):
                     {"role":"user","content": user_query}]
         
         ###### the part that calls open_ai
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, cache = "data_load")
 
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
 
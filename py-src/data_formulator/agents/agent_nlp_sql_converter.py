@@ -2,6 +2,7 @@ import json
 import logging
 from typing import Dict, Any, List, Optional
 from data_formulator.agents.agent_utils import extract_json_objects, extract_code_from_gpt_response
+from data_formulator.data_loader.schema_retriever import get_schema_retriever
 
 logger = logging.getLogger(__name__)
 
@@ -22,14 +23,29 @@ ENHANCED_NLP_SQL_SYSTEM_PROMPT = '''You are a SQL assistant. Generate clean SQL
 
 Generate only the SQL query in the code block above. No explanations needed.'''
 
+# Prompt'a girecek en fazla tablo sayısı (kullanıcı tablo seçmediğinde retrieval ile seçilir)
+DEFAULT_MAX_TABLES = 15
+# İstekle gelen max_tables bu aralığa sıkıştırılır
+MAX_TABLES_LIMIT = 50
+
+
+def clamp_max_tables(value) -> int:
+    """İstekten gelen max_tables değerini 1..MAX_TABLES_LIMIT aralığında int'e çevir (geçersizse varsayılan)"""
+    try:
+        max_tables = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_MAX_TABLES
+    return min(max(max_tables, 1), MAX_TABLES_LIMIT)
+
 class EnhancedNLPSQLConverter:
     """
     Enhanced NLP to SQL Converter - Büyük veritabanları için gelişmiş doğal dil SQL dönüştürücü
     """
     
-    def __init__(self, client, database_indexer):
+    def __init__(self, client, database_indexer, max_tables: int = DEFAULT_MAX_TABLES):
         self.client = client
         self.database_indexer = database_indexer
+        self.max_tables = max_tables
     
     def convert_query(self, database_id: int, natural_query: str, 
                      selected_tables: List[str] = None,
@@ -43,6 +59,12 @@ class EnhancedNLPSQLConverter:
             SQL sorgusu ve analiz sonuçları
         """
         try:
+            retrieved_tables = []
+            if not selected_tables:
+                retrieved_tables = self._retrieve_tables(database_id, natural_query)
+                if retrieved_tables:
+                    selected_tables = [t['table_id'] for t in retrieved_tables]
+
             # Get database context from indexer
             logger.info(f"Getting NLP context for database_id: {database_id}")
             if context_mode == "compact":
@@ -116,6 +138,12 @@ class EnhancedNLPSQLConverter:
                 logger.error(f"Context build traceback: {traceback.format_exc()}")
                 return {'status': 'error', 'message': f'Failed to build context: {str(context_error)}'}
             
+            # Soruyla eşleşen kolonları öne al, böylece 10 kolon sınırında kaybolmasınlar
+            self._rank_columns(enhanced_context, database_id, natural_query)
+
+            # Prompt'taki tablolar arasındaki ön hesaplanmış join yolları
+            enhanced_context['join_paths'] = self._get_join_paths(database_id, enhanced_context)
+
             # Şemadan otomatik prompt oluştur
             schema_prompt = self._schema_to_prompt(enhanced_context)
             
@@ -132,10 +160,15 @@ class EnhancedNLPSQLConverter:
                 {"role": "user", "content": user_prompt}
             ]
             
-            response = self.client.get_completion(messages=messages)
+            response = self.client.get_completion(messages=messages, agent="nlp_sql_converter")
             
             # Parse the response
-            return self._parse_response(response, natural_query, db_context)
+            result = self._parse_response(response, natural_query, db_context)
+            if retrieved_tables and result.get('status') == 'success':
+                result['database_context']['retrieved_tables'] = [
+                    {'name': t['name'], 'score': t['score']} for t in retrieved_tables
+                ]
+            return result
             
         except Exception as e:
             logger.error(f"Enhanced NLP-SQL conversion failed: {e}")
@@ -146,6 +179,57 @@ class EnhancedNLPSQLConverter:
                 'message': str(e)
             }
     
+    def _retrieve_tables(self, database_id: int, natural_query: str) -> List[Dict[str, Any]]:
+        """Kullanıcı tablo seçmediyse soruya en alakalı max_tables tabloyu BM25 ile seç.
+
+        Şema max_tables'tan küçükse boş liste döner ve tüm şema kullanılır. Hiçbir tablo eşleşmezse
+        veya retrieval hata verirse, prompt büyük şemalarda da sınırlı kalsın diye satır sayısına göre
+        en büyük max_tables tablo kullanılır.
+        """
+        try:
+            retriever = get_schema_retriever(self.database_indexer, database_id)
+            if retriever.num_docs <= self.max_tables:
+                return []
+            retrieved = retriever.search(natural_query, top_k=self.max_tables)
+            logger.info(f"Retrieved {len(retrieved)}/{retriever.num_docs} tables for query: {[t['name'] for t in retrieved]}")
+            if retrieved:
+                return retrieved
+            logger.info("No table matched the query, falling back to the largest tables")
+        except Exception as e:
+            logger.warning(f"Table retrieval failed, falling back to the largest tables: {e}")
+        try:
+            largest = self.database_indexer.get_largest_tables(database_id, self.max_tables)
+            return [{**table, 'score': 0.0} for table in largest]
+        except Exception as e:
+            logger.warning(f"Failed to load the largest tables, falling back to full context: {e}")
+            return []
+
+    def _rank_columns(self, context: Dict[str, Any], database_id: int, natural_query: str):
+        """Her tablonun kolonlarını soruyla eşleşme durumuna göre yeniden sırala (stable)"""
+        try:
+            retriever = get_schema_retriever(self.database_indexer, database_id)
+        except Exception as e:
+            logger.warning(f"Column ranking skipped: {e}")
+            return
+
+        for table in context.get('tables', []):
+            matched = retriever.match_columns(table.get('table_id'), natural_query)
+            if not matched:
+                continue
+            rank = {name: i for i, name in enumerate(matched)}
+            table['columns'] = sorted(table['columns'], key=lambda col: rank.get(col['name'], len(rank)))
+
+    def _get_join_paths(self, database_id: int, context: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Context'teki tablolar için indeks sırasında hesaplanmış join yollarını getir"""
+        table_ids = [t['table_id'] for t in context.get('tables', []) if t.get('table_id') is not None]
+        if len(table_ids) < 2 or len(table_ids) > self.max_tables:
+            return []
+        try:
+            return self.database_indexer.get_join_paths(database_id, table_ids)
+        except Exception as e:
+            logger.warning(f"Failed to load join paths: {e}")
+            return []
+
     def _build_enhanced_context(self, db_context: Dict[str, Any], 
                               context_hints: Dict[str, Any] = None) -> Dict[str, Any]:
         """Enhanced context bilgilerini oluştur"""
@@ -233,6 +317,13 @@ class EnhancedNLPSQLConverter:
                 prompt += f"  ... and {len(table.get('columns', [])) - 10} more columns\n"
             prompt += "\n"
         
+        join_paths = context.get("join_paths", [])
+        if join_paths:
+            prompt += "Join paths (use these to join tables):\n"
+            for join_path in join_paths:
+                prompt += f"  - {join_path['join']}\n"
+            prompt += "\n"
+        
         return prompt
     
     def _parse_response(self, response, original_query: str, db_context: Dict[str, Any]) -> Dict[str, Any]:
@@ -426,7 +517,7 @@ Format as JSON:
                 {"role": "user", "content": improvement_prompt}
             ]
             
-            response = self.client.get_completion(messages=messages)
+            response = self.client.get_completion(messages=messages, agent="nlp_sql_converter")
             content = response.choices[0].message.content
             
             # Try to parse JSON response
@@ -477,7 +568,7 @@ Keep the explanation clear and accessible to non-technical users.
                 {"role": "user", "content": explanation_prompt}
             ]
             
-            response = self.client.get_completion(messages=messages)
+            response = self.client.get_completion(messages=messages, agent="nlp_sql_converter")
             return response.choices[0].message.content
             
         except Exception as e:
@@ -3,7 +3,8 @@
 
 import time
 
-from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response
+from data_formulator.agents.agent_utils import generate_data_summary, table_frame, extract_code_from_gpt_response
+from data_formulator.agents.prompt_budget import get_data_token_budget
 import data_formulator.py_sandbox as py_sandbox
 
 import traceback
@@ -96,7 +97,9 @@ class PyConceptDeriveAgent(object):
         """derive a new concept based on input table, input fields, and output field name, (and description)
         """
         
-        data_summary = generate_data_summary([input_table], include_data_samples=True)
+        data_summary = generate_data_summary([input_table], include_data_samples=True, instruction=description,
+                                             priority_fields=[*input_fields, output_field],
+                                             token_budget=get_data_token_budget(self.client))
 
         objective = {
             "input_fields": input_fields,
@@ -113,7 +116,7 @@ class PyConceptDeriveAgent(object):
         
         time_start = time.time()
         ###### the part that calls open_ai
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, agent = "py_concept_derive")
         time_end = time.time()
         logger.info(f"time taken to get response: {time_end - time_start} seconds")
 
@@ -130,7 +133,7 @@ class PyConceptDeriveAgent(object):
             if len(code_blocks) > 0:
                 code_str = code_blocks[-1]
                 try:
-                    result =  py_sandbox.run_derive_concept(code_str, output_field, input_table['rows'], self.exec_python_in_subprocess)
+                    result =  py_sandbox.run_derive_concept(code_str, output_field, table_frame(input_table), self.exec_python_in_subprocess)
 
                     if result['status'] == 'ok':
                         result['content'] = {
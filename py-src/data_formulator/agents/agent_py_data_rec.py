@@ -4,7 +4,8 @@
 import json
 import pandas as pd
 
-from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary, extract_code_from_gpt_response
+from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary, table_input, extract_code_from_gpt_response, process_candidates_in_parallel
+from data_formulator.agents.prompt_budget import get_data_token_budget, trim_messages
 import data_formulator.py_sandbox as py_sandbox
 
 import traceback
@@ -132,7 +133,47 @@ class PythonDataRecAgent(object):
         self.system_prompt = system_prompt if system_prompt is not None else SYSTEM_PROMPT
         self.exec_python_in_subprocess = exec_python_in_subprocess
 
-    def process_gpt_response(self, input_tables, messages, response):
+    def process_choice(self, input_tables, messages, choice):
+        """extract and execute the code of a single model choice"""
+        logger.info("\n=== Data recommendation result ===>\n")
+        logger.info(choice.message.content + "\n")
+        
+        json_blocks = extract_json_objects(choice.message.content + "\n")
+        if len(json_blocks) > 0:
+            refined_goal = json_blocks[0]
+        else:
+            refined_goal = { 'mode': "", 'recommendation': "", 'output_fields': [], 'visualization_fields': [], }
+
+        code_blocks = extract_code_from_gpt_response(choice.message.content + "\n", "python")
+
+        if len(code_blocks) > 0:
+            code_str = code_blocks[-1]
+
+            try:
+                result = py_sandbox.run_transform_in_sandbox2020(code_str, [table_input(t) for t in input_tables], self.exec_python_in_subprocess)
+                result['code'] = code_str
+
+                if result['status'] == 'ok':
+                    result_df = result['content']
+                    result['content'] = {
+                        'rows': json.loads(result_df.to_json(orient='records')),
+                    }
+                else:
+                    logger.info(result['content'])
+            except Exception as e:
+                logger.warning('other error:')
+                error_message = traceback.format_exc()
+                logger.warning(error_message)
+                result = {'status': 'other error', 'code': code_str, 'content': f"Unexpected error executing the code, please try again."}
+        else:
+            result = {'status': 'error', 'code': "", 'content': "No code block found in the response. The model is unable to generate code to complete the task."}
+        
+        result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
+        result['agent'] = 'PythonDataRecAgent'
+        result['refined_goal'] = refined_goal
+        return result
+
+    def process_gpt_response(self, input_tables, messages, response, first_success=False):
         """process gpt response to handle execution"""
 
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
@@ -141,46 +182,9 @@ class PythonDataRecAgent(object):
             result = {'status': 'other error', 'content': str(response.body)}
             return [result]
         
-        candidates = []
-        for choice in response.choices:
-            
-            logger.info("\n=== Data recommendation result ===>\n")
-            logger.info(choice.message.content + "\n")
-            
-            json_blocks = extract_json_objects(choice.message.content + "\n")
-            if len(json_blocks) > 0:
-                refined_goal = json_blocks[0]
-            else:
-                refined_goal = { 'mode': "", 'recommendation': "", 'output_fields': [], 'visualization_fields': [], }
-
-            code_blocks = extract_code_from_gpt_response(choice.message.content + "\n", "python")
-
-            if len(code_blocks) > 0:
-                code_str = code_blocks[-1]
-
-                try:
-                    result = py_sandbox.run_transform_in_sandbox2020(code_str, [pd.DataFrame.from_records(t['rows']) for t in input_tables], self.exec_python_in_subprocess)
-                    result['code'] = code_str
-
-                    if result['status'] == 'ok':
-                        result_df = result['content']
-                        result['content'] = {
-                            'rows': json.loads(result_df.to_json(orient='records')),
-                        }
-                    else:
-                        logger.info(result['content'])
-                except Exception as e:
-                    logger.warning('other error:')
-                    error_message = traceback.format_exc()
-                    logger.warning(error_message)
-                    result = {'status': 'other error', 'code': code_str, 'content': f"Unexpected error executing the code, please try again."}
-            else:
-                result = {'status': 'error', 'code': "", 'content': "No code block found in the response. The model is unable to generate code to complete the task."}
-            
-            result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
-            result['agent'] = 'PythonDataRecAgent'
-            result['refined_goal'] = refined_goal
-            candidates.append(result)
+        candidates = process_candidates_in_parallel(
+            lambda choice: self.process_choice(input_tables, messages, choice),
+            response.choices, first_success)
 
         logger.info("=== Recommendation Candidates ===>")
         for candidate in candidates:
@@ -193,9 +197,10 @@ class PythonDataRecAgent(object):
         return candidates
     
 
-    def run(self, input_tables, description, n=1):
+    def run(self, input_tables, description, n=1, first_success=False):
 
-        data_summary = generate_data_summary(input_tables, include_data_samples=True)
+        data_summary = generate_data_summary(input_tables, include_data_samples=True, instruction=description,
+                                             token_budget=get_data_token_budget(self.client))
 
         user_query = f"[CONTEXT]\n\n{data_summary}\n\n[GOAL]\n\n{description}\n\n[OUTPUT]\n"
 
@@ -204,18 +209,19 @@ class PythonDataRecAgent(object):
         messages = [{"role":"system", "content": self.system_prompt},
                     {"role":"user","content": user_query}]
         
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, agent = "py_data_rec")
         
-        return self.process_gpt_response(input_tables, messages, response)
+        return self.process_gpt_response(input_tables, messages, response, first_success)
         
 
-    def followup(self, input_tables, dialog, new_instruction: str, n=1):
+    def followup(self, input_tables, dialog, new_instruction: str, n=1, first_success=False):
         """extend the input data (in json records format) to include new fields"""
 
         logger.info(f"GOAL: \n\n{new_instruction}")
 
-        messages = [*dialog, {"role":"user", "content": f"Update: \n\n{new_instruction}"}]
+        # keep the system prompt and the data context, drop the oldest turns if the dialog grew too long
+        messages = [*trim_messages(dialog, keep_first=2), {"role":"user", "content": f"Update: \n\n{new_instruction}"}]
 
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, agent = "py_data_rec")
 
-        return self.process_gpt_response(input_tables, messages, response)
\ No newline at end of file
+        return self.process_gpt_response(input_tables, messages, response, first_success)
\ No newline at end of file
@@ -3,7 +3,8 @@
 
 import json
 
-from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary, extract_code_from_gpt_response
+from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary, table_input, extract_code_from_gpt_response, process_candidates_in_parallel
+from data_formulator.agents.prompt_budget import get_data_token_budget, trim_messages
 import data_formulator.py_sandbox as py_sandbox
 import pandas as pd
 
@@ -189,7 +190,48 @@ class PythonDataTransformationAgent(object):
         self.system_prompt = system_prompt if system_prompt is not None else SYSTEM_PROMPT
         self.exec_python_in_subprocess = exec_python_in_subprocess
 
-    def process_gpt_response(self, input_tables, messages, response):
+    def process_choice(self, input_tables, messages, choice):
+        """extract and execute the code of a single model choice"""
+        logger.info("=== Data transformation result ===>")
+        logger.info(choice.message.content + "\n")
+        
+        json_blocks = extract_json_objects(choice.message.content + "\n")
+        if len(json_blocks) > 0:
+            refined_goal = json_blocks[0]
+        else:
+            refined_goal = {'visualization_fields': [], 'instruction': '', 'reason': ''}
+
+        code_blocks = extract_code_from_gpt_response(choice.message.content + "\n", "python")
+
+        if len(code_blocks) > 0:
+            code_str = code_blocks[-1]
+
+            try:
+                result = py_sandbox.run_transform_in_sandbox2020(code_str, [table_input(t) for t in input_tables], self.exec_python_in_subprocess)
+                result['code'] = code_str
+
+                if result['status'] == 'ok':
+                    # parse the content
+                    result_df = result['content']
+                    result['content'] = {
+                        'rows': json.loads(result_df.to_json(orient='records')),
+                    }
+                else:
+                    logger.info(result['content'])
+            except Exception as e:
+                logger.warning('Error occurred during code execution:')
+                error_message = f"An error occurred during code execution. Error type: {type(e).__name__}"
+                logger.warning(error_message)
+                result = {'status': 'error', 'code': code_str, 'content': error_message}
+        else:
+            result = {'status': 'error', 'code': "", 'content': "No code block found in the response. The model is unable to generate code to complete the task."}
+        
+        result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
+        result['agent'] = 'PythonDataTransformationAgent'
+        result['refined_goal'] = refined_goal
+        return result
+
+    def process_gpt_response(self, input_tables, messages, response, first_success=False):
         """process gpt response to handle execution"""
 
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
@@ -200,46 +242,9 @@ class PythonDataTransformationAgent(object):
             result = {'status': 'other error', 'content': str(response.body)}
             return [result]
         
-        candidates = []
-        for choice in response.choices:
-            logger.info("=== Data transformation result ===>")
-            logger.info(choice.message.content + "\n")
-            
-            json_blocks = extract_json_objects(choice.message.content + "\n")
-            if len(json_blocks) > 0:
-                refined_goal = json_blocks[0]
-            else:
-                refined_goal = {'visualization_fields': [], 'instruction': '', 'reason': ''}
-
-            code_blocks = extract_code_from_gpt_response(choice.message.content + "\n", "python")
-
-            if len(code_blocks) > 0:
-                code_str = code_blocks[-1]
-
-                try:
-                    result = py_sandbox.run_transform_in_sandbox2020(code_str, [pd.DataFrame.from_records(t['rows']) for t in input_tables], self.exec_python_in_subprocess)
-                    result['code'] = code_str
-
-                    if result['status'] == 'ok':
-                        # parse the content
-                        result_df = result['content']
-                        result['content'] = {
-                            'rows': json.loads(result_df.to_json(orient='records')),
-                        }
-                    else:
-                        logger.info(result['content'])
-                except Exception as e:
-                    logger.warning('Error occurred during code execution:')
-                    error_message = f"An error occurred during code execution. Error type: {type(e).__name__}"
-                    logger.warning(error_message)
-                    result = {'status': 'error', 'code': code_str, 'content': error_message}
-            else:
-                result = {'status': 'error', 'code': "", 'content': "No code block found in the response. The model is unable to generate code to complete the task."}
-            
-            result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
-            result['agent'] = 'PythonDataTransformationAgent'
-            result['refined_goal'] = refined_goal
-            candidates.append(result)
+        candidates = process_candidates_in_parallel(
+            lambda choice: self.process_choice(input_tables, messages, choice),
+            response.choices, first_success)
 
         logger.info("=== Transform Candidates ===>")
         for candidate in candidates:
@@ -252,18 +257,19 @@ class PythonDataTransformationAgent(object):
         return candidates
 
 
-    def run(self, input_tables, description, expected_fields: list[str], prev_messages: list[dict] = [], n=1):
+    def run(self, input_tables, description, expected_fields: list[str], prev_messages: list[dict] = [], n=1, first_success=False):
 
         if len(prev_messages) > 0:
             logger.info("=== Previous messages ===>")
             formatted_prev_messages = ""
-            for m in prev_messages:
+            for m in trim_messages(prev_messages):
                 if m['role'] != 'system':
                     formatted_prev_messages += f"{m['role']}: \n\n\t{m['content']}\n\n"
             logger.info(formatted_prev_messages)
             prev_messages = [{"role": "user", "content": '[Previous Messages] Here are the previous messages for your reference:\n\n' + formatted_prev_messages}]
 
-        data_summary = generate_data_summary(input_tables, include_data_samples=True)
+        data_summary = generate_data_summary(input_tables, include_data_samples=True, instruction=description, priority_fields=expected_fields,
+                                             token_budget=get_data_token_budget(self.client))
 
         goal = {
             "instruction": description,
@@ -278,12 +284,12 @@ class PythonDataTransformationAgent(object):
                     *prev_messages,
                     {"role":"user","content": user_query}]
         
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, agent = "py_data_transform")
 
-        return self.process_gpt_response(input_tables, messages, response)
+        return self.process_gpt_response(input_tables, messages, response, first_success)
         
 
-    def followup(self, input_tables, dialog, output_fields: list[str], new_instruction: str, n=1):
+    def followup(self, input_tables, dialog, output_fields: list[str], new_instruction: str, n=1, first_success=False):
         """extend the input data (in json records format) to include new fields"""
 
         goal = {
@@ -297,9 +303,12 @@ class PythonDataTransformationAgent(object):
 
         updated_dialog = [{"role":"system", "content": self.system_prompt}, *dialog[1:]]
 
+        # keep the system prompt and the data context, drop the oldest turns if the dialog grew too long
+        updated_dialog = trim_messages(updated_dialog, keep_first=2)
+
         messages = [*updated_dialog, {"role":"user", 
                               "content": f"Update the code above based on the following instruction:\n\n{json.dumps(goal, indent=4)}"}]
 
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, agent = "py_data_transform")
 
-        return self.process_gpt_response(input_tables, messages, response)
+        return self.process_gpt_response(input_tables, messages, response, first_success)
@@ -62,7 +62,7 @@ class QueryCompletionAgent(object):
                     {"role":"user","content": user_query}]
         
         ###### the part that calls open_ai
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, agent = "query_completion")
         response_content = '[REASONING]\n' + response.choices[0].message.content
         
         logger.info(f"=== query completion output ===>\n{response_content}\n")
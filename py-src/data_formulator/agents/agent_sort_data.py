@@ -83,7 +83,7 @@ class SortDataAgent(object):
                     {"role":"user","content": user_query}]
         
         ###### the part that calls open_ai
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, cache = "sort_data")
 
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
 
@@ -5,6 +5,7 @@ import json
 
 from data_formulator.agents.agent_utils import extract_json_objects, extract_code_from_gpt_response
 from data_formulator.agents.agent_sql_data_transform import get_sql_table_statistics_str, sanitize_table_name
+from data_formulator.agents.prompt_budget import get_data_token_budget, trim_messages
 
 import random
 import string
@@ -133,7 +134,7 @@ class SQLDataRecAgent(object):
         self.conn = conn
         self.system_prompt = system_prompt if system_prompt is not None else SYSTEM_PROMPT
 
-    def process_gpt_response(self, input_tables, messages, response):
+    def process_gpt_response(self, input_tables, messages, response, first_success=False):
         """process gpt response to handle execution"""
 
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
@@ -197,6 +198,11 @@ class SQLDataRecAgent(object):
             result['refined_goal'] = refined_goal
             candidates.append(result)
 
+            # candidates share one DuckDB connection, so they are executed one after another
+            if first_success and result['status'] == 'ok':
+                candidates = [result]
+                break
+
         logger.info("=== Recommendation Candidates ===>")
         for candidate in candidates:
             for key, value in candidate.items():
@@ -208,11 +214,13 @@ class SQLDataRecAgent(object):
         return candidates
     
 
-    def run(self, input_tables, description, n=1):
+    def run(self, input_tables, description, n=1, first_success=False):
+        table_token_budget = get_data_token_budget(self.client) // max(1, len(input_tables))
         data_summary = ""
         for table in input_tables:
             table_name = sanitize_table_name(table['name'])
-            table_summary_str = get_sql_table_statistics_str(self.conn, table_name)
+            table_summary_str = get_sql_table_statistics_str(self.conn, table_name, instruction=description,
+                                                             token_budget=table_token_budget)
             data_summary += f"[TABLE {table_name}]\n\n{table_summary_str}\n\n"
 
         user_query = f"[CONTEXT]\n\n{data_summary}\n\n[GOAL]\n\n{description}\n\n[OUTPUT]\n"
@@ -222,18 +230,19 @@ class SQLDataRecAgent(object):
         messages = [{"role":"system", "content": self.system_prompt},
                     {"role":"user","content": user_query}]
         
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, agent = "sql_data_rec")
         
-        return self.process_gpt_response(input_tables, messages, response)
+        return self.process_gpt_response(input_tables, messages, response, first_success)
         
 
-    def followup(self, input_tables, dialog, new_instruction: str, n=1):
+    def followup(self, input_tables, dialog, new_instruction: str, n=1, first_success=False):
         """extend the input data (in json records format) to include new fields"""
 
         logger.info(f"GOAL: \n\n{new_instruction}")
 
-        messages = [*dialog, {"role":"user", "content": f"Update: \n\n{new_instruction}"}]
+        # keep the system prompt and the data context, drop the oldest turns if the dialog grew too long
+        messages = [*trim_messages(dialog, keep_first=2), {"role":"user", "content": f"Update: \n\n{new_instruction}"}]
 
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, agent = "sql_data_rec")
 
-        return self.process_gpt_response(input_tables, messages, response)
\ No newline at end of file
+        return self.process_gpt_response(input_tables, messages, response, first_success)
\ No newline at end of file
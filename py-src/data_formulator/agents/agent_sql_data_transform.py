@@ -6,6 +6,7 @@ import random
 import string
 
 from data_formulator.agents.agent_utils import extract_json_objects, extract_code_from_gpt_response
+from data_formulator.agents.prompt_budget import fit_to_budget, select_columns, get_data_token_budget, trim_messages
 import pandas as pd
 
 import logging 
@@ -132,7 +133,7 @@ class SQLDataTransformationAgent(object):
         self.system_prompt = system_prompt if system_prompt is not None else SYSTEM_PROMPT
 
 
-    def process_gpt_sql_response(self, response, messages):
+    def process_gpt_sql_response(self, response, messages, first_success=False):
         """process gpt response to handle execution"""
 
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
@@ -203,6 +204,11 @@ class SQLDataTransformationAgent(object):
             result['refined_goal'] = refined_goal
             candidates.append(result)
 
+            # candidates share one DuckDB connection, so they are executed one after another
+            if first_success and result['status'] == 'ok':
+                candidates = [result]
+                break
+
         logger.info("=== Transform Candidates ===>")
         for candidate in candidates:
             for key, value in candidate.items():
@@ -214,7 +220,7 @@ class SQLDataTransformationAgent(object):
         return candidates
 
 
-    def run(self, input_tables, description, expected_fields: list[str], prev_messages: list[dict] = [], n=1):
+    def run(self, input_tables, description, expected_fields: list[str], prev_messages: list[dict] = [], n=1, first_success=False):
         """Args:
             input_tables: list[dict], each dict contains 'name' and 'rows'
             description: str, the description of the data transformation
@@ -248,16 +254,18 @@ class SQLDataTransformationAgent(object):
         if len(prev_messages) > 0:
             logger.info("=== Previous messages ===>")
             formatted_prev_messages = ""
-            for m in prev_messages:
+            for m in trim_messages(prev_messages):
                 if m['role'] != 'system':
                     formatted_prev_messages += f"{m['role']}: \n\n\t{m['content']}\n\n"
             logger.info(formatted_prev_messages)
             prev_messages = [{"role": "user", "content": '[Previous Messages] Here are the previous messages for your reference:\n\n' + formatted_prev_messages}]
 
+        table_token_budget = get_data_token_budget(self.client) // max(1, len(input_tables))
         data_summary = ""
         for table in input_tables:
             table_name = sanitize_table_name(table['name'])
-            table_summary_str = get_sql_table_statistics_str(self.conn, table_name)
+            table_summary_str = get_sql_table_statistics_str(self.conn, table_name, instruction=description,
+                                                             priority_fields=expected_fields, token_budget=table_token_budget)
             data_summary += f"[TABLE {table_name}]\n\n{table_summary_str}\n\n"
 
         goal = {
@@ -273,12 +281,12 @@ class SQLDataTransformationAgent(object):
                     *prev_messages,
                     {"role":"user","content": user_query}]
         
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, agent = "sql_data_transform")
 
-        return self.process_gpt_sql_response(response, messages)
+        return self.process_gpt_sql_response(response, messages, first_success)
         
 
-    def followup(self, input_tables, dialog, output_fields: list[str], new_instruction: str, n=1):
+    def followup(self, input_tables, dialog, output_fields: list[str], new_instruction: str, n=1, first_success=False):
         """extend the input data (in json records format) to include new fields"""
 
         goal = {
@@ -292,33 +300,51 @@ class SQLDataTransformationAgent(object):
 
         updated_dialog = [{"role":"system", "content": self.system_prompt}, *dialog[1:]]
 
+        # keep the system prompt and the data context, drop the oldest turns if the dialog grew too long
+        updated_dialog = trim_messages(updated_dialog, keep_first=2)
+
         messages = [*updated_dialog, {"role":"user", 
                               "content": f"Update the sql query above based on the following instruction:\n\n{json.dumps(goal, indent=4)}"}]
 
-        response = self.client.get_completion(messages = messages)
+        response = self.client.get_completion(messages = messages, n = n, agent = "sql_data_transform")
 
-        return self.process_gpt_sql_response(response, messages)
+        return self.process_gpt_sql_response(response, messages, first_success)
         
 
 def get_sql_table_statistics_str(conn, table_name: str, 
         row_sample_size: int = 5, # number of rows to be sampled in the sample data part
         field_sample_size: int = 7, # number of example values for each field to be sampled
-        max_val_chars: int = 140 # max number of characters to be shown for each example value
+        max_val_chars: int = 140, # max number of characters to be shown for each example value
+        instruction: str = "", # columns relevant to the instruction are kept when the summary is compressed
+        priority_fields: list[str] = (),
+        token_budget: int = None # compress the summary to fit this many tokens
     ) -> str:
     """Get a string representation of the table statistics"""
 
     table_name = sanitize_table_name(table_name)
 
+    # statistics are queried once, the budgeted rendering only slices them
+    columns, sample_data, col_metadata_list = collect_sql_table_statistics(conn, table_name, row_sample_size, field_sample_size)
+
+    def render(row_sample_size=row_sample_size, field_sample_size=field_sample_size, max_val_chars=max_val_chars, max_columns=None):
+        return render_sql_table_statistics(columns, sample_data, col_metadata_list, row_sample_size, field_sample_size,
+                                           max_val_chars, max_columns, instruction, priority_fields)
+
+    if token_budget is None:
+        return render()
+
+    return fit_to_budget(render, token_budget,
+                         {"field_sample_size": field_sample_size, "max_val_chars": max_val_chars, "row_sample_size": row_sample_size},
+                         len(columns))
+
+
+def collect_sql_table_statistics(conn, table_name: str, row_sample_size: int = 5, field_sample_size: int = 7):
+    """Query column types, sample rows and per-column statistics of a table"""
+
     # Get column information
     columns = conn.execute(f"DESCRIBE {table_name}").fetchall()
     sample_data = conn.execute(f"SELECT * FROM {table_name} LIMIT {row_sample_size}").fetchall()
     
-    # Format sample data as pipe-separated string
-    col_names = [col[0] for col in columns]
-    formatted_sample_data = "| " + " | ".join(col_names) + " |\n"
-    for i, row in enumerate(sample_data):
-        formatted_sample_data += f"{i}| " + " | ".join(str(val)[:max_val_chars]+ "..." if len(str(val)) > max_val_chars else str(val) for val in row) + " |\n"
-    
     col_metadata_list = []
     for col in columns:
         col_name = col[0]
@@ -371,9 +397,7 @@ def get_sql_table_statistics_str(conn, table_name: str,
                 LIMIT {field_sample_size})
             """
             
-            sample_values = conn.execute(query_for_sample_values).fetchall()
-            
-            stats_dict['sample_values'] = [str(val)[:max_val_chars]+ "..." if len(str(val)) > max_val_chars else str(val) for val in sample_values]
+            stats_dict['sample_values'] = conn.execute(query_for_sample_values).fetchall()
 
         col_metadata_list.append({
             "column": col_name,
@@ -381,14 +405,36 @@ def get_sql_table_statistics_str(conn, table_name: str,
             "statistics": stats_dict,
         })
 
-    table_metadata = {
-        "column_metadata": col_metadata_list,
-        "sample_data_str": formatted_sample_data
-    }
+    return columns, sample_data, col_metadata_list
+
+
+def render_sql_table_statistics(columns, sample_data, col_metadata_list,
+        row_sample_size: int = 5, field_sample_size: int = 7, max_val_chars: int = 140,
+        max_columns: int = None, instruction: str = "", priority_fields: list[str] = ()) -> str:
+    """Render collected table statistics, keeping only the max_columns most relevant columns if given"""
+
+    def cap(val):
+        return str(val)[:max_val_chars]+ "..." if len(str(val)) > max_val_chars else str(val)
+
+    # Format sample data as pipe-separated string
+    col_names = [col[0] for col in columns]
+    kept_names, omitted_names = select_columns(col_names, max_columns, instruction, priority_fields)
+    kept_indices = [col_names.index(name) for name in kept_names]
+
+    formatted_sample_data = "| " + " | ".join(kept_names) + " |\n"
+    for i, row in enumerate(sample_data[:row_sample_size]):
+        formatted_sample_data += f"{i}| " + " | ".join(cap(row[j]) for j in kept_indices) + " |\n"
 
     table_summary_str = f"Column metadata:\n\n"
-    for col_metadata in table_metadata['column_metadata']:
-        table_summary_str += f"\t{col_metadata['column']} ({col_metadata['type']}) ---- {col_metadata['statistics']}\n"
-    table_summary_str += f"\n\nSample data:\n\n{table_metadata['sample_data_str']}\n"
+    for col_metadata in col_metadata_list:
+        if col_metadata['column'] not in kept_names:
+            continue
+        stats_dict = dict(col_metadata['statistics'])
+        if 'sample_values' in stats_dict:
+            stats_dict['sample_values'] = [cap(val) for val in stats_dict['sample_values'][:field_sample_size]]
+        table_summary_str += f"\t{col_metadata['column']} ({col_metadata['type']}) ---- {stats_dict}\n"
+    if len(omitted_names) > 0:
+        table_summary_str += f"\t(other columns, not summarized: {', '.join(omitted_names)})\n"
+    table_summary_str += f"\n\nSample data:\n\n{formatted_sample_data}\n"
 
     return table_summary_str
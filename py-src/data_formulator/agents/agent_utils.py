@@ -7,6 +7,11 @@ import pandas as pd
 import numpy as np
 
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from data_formulator.agents.prompt_budget import fit_to_budget, select_columns
+import data_formulator.py_sandbox as py_sandbox
 
 def string_to_py_varname(var_str): 
     var_name = re.sub('\W|^(?=\d)','_', var_str)
@@ -149,32 +154,53 @@ def extract_json_objects(text):
     return json_objects  
 
 
-def insert_candidates(code, table, dialog, candidate_groups):
-    """ Try to insert a candidate into existing candidate groups
-    Args:
-        code: code candidate
-        table: json records table
-        candidate_groups: current candidate group
-    Returns:
-        a boolean flag incidate whether new_group_created
-    """
-    table_headers = sorted(table[0].keys())
-    t_hash = table_hash([{c: r[c] for c in table_headers} for r in table])
-    if t_hash in candidate_groups:
-        candidate_groups[t_hash].append({"code": code, "content": table, "dialog": dialog})
-        new_group_created = False
-    else:
-        candidate_groups[t_hash] = [{"code": code, "content": table, "dialog": dialog}]
-        new_group_created = True
-    return new_group_created
-
 def dedup_data_transform_candidates(candidates):
-    """each candidate is a tuple of {status: ..., code: ..., data: ..., dialog: ...},
-    this function extracts candidates that are 'ok', and removes uncessary duplicates"""
-    candidate_groups = {}
+    """each candidate is a dict of {status: ..., code: ..., content: {rows: ...}, dialog: ...},
+    this function extracts candidates that are 'ok', and removes candidates that produce the same table
+    (the first candidate of each group is kept, in the original order)"""
+    seen = set()
+    deduped = []
     for candidate in candidates:
-        insert_candidates(candidate["code"], candidate['data'], candidate['dialog'], candidate_groups)
-    return [items[0] for _, items in candidate_groups.items()]
+        if candidate['status'] != 'ok':
+            continue
+        rows = candidate['content']['rows']
+        t_hash = (tuple(sorted(rows[0].keys())), table_hash(rows)) if len(rows) > 0 else ()
+        if t_hash in seen:
+            continue
+        seen.add(t_hash)
+        deduped.append(candidate)
+    return deduped
+
+
+def process_candidates_in_parallel(process_choice, choices, first_success=False):
+    """run process_choice(choice) for every model choice concurrently (their code on separate sandbox workers)
+    and return the candidates in choice order, whatever order they finish in; with first_success, return as
+    soon as one candidate is 'ok' (only that candidate is returned) and cancel the executions still running"""
+    if len(choices) <= 1:
+        return [process_choice(choice) for choice in choices]
+
+    cancel_event = threading.Event()
+    # candidates are also cancelled with the scope of the calling thread (e.g. a losing repair strategy)
+    parent_scope = py_sandbox.cancel_scope()
+
+    def run(choice):
+        with py_sandbox.cancel_on(cancel_event, parent_scope):
+            return process_choice(choice)
+
+    executor = ThreadPoolExecutor(max_workers=len(choices))
+    try:
+        futures = {executor.submit(run, choice): i for i, choice in enumerate(choices)}
+        candidates = [None] * len(choices)
+        for future in as_completed(futures):
+            candidate = future.result()
+            if first_success and candidate['status'] == 'ok':
+                return [candidate]
+            candidates[futures[future]] = candidate
+        return candidates
+    finally:
+        # do not wait for slower candidates once the early result is returned
+        cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def get_field_summary(field_name, df, field_sample_size, max_val_chars=100):
@@ -207,22 +233,53 @@ def get_field_summary(field_name, df, field_sample_size, max_val_chars=100):
 
     return f"{field_name} -- type: {df[field_name].dtype}, values: {val_str}"
 
-def generate_data_summary(input_tables, include_data_samples=True, field_sample_size=7, max_val_chars=140):
+def table_frame(table):
+    """dataframe of an input table: the one loaded from the session database, or one built (once) from its json rows"""
+    if table.get('df') is None:
+        table['df'] = pd.DataFrame.from_records(table.get('rows', []))
+    return table['df']
+
+
+def table_input(table):
+    """what the sandbox gets for an input table: a LazyTableRef for tables too large to load, else its dataframe"""
+    return table['lazy_ref'] if table.get('lazy_ref') is not None else table_frame(table)
+
+
+def generate_data_summary(input_tables, include_data_samples=True, field_sample_size=7, max_val_chars=140,
+                          row_sample_size=5, max_columns=None, instruction="", priority_fields=(), token_budget=None):
+    """field summaries and sample rows of the input tables; with token_budget, samples are shortened and
+    the least relevant columns (w.r.t. instruction / priority_fields) are left unsummarized until it fits"""
+
+    if token_budget is not None:
+        return fit_to_budget(
+            lambda **settings: generate_data_summary(input_tables, include_data_samples, instruction=instruction,
+                                                     priority_fields=priority_fields, **settings),
+            token_budget,
+            {"field_sample_size": field_sample_size, "max_val_chars": max_val_chars, "row_sample_size": row_sample_size},
+            max([len(table_frame(t).columns) for t in input_tables], default=0))
     
     input_table_names = [f'{string_to_py_varname(t["name"])}' for t in input_tables]
 
-    data_samples = [t['rows'][:5] for t in input_tables]
-
     field_summaries = []
+    data_samples = []
     for input_data in input_tables:
-        df = pd.DataFrame(input_data['rows'])
-        s = '\n\t'.join([get_field_summary(fname, df, field_sample_size, max_val_chars)  for fname in list(df.columns.values)])
+        df = table_frame(input_data)
+        columns, omitted_columns = select_columns(df.columns.values, max_columns, instruction, priority_fields)
+        s = '\n\t'.join([get_field_summary(fname, df, field_sample_size, max_val_chars)  for fname in columns])
+        if len(omitted_columns) > 0:
+            s += f"\n\t(other fields, not summarized: {', '.join([str(c) for c in omitted_columns])})"
+        if input_data.get('lazy_ref') is not None:
+            s += (f"\n\t(this table has {input_data['row_count']} rows, summarized from a sample; it is passed to the function as a "
+                  "lazy dataframe evaluated in the database: use column arithmetic and comparisons, boolean filters, assign, "
+                  "groupby(...).agg(...), merge, sort_values and head; other pandas methods (loc, iloc, apply, pivot_table, ...) raise, "
+                  "call .to_pandas() on a reduced frame before using them)")
         field_summaries.append(s)
+        data_samples.append(df[columns].head(row_sample_size) if len(df) > 0 else df)
 
     table_field_summaries = [f'table_{i} ({input_table_names[i]}) fields:\n\t{s}' for i, s in enumerate(field_summaries)]
     
     if include_data_samples:
-        table_sample_strings = [f'table_{i} ({input_table_names[i]}) sample:\n\n```\n{pd.DataFrame(data_sample).to_csv(sep="|")}......\n```' for i, data_sample in enumerate(data_samples)]
+        table_sample_strings = [f'table_{i} ({input_table_names[i]}) sample:\n\n```\n{data_sample.to_csv(sep="|")}......\n```' for i, data_sample in enumerate(data_samples)]
     else:
         table_sample_strings = ['' for i, data_sample in enumerate(data_samples)]
 
@@ -1,11 +1,65 @@
+import copy
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import httpx
 import litellm
 import openai
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 
+from data_formulator.agents.completion_cache import get_completion_cache, completion_cache_key
+from data_formulator.agents.llm_router import call_with_resilience, is_retryable
+from data_formulator.agents.llm_telemetry import get_llm_telemetry
+from data_formulator.agents.llm_replay import get_replay_backend, get_recording_store, replay_enabled, replay_store_path
+from data_formulator.agents.llm_admission import admit_batch_call, current_priority, get_provider_budget
+from data_formulator.agents.prompt_budget import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "120"))
+
+# keep-alive HTTP pool shared by all LLM clients, so completions reuse connections instead of new TLS handshakes
+_http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+    timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10),
+)
+litellm.client_session = _http_client
+
+# endpoints that return n candidates from a single request; others get n concurrent requests
+NATIVE_N_ENDPOINTS = ("openai", "azure", "replay")
+
+# streams ask for a final usage chunk (stream_options.include_usage) only where the provider accepts it: the OpenAI
+# API itself, Azure from this api version on, and the LiteLLM providers that translate it; other streams are
+# accounted with estimated token counts
+STREAM_USAGE_ENDPOINTS = ("anthropic", "gemini")
+AZURE_STREAM_USAGE_MIN_VERSION = "2024-09-01"
+
+_azure_token_provider = None
+_azure_token_provider_lock = threading.Lock()
+
+
+def get_azure_token_provider():
+    """Create the Azure AD credential / token provider once per process; tokens are cached by the credential"""
+    global _azure_token_provider
+    with _azure_token_provider_lock:
+        if _azure_token_provider is None:
+            _azure_token_provider = get_bearer_token_provider(
+                DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+            )
+        return _azure_token_provider
+
+
 class Client(object):
     """
     Returns a LiteLLM client configured for the specified endpoint and model.
-    Supports OpenAI, Azure, Ollama, and other providers via LiteLLM.
+    Supports OpenAI, Azure, Ollama, and other providers via LiteLLM, and the offline "replay" endpoint.
     """
     def __init__(self, endpoint, model, api_key=None,  api_base=None, api_version=None):
         
@@ -41,10 +95,7 @@ class Client(object):
             self.params["api_base"] = api_base
             self.params["api_version"] = api_version if api_version else "2024-02-15-preview"
             if api_key is None or api_key == "":
-                token_provider = get_bearer_token_provider(
-                    DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
-                )
-                self.params["azure_ad_token_provider"] = token_provider
+                self.params["azure_ad_token_provider"] = get_azure_token_provider()
             self.params["custom_llm_provider"] = "azure"
         elif self.endpoint == "ollama":
             self.params["api_base"] = api_base if api_base else "http://localhost:11434"
@@ -53,21 +104,217 @@ class Client(object):
                 self.model = model
             else:
                 self.model = f"ollama/{model}"
-        
+        elif self.endpoint == "replay":
+            # offline stand-in answering with recorded completions (see llm_replay), api_base is the recording file
+            # configured on the server, whatever the model config says
+            if not replay_enabled():
+                raise ValueError("The replay endpoint is not enabled on this server")
+            self.params["api_base"] = replay_store_path()
 
-    def get_completion(self, messages):
+        self._openai_client = None
+        self._openai_client_lock = threading.Lock()
+
+        # health / circuit breaker key of this provider deployment (no secrets)
+        self.provider_name = f"{self.endpoint}:{self.params.get('api_base', 'default')}:{self.model}"
+        # client used when this provider fails or its circuit is open, set by get_cached_client
+        self.fallback_client = None
+
+    def with_params(self, **params):
+        """a copy of this client sending the given params (e.g. temperature) instead of its own; the copy shares
+        the provider's health, budget and fallback with this client"""
+        client = copy.copy(self)
+        client.params = {**self.params, **params}
+        return client
+
+    def _get_openai_client(self):
+        # openai.OpenAI is thread-safe: create it once per client, on top of the shared HTTP pool
+        with self._openai_client_lock:
+            if self._openai_client is None:
+                self._openai_client = openai.OpenAI(
+                    base_url=self.params.get("api_base", None),
+                    api_key=self.params.get("api_key", ""),
+                    timeout=REQUEST_TIMEOUT,
+                    # retries are handled by llm_router, with backoff, hedging and circuit breaking
+                    max_retries=0,
+                    http_client=_http_client
+                )
+            return self._openai_client
+
+    def get_completion(self, messages, n=1, on_token=None, cache=None, agent=None):
         """
         Returns a LiteLLM client configured for the specified endpoint and model.
         Supports OpenAI, Azure, Ollama, and other providers via LiteLLM.
+
+        n > 1 asks for n candidates: natively on endpoints that support it, otherwise with n
+        concurrent requests whose choices are merged into one response.
+
+        If on_token is given (and n == 1), the completion is streamed and on_token(text) is called
+        for every content delta; the assembled response has the same choices[0].message shape.
+
+        cache="<agent name>" opts in to the completion cache (see completion_cache.AGENT_CACHE_TTLS);
+        cached responses only carry choices[i].message.role / content.
+
+        Every call is recorded in the LLM telemetry under agent (defaults to the cache name):
+        tokens, time to first token (streamed calls), latency, cache hit and error class.
         """
-        # Configure LiteLLM 
+        agent = agent or cache or "unknown"
+
+        # batch (indexing) threads take an admission slot per call, interactive requests are admitted per request
+        with admit_batch_call():
+            start = time.time()
+            first_token_at = []
+
+            def on_token_timed(delta):
+                if not first_token_at:
+                    first_token_at.append(time.time())
+                on_token(delta)
+
+            try:
+                response = self._get_completion(messages, n, on_token_timed if on_token is not None else None, cache)
+            except Exception as e:
+                get_llm_telemetry().record(agent, self.endpoint, self.model, n=n, stream=on_token is not None,
+                                           latency=time.time() - start, error=e)
+                raise
+
+            cache_hit = getattr(response, "cached", False)
+            usage = getattr(response, "usage", None)
+            prompt_tokens = getattr(usage, "prompt_tokens", None)
+            completion_tokens = getattr(usage, "completion_tokens", None)
+            tokens_estimated = prompt_tokens is None and not cache_hit
+            if tokens_estimated:
+                # providers that do not report usage (e.g. some streams): ~4 characters per token
+                prompt_tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+                completion_tokens = sum(estimate_tokens(choice.message.content or "") for choice in response.choices)
+
+            get_llm_telemetry().record(agent, self.endpoint, self.model, n=n, stream=on_token is not None,
+                                       latency=time.time() - start,
+                                       ttft=first_token_at[0] - start if first_token_at and not cache_hit else None,
+                                       prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                       tokens_estimated=tokens_estimated, cache_hit=cache_hit)
+
+            recording_store = get_recording_store() if self.endpoint != "replay" and not cache_hit else None
+            if recording_store is not None:
+                recording_store.record(messages, n, response, self.model)
+            return response
+
+    def _get_completion(self, messages, n=1, on_token=None, cache=None):
+        completion_cache = get_completion_cache() if cache is not None else None
+        if completion_cache is not None:
+            cache_key = completion_cache_key(self.endpoint, self.model, messages, self.params, n)
+            cached_choices = completion_cache.get(cache_key, cache)
+            if cached_choices is not None:
+                if on_token is not None and n == 1:
+                    on_token(cached_choices[0]["content"])
+                return self._make_response(cached_choices, cached=True)
+
+            response = self._get_completion(messages, n=n, on_token=on_token)
+            choices = [{"role": choice.message.role, "content": choice.message.content} for choice in response.choices]
+            if choices and all(choice["content"] for choice in choices):
+                completion_cache.put(cache_key, cache, choices)
+            return response
+
+        if n > 1:
+            if self.endpoint in NATIVE_N_ENDPOINTS:
+                return self._create_completion(messages, stream=False, n=n)
+            return self._get_concurrent_completions(messages, n)
+
+        if on_token is not None:
+            parts, usage = [], None
+            for delta, chunk_usage in self._stream_deltas(messages):
+                if chunk_usage is not None:
+                    usage = chunk_usage
+                if delta:
+                    on_token(delta)
+                    parts.append(delta)
+            return self._make_response([{"role": "assistant", "content": "".join(parts)}], usage=usage)
+
+        return self._create_completion(messages, stream=False)
 
+    @staticmethod
+    def _make_response(choices, usage=None, cached=False):
+        """builds a response object with the choices[i].message shape (and usage) of a chat completion"""
+        return SimpleNamespace(choices=[
+            SimpleNamespace(index=i, message=SimpleNamespace(role=choice["role"], content=choice["content"]))
+            for i, choice in enumerate(choices)
+        ], usage=usage, cached=cached)
+
+    def _get_concurrent_completions(self, messages, n):
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            futures = [executor.submit(self._create_completion, messages, False) for _ in range(n)]
+
+        choices, errors = [], []
+        usage = SimpleNamespace(prompt_tokens=0, completion_tokens=0)
+        for future in futures:
+            try:
+                response = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            choices.extend(response.choices)
+            if usage is not None and getattr(response, "usage", None) is not None:
+                usage.prompt_tokens += response.usage.prompt_tokens or 0
+                usage.completion_tokens += response.usage.completion_tokens or 0
+            else:
+                usage = None
+        if not choices:
+            raise errors[0]
+
+        return self._make_response([{"role": choice.message.role, "content": choice.message.content} for choice in choices],
+                                   usage=usage)
+
+    def stream_completion(self, messages):
+        """Yield content deltas of the completion as they arrive from the model"""
+        for delta, _ in self._stream_deltas(messages):
+            if delta:
+                yield delta
+
+    def _stream_deltas(self, messages):
+        """Yield (content delta, None) per chunk and (None, usage) for the usage chunk, if the provider sends one"""
+        for chunk in self._create_completion(messages, stream=True):
+            if getattr(chunk, "usage", None) is not None:
+                yield None, chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta is not None and delta.content:
+                yield delta.content, None
+
+    def _stream_usage_supported(self):
         if self.endpoint == "openai":
-            client = openai.OpenAI(
-                base_url=self.params.get("api_base", None),
-                api_key=self.params.get("api_key", ""),
-                timeout=120
-            )
+            # OpenAI-compatible servers behind a custom api_base may reject the option
+            api_base = self.params.get("api_base")
+            return not api_base or "api.openai.com" in api_base
+        if self.endpoint == "azure":
+            return (self.params.get("api_version") or "")[:10] >= AZURE_STREAM_USAGE_MIN_VERSION
+        return self.endpoint in STREAM_USAGE_ENDPOINTS
+
+    def _create_completion(self, messages, stream, n=1):
+        try:
+            budget = get_provider_budget(self.provider_name, self.endpoint)
+            before_hedge = None
+            if budget is not None:
+                max_tokens = self.params.get("max_completion_tokens", 0)
+                tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in messages) + n * max_tokens
+                priority = current_priority()
+                budget.acquire(tokens, priority)
+                # a hedge is another request against the budget, it is skipped rather than waiting for one
+                before_hedge = lambda: budget.acquire(tokens, priority, max_wait=0)
+            return call_with_resilience(self.provider_name,
+                                        lambda: self._send_completion(messages, stream, n),
+                                        hedge=not stream, before_hedge=before_hedge)
+        except Exception as e:
+            if self.fallback_client is None or not is_retryable(e):
+                raise
+            logger.warning(f"{self.provider_name} failed ({e}), falling back to {self.fallback_client.provider_name}")
+            return self.fallback_client._create_completion(messages, stream, n)
+
+    def _send_completion(self, messages, stream, n=1):
+        # Configure LiteLLM 
+
+        if self.endpoint == "replay":
+            return get_replay_backend(self.params["api_base"]).complete(self.model, messages, stream, n)
+        elif self.endpoint == "openai":
+            client = self._get_openai_client()
 
             completion_params = {
                 "model": self.model,
@@ -77,6 +324,13 @@ class Client(object):
             if not (self.model == "o3-mini" or self.model == "o1"):
                 completion_params["temperature"] = self.params["temperature"]
                 completion_params["max_tokens"] = self.params["max_completion_tokens"]
+
+            if stream:
+                completion_params["stream"] = True
+                if self._stream_usage_supported():
+                    completion_params["stream_options"] = {"include_usage": True}
+            if n > 1:
+                completion_params["n"] = n
                 
             return client.chat.completions.create(**completion_params)
         else:
@@ -84,5 +338,81 @@ class Client(object):
                 model=self.model,
                 messages=messages,
                 drop_params=True,
+                stream=stream,
+                **({"stream_options": {"include_usage": True}} if stream and self._stream_usage_supported() else {}),
+                timeout=REQUEST_TIMEOUT,
+                **({"n": n} if n > 1 else {}),
                 **self.params
-            )
\ No newline at end of file
+            )
+
+
+class StreamingClient(object):
+    """
+    Wraps a (shared) Client so that every get_completion call made by an agent is streamed
+    and its tokens are forwarded to on_token. Agents use it exactly like a Client.
+    """
+    def __init__(self, client, on_token):
+        self.client = client
+        self.on_token = on_token
+
+    def get_completion(self, messages, n=1, cache=None, agent=None):
+        # candidates are not streamed, their tokens would interleave in one stream
+        if n > 1:
+            return self.client.get_completion(messages, n=n, cache=cache, agent=agent)
+        return self.client.get_completion(messages, on_token=self.on_token, cache=cache, agent=agent)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+# clients are keyed by request-supplied endpoint / model / api_base / api key: keep only the most recently used ones
+CLIENT_REGISTRY_SIZE = int(os.getenv("LLM_CLIENT_REGISTRY_SIZE", "64"))
+
+_client_registry = OrderedDict()  # key -> Client, least recently used first
+_client_registry_lock = threading.Lock()
+
+
+def get_cached_client(endpoint, model, api_key=None, api_base=None, api_version=None) -> Client:
+    """
+    Returns the process-wide Client for the given endpoint/model/api_base/api_version/api_key.
+    Clients are thread-safe and shared across requests; at most CLIENT_REGISTRY_SIZE are kept (LRU).
+    """
+    # do not keep the api key in plain text as part of the key
+    key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+    key = (endpoint, model, api_base or "", api_version or "", key_hash)
+    with _client_registry_lock:
+        client = _client_registry.get(key)
+        if client is not None:
+            _client_registry.move_to_end(key)
+        else:
+            client = Client(endpoint, model, api_key, api_base, api_version)
+            # requests that bring their own api key do not fail over to a model paid with the server's credentials
+            if _uses_server_credentials(endpoint, api_key):
+                client.fallback_client = _get_fallback_client(endpoint, model)
+            _client_registry[key] = client
+            while len(_client_registry) > CLIENT_REGISTRY_SIZE:
+                _client_registry.popitem(last=False)
+        return client
+
+
+def _uses_server_credentials(endpoint, api_key):
+    """whether a client authenticates with the server's own <ENDPOINT>_API_KEY (or none) rather than a user's key"""
+    if not api_key:
+        return True
+    return hmac.compare_digest(api_key, os.getenv(f"{endpoint.upper()}_API_KEY", ""))
+
+
+def _get_fallback_client(endpoint, model):
+    """
+    Client for LLM_FALLBACK_MODEL ("<endpoint>:<model>", e.g. "azure:gpt-4o"), with credentials
+    from the provider's <ENDPOINT>_API_KEY / _API_BASE / _API_VERSION environment variables.
+    """
+    fallback = os.getenv("LLM_FALLBACK_MODEL", "").strip()
+    if ":" not in fallback:
+        return None
+    fallback_endpoint, fallback_model = fallback.split(":", 1)
+    if (fallback_endpoint, fallback_model) == (endpoint, model):
+        return None
+    prefix = fallback_endpoint.upper()
+    return Client(fallback_endpoint, fallback_model,
+                  os.getenv(f"{prefix}_API_KEY", ""), os.getenv(f"{prefix}_API_BASE", ""), os.getenv(f"{prefix}_API_VERSION", ""))
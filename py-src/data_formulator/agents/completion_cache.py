@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# TTL (seconds) of cached completions per agent; agents opt in by passing cache="<name>" to get_completion
+AGENT_CACHE_TTLS = {
+    "data_load": 7 * 24 * 3600,
+    "code_explanation": 7 * 24 * 3600,
+    "sort_data": 30 * 24 * 3600,
+}
+DEFAULT_CACHE_TTL = 24 * 3600
+
+# client params that must not end up in the cache key (secrets, non-serializable objects)
+EXCLUDED_PARAMS = ("api_key", "azure_ad_token_provider")
+
+
+def completion_cache_key(endpoint, model, messages, params, n=1):
+    """canonical hash of everything that determines the completion"""
+    key_data = {
+        "endpoint": endpoint,
+        "model": model,
+        "messages": messages,
+        "n": n,
+        "params": {k: v for k, v in params.items() if k not in EXCLUDED_PARAMS},
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class CompletionCache(object):
+    """
+    SQLite-backed cache of LLM completions with per-agent TTLs and size-bounded LRU eviction.
+    Only the message role/content of each choice is stored.
+    """
+
+    def __init__(self, store_path, max_entries=5000):
+        self.store_path = store_path
+        self.max_entries = max_entries
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._init_store()
+
+    def _get_connection(self):
+        conn = sqlite3.connect(self.store_path, timeout=30.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    def _init_store(self):
+        os.makedirs(os.path.dirname(self.store_path) or ".", exist_ok=True)
+        conn = self._get_connection()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS completion_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    agent TEXT,
+                    choices TEXT NOT NULL,
+                    created_at REAL,
+                    expires_at REAL,
+                    last_used_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_completion_cache_lru ON completion_cache (last_used_at)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _count(self, agent, outcome):
+        with self._lock:
+            agent_stats = self._stats.setdefault(agent, {"hits": 0, "misses": 0})
+            agent_stats[outcome] += 1
+
+    def get(self, cache_key, agent):
+        """returns the cached choices ([{role, content}]) or None"""
+        now = time.time()
+        conn = self._get_connection()
+        try:
+            row = conn.execute("SELECT choices FROM completion_cache WHERE cache_key = ? AND expires_at > ?",
+                               (cache_key, now)).fetchone()
+            if row:
+                conn.execute("UPDATE completion_cache SET last_used_at = ? WHERE cache_key = ?", (now, cache_key))
+                conn.commit()
+        finally:
+            conn.close()
+
+        self._count(agent, "hits" if row else "misses")
+        return json.loads(row[0]) if row else None
+
+    def put(self, cache_key, agent, choices):
+        now = time.time()
+        ttl = AGENT_CACHE_TTLS.get(agent, DEFAULT_CACHE_TTL)
+        conn = self._get_connection()
+        try:
+            conn.execute("""
+                INSERT OR REPLACE INTO completion_cache (cache_key, agent, choices, created_at, expires_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (cache_key, agent, json.dumps(choices), now, now + ttl, now))
+            conn.execute("DELETE FROM completion_cache WHERE expires_at <= ?", (now,))
+            # LRU eviction: keep only the max_entries most recently used completions
+            conn.execute("""
+                DELETE FROM completion_cache WHERE cache_key IN (
+                    SELECT cache_key FROM completion_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self):
+        conn = self._get_connection()
+        try:
+            entries = conn.execute("SELECT COUNT(*) FROM completion_cache WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+        finally:
+            conn.close()
+
+        with self._lock:
+            agents = {agent: dict(agent_stats) for agent, agent_stats in self._stats.items()}
+        for agent_stats in agents.values():
+            lookups = agent_stats["hits"] + agent_stats["misses"]
+            agent_stats["hit_rate"] = round(agent_stats["hits"] / lookups, 3) if lookups else None
+
+        hits = sum(a["hits"] for a in agents.values())
+        lookups = hits + sum(a["misses"] for a in agents.values())
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": hits,
+            "misses": lookups - hits,
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+            "agents": agents,
+        }
+
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+
+def get_completion_cache():
+    """process-wide completion cache, or None when disabled with LLM_CACHE_ENABLED=false"""
+    global _completion_cache
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            _completion_cache = CompletionCache(
+                os.getenv("LLM_CACHE_PATH", "flask_session/llm_completion_cache.db"),
+                max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+            )
+        return _completion_cache
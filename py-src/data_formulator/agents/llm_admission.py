@@ -0,0 +1,279 @@
+import itertools
+import os
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+from data_formulator.agents.llm_telemetry import Histogram
+
+logger = logging.getLogger(__name__)
+
+# priority classes, lower is served first
+INTERACTIVE = 0
+BATCH = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+# concurrency limits for LLM-backed work: interactive requests and individual batch (indexing) LLM calls
+MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "16"))
+MAX_CONCURRENT_PER_USER = int(os.getenv("LLM_MAX_CONCURRENT_PER_USER", "4"))
+MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+MAX_QUEUE_WAIT = float(os.getenv("LLM_MAX_QUEUE_WAIT", "30"))
+
+# per-provider budgets (0 = unlimited), <ENDPOINT>_RPM / <ENDPOINT>_TPM override them for one endpoint
+PROVIDER_RPM = float(os.getenv("LLM_PROVIDER_RPM", "0"))
+PROVIDER_TPM = float(os.getenv("LLM_PROVIDER_TPM", "0"))
+# share of each provider bucket that batch calls may not use, so interactive requests are not starved
+BATCH_RESERVE = float(os.getenv("LLM_BATCH_RESERVE", "0.2"))
+MAX_BUDGET_WAIT = float(os.getenv("LLM_MAX_BUDGET_WAIT", "30"))
+
+
+class AdmissionRejected(Exception):
+    """raised when a request cannot be admitted: the queue is full or the wait timed out"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderBudgetExceeded(Exception):
+    """raised when a provider's local request / token budget stays exhausted for longer than the allowed wait"""
+    status_code = 429
+
+
+_context = threading.local()
+
+
+def current_priority():
+    return getattr(_context, "priority", INTERACTIVE)
+
+
+@contextmanager
+def llm_priority(priority, user=None):
+    """marks the LLM calls made by this thread with a priority class (and user, for batch admission)"""
+    previous = (getattr(_context, "priority", INTERACTIVE), getattr(_context, "user", None))
+    _context.priority, _context.user = priority, user
+    try:
+        yield
+    finally:
+        _context.priority, _context.user = previous
+
+
+class _Waiter(object):
+    __slots__ = ("user", "priority", "seq", "enqueued_at", "granted")
+
+    def __init__(self, user, priority, seq):
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.time()
+        self.granted = threading.Event()
+
+
+class AdmissionController(object):
+    """
+    Admits LLM-backed work under a global and a per-user concurrency limit. Requests that cannot run
+    wait in a bounded queue; free slots go to the highest priority class first, then to the user with
+    the fewest running requests (fair share), then first come first served.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_per_user=MAX_CONCURRENT_PER_USER,
+                 max_queue=MAX_QUEUE, max_wait=MAX_QUEUE_WAIT):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._active = {}
+        self._active_by_priority = {INTERACTIVE: 0, BATCH: 0}
+        self._queue = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._counters = {"admitted": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+        self._wait_times = {INTERACTIVE: Histogram(), BATCH: Histogram()}
+
+    def _can_run(self, user):
+        return (sum(self._active.values()) < self.max_concurrent
+                and self._active.get(user, 0) < self.max_per_user)
+
+    def _grant(self, user, priority):
+        self._active[user] = self._active.get(user, 0) + 1
+        self._active_by_priority[priority] += 1
+        self._counters["admitted"] += 1
+
+    def _dispatch(self):
+        # hand free slots to queued requests, called with the lock held
+        while self._queue and sum(self._active.values()) < self.max_concurrent:
+            eligible = [w for w in self._queue if self._active.get(w.user, 0) < self.max_per_user]
+            if not eligible:
+                return
+            waiter = min(eligible, key=lambda w: (w.priority, self._active.get(w.user, 0), w.seq))
+            self._queue.remove(waiter)
+            self._grant(waiter.user, waiter.priority)
+            self._wait_times[waiter.priority].observe(time.time() - waiter.enqueued_at)
+            waiter.granted.set()
+
+    def acquire(self, user, priority=INTERACTIVE, timeout=None):
+        timeout = self.max_wait if timeout is None else timeout
+        with self._lock:
+            if not self._queue and self._can_run(user):
+                self._grant(user, priority)
+                self._wait_times[priority].observe(0.0)
+                return
+            if len(self._queue) >= self.max_queue:
+                self._counters["rejected_queue_full"] += 1
+                raise AdmissionRejected("Too many queued requests, please retry later")
+            waiter = _Waiter(user, priority, next(self._seq))
+            self._queue.append(waiter)
+            self._dispatch()
+
+        if waiter.granted.wait(timeout):
+            return
+        with self._lock:
+            # granted between the timeout and taking the lock
+            if waiter.granted.is_set():
+                return
+            self._queue.remove(waiter)
+            self._counters["rejected_timeout"] += 1
+        raise AdmissionRejected(f"Request waited more than {timeout:.0f}s for a free slot, please retry later")
+
+    def release(self, user, priority=INTERACTIVE):
+        with self._lock:
+            self._active[user] -= 1
+            if self._active[user] <= 0:
+                del self._active[user]
+            self._active_by_priority[priority] -= 1
+            self._dispatch()
+
+    @contextmanager
+    def admit(self, user, priority=INTERACTIVE, timeout=None):
+        self.acquire(user, priority, timeout)
+        try:
+            yield
+        finally:
+            self.release(user, priority)
+
+    def stats(self):
+        with self._lock:
+            queued = {name: sum(1 for w in self._queue if w.priority == p) for p, name in PRIORITY_NAMES.items()}
+            oldest = min((w.enqueued_at for w in self._queue), default=None)
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_concurrent_per_user": self.max_per_user,
+                "max_queue": self.max_queue,
+                "max_queue_wait": self.max_wait,
+                "active": sum(self._active.values()),
+                "active_users": len(self._active),
+                "active_by_priority": {PRIORITY_NAMES[p]: n for p, n in self._active_by_priority.items()},
+                "queue_depth": len(self._queue),
+                "queued_by_priority": queued,
+                "oldest_queued_seconds": round(time.time() - oldest, 3) if oldest else None,
+                **self._counters,
+                "wait_time": {PRIORITY_NAMES[p]: h.snapshot() for p, h in self._wait_times.items()},
+            }
+
+
+class TokenBucket(object):
+    """refills `rate_per_minute` units per minute up to one minute's worth"""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        self.tokens = rate_per_minute
+        self.updated_at = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount, reserve=0.0):
+        """seconds until amount units (plus the reserved share) are available, 0 if they are now"""
+        self._refill(time.time())
+        # a single request larger than the bucket would never fit, let it through once the bucket is full
+        needed = min(amount + reserve * self.capacity, self.capacity)
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class ProviderBudget(object):
+    """request and token per-minute buckets of one provider"""
+
+    def __init__(self, name, rpm, tpm):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens, priority=INTERACTIVE, max_wait=MAX_BUDGET_WAIT):
+        reserve = BATCH_RESERVE if priority == BATCH else 0.0
+        deadline = time.time() + max_wait
+        waited = False
+        while True:
+            with self._lock:
+                wait = max(self.requests.wait_time(1, reserve) if self.requests else 0.0,
+                           self.tokens.wait_time(tokens, reserve) if self.tokens else 0.0)
+                if wait == 0.0:
+                    if self.requests:
+                        self.requests.take(1)
+                    if self.tokens:
+                        self.tokens.take(tokens)
+                    return
+                if not waited:
+                    self.throttled += 1
+                    waited = True
+            if time.time() + wait > deadline:
+                raise ProviderBudgetExceeded(f"Local rate limit of {self.name} exhausted")
+            time.sleep(min(wait, 1.0))
+            with self._lock:
+                self.throttled_seconds += min(wait, 1.0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "provider": self.name,
+                "rpm": self.requests.capacity if self.requests else None,
+                "tpm": self.tokens.capacity if self.tokens else None,
+                "available_requests": round(self.requests.tokens, 1) if self.requests else None,
+                "available_tokens": round(self.tokens.tokens) if self.tokens else None,
+                "throttled": self.throttled,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+            }
+
+
+_admission_controller = AdmissionController()
+_provider_budgets = {}
+_provider_budgets_lock = threading.Lock()
+
+
+def get_admission_controller():
+    return _admission_controller
+
+
+def get_provider_budget(name, endpoint):
+    """budget of the provider `name`, None if neither an RPM nor a TPM limit is configured for its endpoint"""
+    with _provider_budgets_lock:
+        if name not in _provider_budgets:
+            prefix = str(endpoint).upper()
+            rpm = float(os.getenv(f"{prefix}_RPM", PROVIDER_RPM))
+            tpm = float(os.getenv(f"{prefix}_TPM", PROVIDER_TPM))
+            _provider_budgets[name] = ProviderBudget(name, rpm, tpm) if rpm > 0 or tpm > 0 else None
+        return _provider_budgets[name]
+
+
+@contextmanager
+def admit_batch_call():
+    """admits a single LLM call of a batch (priority BATCH) thread; interactive calls are admitted per request"""
+    if current_priority() != BATCH:
+        yield
+        return
+    with _admission_controller.admit(getattr(_context, "user", None) or "batch", BATCH):
+        yield
+
+
+def admission_snapshot():
+    with _provider_budgets_lock:
+        budgets = [budget for budget in _provider_budgets.values() if budget is not None]
+    return {**_admission_controller.stats(), "provider_budgets": [budget.snapshot() for budget in budgets]}
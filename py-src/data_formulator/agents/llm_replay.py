@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+# replay behaviour, shared by all "replay" models
+REPLAY_LATENCY_MS = float(os.getenv("LLM_REPLAY_LATENCY_MS", "0"))
+REPLAY_JITTER_MS = float(os.getenv("LLM_REPLAY_JITTER_MS", "0"))
+# delay between streamed chunks, after the first one arrived after REPLAY_LATENCY_MS
+REPLAY_CHUNK_MS = float(os.getenv("LLM_REPLAY_CHUNK_MS", "0"))
+REPLAY_ERROR_RATE = float(os.getenv("LLM_REPLAY_ERROR_RATE", "0"))
+REPLAY_ERROR_STATUS = int(os.getenv("LLM_REPLAY_ERROR_STATUS", "503"))
+REPLAY_SEED = os.getenv("LLM_REPLAY_SEED", "0")
+# what to do for a prompt that was never recorded: "error" (404) or "echo" (a fixed placeholder answer)
+REPLAY_ON_MISS = os.getenv("LLM_REPLAY_ON_MISS", "error")
+
+# set to a JSONL file to record every completion of the real providers for later replay
+RECORD_PATH = os.getenv("LLM_RECORD_PATH", "")
+
+
+def replay_enabled():
+    """the replay endpoint is only served when the server enables it (REPLAY_ENABLED=true)"""
+    return os.getenv("REPLAY_ENABLED", "").lower() == "true"
+
+
+def replay_store_path():
+    """recording file replayed by the "replay" endpoint; always the server's, never a path sent by a client"""
+    return os.getenv("REPLAY_API_BASE") or os.getenv("LLM_REPLAY_PATH", "flask_session/llm_recordings.jsonl")
+
+
+class ReplayError(Exception):
+    """error returned by the replay backend; status_code follows the provider errors it stands in for"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def prompt_key(messages, n=1):
+    """hash of the prompt (roles and contents of the messages) and number of candidates, independent of the model"""
+    prompt = [{"role": m.get("role"), "content": m.get("content")} for m in messages]
+    return hashlib.sha256(json.dumps({"messages": prompt, "n": n}, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class RecordingStore(object):
+    """append-only JSONL file of recorded completions: {"key", "choices": [{role, content}], "usage", "model"}"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry
+            logger.info(f"Loaded {len(self.entries)} recorded completions from {path}")
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def record(self, messages, n, response, model=None):
+        """stores the choices and usage of a chat completion response under the prompt key"""
+        usage = getattr(response, "usage", None)
+        entry = {
+            "key": prompt_key(messages, n),
+            "model": model,
+            "choices": [{"role": choice.message.role, "content": choice.message.content} for choice in response.choices],
+            "usage": {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens} if usage else None,
+        }
+        with self._lock:
+            if entry["key"] in self.entries:
+                return
+            self.entries[entry["key"]] = entry
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+class ReplayBackend(object):
+    """
+    Offline stand-in for an LLM provider: answers prompts with the completions recorded in a
+    RecordingStore, after a configurable latency, and fails a configurable share of requests.
+    Responses have the shape of OpenAI chat completions (and chunks, when streamed).
+    """
+
+    def __init__(self, store, latency_ms=REPLAY_LATENCY_MS, jitter_ms=REPLAY_JITTER_MS, chunk_ms=REPLAY_CHUNK_MS,
+                 error_rate=REPLAY_ERROR_RATE, error_status=REPLAY_ERROR_STATUS, seed=REPLAY_SEED, on_miss=REPLAY_ON_MISS):
+        self.store = store
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.chunk_ms = chunk_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.on_miss = on_miss
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self):
+        with self._lock:
+            return self._random.random(), self._random.uniform(-1, 1)
+
+    def complete(self, model, messages, stream=False, n=1):
+        error_draw, jitter_draw = self._draw()
+        time.sleep(max(0.0, self.latency_ms + jitter_draw * self.jitter_ms) / 1000)
+
+        if error_draw < self.error_rate:
+            raise ReplayError(f"Injected replay error ({self.error_status})", self.error_status)
+
+        entry = self.store.get(prompt_key(messages, n))
+        if entry is None:
+            if self.on_miss != "echo":
+                raise ReplayError("No recorded completion for this prompt", 404)
+            entry = {"choices": [{"role": "assistant", "content": "[no recorded completion]"}] * n, "usage": None}
+
+        usage = SimpleNamespace(**entry["usage"]) if entry.get("usage") else None
+        if stream:
+            return self._stream(model, entry["choices"][0]["content"], usage)
+        return SimpleNamespace(model=model, usage=usage, choices=[
+            SimpleNamespace(index=i, finish_reason="stop", message=SimpleNamespace(role=choice["role"], content=choice["content"]))
+            for i, choice in enumerate(entry["choices"])
+        ])
+
+    def _stream(self, model, content, usage):
+        # split into word-sized chunks so token callbacks and time to first token behave like a real stream
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            if i > 0 and self.chunk_ms > 0:
+                time.sleep(self.chunk_ms / 1000)
+            text = word if i == len(words) - 1 else word + " "
+            yield SimpleNamespace(model=model, usage=None, choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=text))])
+        yield SimpleNamespace(model=model, usage=usage, choices=[])
+
+
+_replay_backends = {}
+_recording_store = None
+_replay_lock = threading.Lock()
+
+
+def get_replay_backend(store_path):
+    """process-wide replay backend for the recordings in store_path"""
+    with _replay_lock:
+        backend = _replay_backends.get(store_path)
+        if backend is None:
+            backend = _replay_backends[store_path] = ReplayBackend(RecordingStore(store_path))
+        return backend
+
+
+def get_recording_store():
+    """store that real completions are recorded to, or None unless LLM_RECORD_PATH is set"""
+    global _recording_store
+    if not RECORD_PATH:
+        return None
+    with _replay_lock:
+        if _recording_store is None:
+            _recording_store = RecordingStore(RECORD_PATH)
+        return _recording_store
@@ -0,0 +1,249 @@
+import os
+import random
+import threading
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# retry policy for transient provider errors (rate limits, 5xx, timeouts, dropped connections)
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# hedging: if a request takes longer than the provider's p95 latency, a second one is sent; its answer is used
+# if the first request fails. Requests run on the calling thread, only hedges use a (bounded) pool: once
+# HEDGE_MAX_CONCURRENT hedges are in flight no more are sent
+HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_CONCURRENT = int(os.getenv("LLM_HEDGE_MAX_CONCURRENT", "8"))
+LATENCY_WINDOW = 200
+
+# circuit breaker: after BREAKER_FAILURES consecutive failures the provider is skipped for BREAKER_COOLDOWN seconds
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+_hedge_executor = ThreadPoolExecutor(max_workers=max(1, HEDGE_MAX_CONCURRENT), thread_name_prefix="llm-hedge")
+_hedge_slots = threading.BoundedSemaphore(max(1, HEDGE_MAX_CONCURRENT))
+
+
+class CircuitOpenError(Exception):
+    """raised when a provider's circuit breaker is open and no request is sent"""
+
+
+def is_retryable(error):
+    """transient errors worth retrying (and failing over on): 429 / 5xx status codes, timeouts, connection errors"""
+    if isinstance(error, CircuitOpenError):
+        return True
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        try:
+            return int(status_code) in RETRYABLE_STATUS_CODES
+        except (TypeError, ValueError):
+            return False
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name or "RateLimit" in name or "ServiceUnavailable" in name
+
+
+def backoff_delay(attempt):
+    """exponential backoff with full jitter"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+class ProviderHealth(object):
+    """latency samples and circuit breaker state of one provider endpoint / model"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.consecutive_failures = 0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.hedged_requests = 0
+        self.opened_at = None
+        self.half_open_trial = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < BREAKER_COOLDOWN:
+                return False
+            # half-open: let a single trial request through after the cooldown
+            if self.half_open_trial:
+                return False
+            self.half_open_trial = True
+            return True
+
+    def record_success(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            self.total_requests += 1
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.half_open_trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.total_requests += 1
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            if self.half_open_trial or self.consecutive_failures >= BREAKER_FAILURES:
+                if self.opened_at is None or self.half_open_trial:
+                    logger.warning(f"Circuit breaker opened for {self.name} after {self.consecutive_failures} failures")
+                self.opened_at = time.time()
+                self.half_open_trial = False
+
+    def record_rejection(self):
+        """the provider answered with a non-transient error (e.g. a bad request): it is reachable, so the
+        request does not count toward the breaker"""
+        with self._lock:
+            self.total_requests += 1
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.half_open_trial = False
+
+    def record_hedge(self):
+        with self._lock:
+            self.hedged_requests += 1
+
+    def percentile(self, q):
+        with self._lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self):
+        """p95 latency once enough samples are collected, otherwise None (no hedging)"""
+        if not HEDGE_ENABLED or len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return self.percentile(0.95)
+
+    def snapshot(self):
+        with self._lock:
+            state = "closed" if self.opened_at is None else ("half-open" if self.half_open_trial else "open")
+            snapshot = {
+                "provider": self.name,
+                "state": state,
+                "consecutive_failures": self.consecutive_failures,
+                "total_requests": self.total_requests,
+                "total_failures": self.total_failures,
+                "hedged_requests": self.hedged_requests,
+                "samples": len(self.latencies),
+            }
+        snapshot["p50_latency"] = self.percentile(0.5)
+        snapshot["p95_latency"] = self.percentile(0.95)
+        return snapshot
+
+
+_provider_health = {}
+_provider_health_lock = threading.Lock()
+
+
+def get_provider_health(name):
+    with _provider_health_lock:
+        health = _provider_health.get(name)
+        if health is None:
+            health = _provider_health[name] = ProviderHealth(name)
+        return health
+
+
+def provider_health_snapshots():
+    with _provider_health_lock:
+        providers = list(_provider_health.values())
+    return [health.snapshot() for health in providers]
+
+
+def _timed_call(fn, health):
+    start = time.time()
+    result = fn()
+    health.record_success(time.time() - start)
+    return result
+
+
+def _hedged_call(fn, health, delay, before_hedge=None):
+    """runs fn() on the calling thread; if it has not returned after delay, a hedge is sent on the hedge pool
+    (unless the pool is saturated or before_hedge, e.g. the provider budget, raises). The hedge's answer is
+    used when the primary request fails."""
+    start = time.time()
+    hedge = []
+    primary_done = threading.Event()
+    lock = threading.Lock()
+
+    def run_hedge():
+        try:
+            return fn()
+        finally:
+            _hedge_slots.release()
+
+    def launch_hedge():
+        with lock:
+            if primary_done.is_set() or not _hedge_slots.acquire(blocking=False):
+                return
+            try:
+                if before_hedge is not None:
+                    before_hedge()
+            except Exception as e:
+                _hedge_slots.release()
+                logger.info(f"Not hedging request to {health.name}: {e}")
+                return
+            health.record_hedge()
+            logger.info(f"Hedging request to {health.name} after {delay:.2f}s")
+            hedge.append(_hedge_executor.submit(run_hedge))
+
+    def finish_primary():
+        timer.cancel()
+        with lock:
+            primary_done.set()
+
+    timer = threading.Timer(delay, launch_hedge)
+    timer.daemon = True
+    timer.start()
+    try:
+        result = fn()
+    except Exception as e:
+        finish_primary()
+        if not hedge or not is_retryable(e):
+            raise
+        try:
+            result = hedge[0].result()
+        except Exception:
+            raise e
+    else:
+        finish_primary()
+    health.record_success(time.time() - start)
+    return result
+
+
+def call_with_resilience(name, fn, hedge=True, before_hedge=None):
+    """
+    Calls fn() against the provider `name` with circuit breaking, retries with exponential backoff
+    and jitter on transient errors, and (if hedge) a hedged second request after the p95 latency;
+    before_hedge() is called before a hedge is sent and skips it by raising.
+    """
+    health = get_provider_health(name)
+    if not health.allow_request():
+        raise CircuitOpenError(f"Circuit breaker is open for {name}")
+
+    attempt = 0
+    while True:
+        try:
+            delay = health.hedge_delay() if hedge else None
+            return _hedged_call(fn, health, delay, before_hedge) if delay is not None else _timed_call(fn, health)
+        except Exception as e:
+            # only transient errors say the provider is unhealthy; a bad request or auth error is the caller's
+            if not is_retryable(e):
+                health.record_rejection()
+                raise
+            health.record_failure()
+            if attempt >= MAX_RETRIES or not health.allow_request():
+                raise
+            sleep_for = backoff_delay(attempt)
+            logger.warning(f"Retrying {name} in {sleep_for:.2f}s after error: {e}")
+            time.sleep(sleep_for)
+            attempt += 1
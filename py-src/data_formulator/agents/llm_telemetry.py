@@ -0,0 +1,224 @@
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+from collections import deque
+
+import litellm
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the latency / time-to-first-token histogram buckets; the last bucket is open-ended
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+# recent latencies kept per agent / model for percentiles
+LATENCY_WINDOW = 500
+
+# rolling JSONL log of every LLM call
+CALL_LOG_PATH = os.getenv("LLM_TELEMETRY_LOG", "flask_session/llm_calls.jsonl")
+CALL_LOG_MAX_BYTES = int(os.getenv("LLM_TELEMETRY_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+CALL_LOG_BACKUPS = int(os.getenv("LLM_TELEMETRY_LOG_BACKUPS", "3"))
+
+
+def _load_price_overrides():
+    """LLM_PRICING='{"<model>": [<usd per 1M prompt tokens>, <usd per 1M completion tokens>], ...}'"""
+    try:
+        return {model: (prices[0] / 1e6, prices[1] / 1e6)
+                for model, prices in json.loads(os.getenv("LLM_PRICING", "{}")).items()}
+    except (ValueError, TypeError, IndexError):
+        logger.warning("Ignoring malformed LLM_PRICING")
+        return {}
+
+
+PRICE_OVERRIDES = _load_price_overrides()
+
+
+def token_prices(endpoint, model):
+    """(usd per prompt token, usd per completion token), from LLM_PRICING or litellm's price map, or None"""
+    for name in (model, f"{endpoint}/{model}", str(model).split("/", 1)[-1]):
+        if name in PRICE_OVERRIDES:
+            return PRICE_OVERRIDES[name]
+        info = litellm.model_cost.get(name)
+        if info and "input_cost_per_token" in info:
+            return info["input_cost_per_token"], info.get("output_cost_per_token", 0.0)
+    return None
+
+
+def estimate_cost(endpoint, model, prompt_tokens, completion_tokens):
+    prices = token_prices(endpoint, model)
+    if prices is None or prompt_tokens is None:
+        return None
+    return round(prompt_tokens * prices[0] + (completion_tokens or 0) * prices[1], 8)
+
+
+class Histogram(object):
+    """fixed-bucket histogram plus a window of recent samples for percentiles"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.total += value
+        self.samples.append(value)
+
+    def percentile(self, q):
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))], 3)
+
+    def snapshot(self):
+        count = sum(self.counts)
+        labels = [f"le_{bound}" for bound in self.buckets] + ["le_inf"]
+        return {
+            "count": count,
+            "avg": round(self.total / count, 3) if count else None,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class CallStats(object):
+    """aggregated metrics of the calls of one agent to one model"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+        self.priced_calls = 0
+        self.latency = Histogram()
+        self.ttft = Histogram()
+
+    def add(self, record):
+        self.calls += 1
+        if record["cache_hit"]:
+            self.cache_hits += 1
+        if record["error"]:
+            self.errors[record["error"]] = self.errors.get(record["error"], 0) + 1
+        self.prompt_tokens += record["prompt_tokens"] or 0
+        self.completion_tokens += record["completion_tokens"] or 0
+        if record["cost_usd"] is not None:
+            self.cost_usd += record["cost_usd"]
+            self.priced_calls += 1
+        # cache hits would skew provider latency, they are only counted
+        if not record["cache_hit"]:
+            self.latency.observe(record["latency"])
+            if record["ttft"] is not None:
+                self.ttft.observe(record["ttft"])
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "errors": dict(self.errors),
+            "error_rate": round(sum(self.errors.values()) / self.calls, 3) if self.calls else None,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_usd": round(self.cost_usd, 6),
+            "priced_calls": self.priced_calls,
+            "latency": self.latency.snapshot(),
+            "ttft": self.ttft.snapshot(),
+        }
+
+
+class LLMTelemetry(object):
+    """
+    Collects one record per Client.get_completion call (agent, model, tokens, time to first token,
+    latency, cache hit, error class), aggregates them per agent / model and appends them to a
+    size-rotated JSONL log.
+    """
+
+    def __init__(self, log_path=CALL_LOG_PATH):
+        self.log_path = log_path
+        self.started_at = time.time()
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._call_log = self._init_call_log(log_path)
+
+    @staticmethod
+    def _init_call_log(log_path):
+        if not log_path:
+            return None
+        try:
+            os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=CALL_LOG_MAX_BYTES,
+                                                           backupCount=CALL_LOG_BACKUPS, encoding="utf-8")
+        except OSError as e:
+            logger.warning(f"LLM call log disabled, cannot open {log_path}: {e}")
+            return None
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        call_log = logging.getLogger(f"{__name__}.calls")
+        call_log.handlers = [handler]
+        call_log.setLevel(logging.INFO)
+        call_log.propagate = False
+        return call_log
+
+    def record(self, agent, endpoint, model, n=1, stream=False, latency=0.0, ttft=None,
+               prompt_tokens=None, completion_tokens=None, tokens_estimated=False, cache_hit=False, error=None):
+        record = {
+            "ts": round(time.time(), 3),
+            "agent": agent,
+            "endpoint": endpoint,
+            "model": model,
+            "n": n,
+            "stream": stream,
+            "latency": round(latency, 4),
+            "ttft": round(ttft, 4) if ttft is not None else None,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "tokens_estimated": tokens_estimated,
+            "cost_usd": None if cache_hit else estimate_cost(endpoint, model, prompt_tokens, completion_tokens),
+            "cache_hit": cache_hit,
+            "error": type(error).__name__ if error is not None else None,
+        }
+
+        with self._lock:
+            for key in ((agent, model), ("*", model), (agent, "*")):
+                stats = self._stats.get(key)
+                if stats is None:
+                    stats = self._stats[key] = CallStats()
+                stats.add(record)
+
+        if self._call_log is not None:
+            self._call_log.info(json.dumps(record))
+        return record
+
+    def snapshot(self):
+        with self._lock:
+            stats = {key: value.snapshot() for key, value in self._stats.items()}
+        return {
+            "since": self.started_at,
+            "by_agent_model": [{"agent": agent, "model": model, **value}
+                               for (agent, model), value in stats.items() if "*" not in (agent, model)],
+            "by_agent": {agent: value for (agent, model), value in stats.items() if model == "*"},
+            "by_model": {model: value for (agent, model), value in stats.items() if agent == "*"},
+        }
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.started_at = time.time()
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_llm_telemetry():
+    """process-wide LLM call telemetry"""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = LLMTelemetry()
+        return _telemetry
@@ -0,0 +1,123 @@
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# token budget for the data context ([CONTEXT] section) of a prompt, by model name (first matching substring wins)
+MODEL_DATA_TOKEN_BUDGETS = [
+    ("gpt-4.1", 16000),
+    ("gpt-4o-mini", 8000),
+    ("gpt-4o", 12000),
+    ("o1", 12000),
+    ("o3", 12000),
+    ("claude", 12000),
+    ("gemini", 16000),
+    ("gpt-3.5", 3000),
+    ("ollama/", 2500),
+]
+DEFAULT_DATA_TOKEN_BUDGET = 6000
+
+# token budget for previous messages / dialog carried into a prompt
+DIALOG_TOKEN_BUDGET = int(os.getenv("PROMPT_DIALOG_TOKEN_BUDGET", "6000"))
+
+# summary settings tried in order until the data context fits its budget; columns are pruned after the last one
+COMPRESSION_LEVELS = [
+    {"field_sample_size": 7, "max_val_chars": 140, "row_sample_size": 5},
+    {"field_sample_size": 5, "max_val_chars": 60, "row_sample_size": 3},
+    {"field_sample_size": 3, "max_val_chars": 30, "row_sample_size": 2},
+]
+MIN_SUMMARIZED_COLUMNS = 8
+
+
+def estimate_tokens(text):
+    """rough token estimate (~4 characters per token for English text, code and tables)"""
+    return (len(text) + 3) // 4
+
+
+def get_data_token_budget(client):
+    """token budget for the data context of prompts sent through client (env PROMPT_DATA_TOKEN_BUDGET overrides)"""
+    if os.getenv("PROMPT_DATA_TOKEN_BUDGET"):
+        return int(os.getenv("PROMPT_DATA_TOKEN_BUDGET"))
+    model = str(getattr(client, "model", "")).lower()
+    for pattern, budget in MODEL_DATA_TOKEN_BUDGETS:
+        if pattern in model:
+            return budget
+    return DEFAULT_DATA_TOKEN_BUDGET
+
+
+def _name_tokens(text):
+    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', str(text))
+    return {t for t in re.split(r'[^a-z0-9]+', text.lower()) if len(t) > 1}
+
+
+def rank_columns(columns, instruction="", priority_fields=()):
+    """columns ordered by relevance: fields named in priority_fields, then columns sharing words with the instruction,
+    then the rest in their original order"""
+    instruction_text = str(instruction).lower()
+    instruction_tokens = _name_tokens(instruction)
+    priority = {str(f).lower() for f in priority_fields}
+
+    def score(item):
+        index, column = item
+        name = str(column)
+        if name.lower() in priority:
+            return (0, index)
+        if name.lower() in instruction_text:
+            return (1, index)
+        overlap = len(_name_tokens(name) & instruction_tokens)
+        return (2, -overlap, index) if overlap else (3, index)
+
+    return [column for _, column in sorted(enumerate(columns), key=score)]
+
+
+def select_columns(columns, max_columns, instruction="", priority_fields=()):
+    """the max_columns most relevant columns (in their original order) and the omitted ones"""
+    columns = list(columns)
+    if max_columns is None or len(columns) <= max_columns:
+        return columns, []
+    keep = set(rank_columns(columns, instruction, priority_fields)[:max_columns])
+    return [c for c in columns if c in keep], [c for c in columns if c not in keep]
+
+
+def fit_to_budget(render, token_budget, base_settings, num_columns):
+    """
+    render(**settings) -> prompt text. Tries base_settings, then the compression levels (never exceeding
+    base_settings), then halves the number of summarized columns, until the text fits token_budget.
+    """
+    text = None
+    levels = [base_settings] + [{key: min(base_settings.get(key, value), value) for key, value in level.items()}
+                                for level in COMPRESSION_LEVELS]
+    for settings in levels:
+        text = render(**settings)
+        if estimate_tokens(text) <= token_budget:
+            return text
+
+    max_columns = num_columns
+    while max_columns > MIN_SUMMARIZED_COLUMNS:
+        max_columns = max(MIN_SUMMARIZED_COLUMNS, max_columns // 2)
+        text = render(max_columns=max_columns, **settings)
+        if estimate_tokens(text) <= token_budget:
+            break
+
+    logger.info(f"data context compressed to ~{estimate_tokens(text)} tokens (budget {token_budget})")
+    return text
+
+
+def trim_messages(messages, token_budget=DIALOG_TOKEN_BUDGET, keep_first=0, keep_last=2):
+    """drops the oldest messages until the dialog fits token_budget; the first keep_first messages (e.g. system prompt
+    and the user message carrying the data context, which has its own budget) are always kept and not counted,
+    and the last keep_last messages are always kept"""
+    messages = list(messages)
+    head, body = messages[:keep_first], messages[keep_first:]
+
+    def total(msgs):
+        return sum(estimate_tokens(str(m.get("content", ""))) for m in msgs)
+
+    dropped = 0
+    while len(body) > keep_last and total(body) > token_budget:
+        body.pop(0)
+        dropped += 1
+    if dropped:
+        logger.info(f"dropped {dropped} old messages to fit the dialog budget of {token_budget} tokens")
+    return head + body
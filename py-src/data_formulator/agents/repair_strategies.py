@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import data_formulator.py_sandbox as py_sandbox
+
+logger = logging.getLogger(__name__)
+
+# how a repair asks the model to fix a failed execution: the error framing, and the sampling temperature
+# (None keeps the client's own temperature)
+REPAIR_STRATEGIES = {
+    "reflect": {
+        "temperature": None,
+        "instruction": "We run into the following problem executing the code, please fix it:\n\n{error}\n\n"
+                       "Please think step by step, reflect why the error happens and fix the code so that no more errors would occur.",
+    },
+    "minimal_fix": {
+        "temperature": 0.2,
+        "instruction": "Executing the code fails with the following error:\n\n{error}\n\n"
+                       "Make the smallest change to the code that fixes this error, keep the rest of the code and the output fields as they are.",
+    },
+    "rewrite": {
+        "temperature": 1.0,
+        "instruction": "Executing the code fails with the following error:\n\n{error}\n\n"
+                       "The current approach does not work. Rewrite the code with a different, simpler approach that produces the same output fields, "
+                       "and double check the column names and data types of the input tables it uses.",
+    },
+}
+
+# strategies tried at once on every repair attempt; "reflect" alone repairs one fix at a time. Every extra strategy
+# is another model call per repair, so several strategies are opt-in (e.g. REPAIR_STRATEGIES=reflect,minimal_fix,rewrite)
+DEFAULT_REPAIR_STRATEGIES = [name.strip() for name in os.getenv("REPAIR_STRATEGIES", "reflect").split(",")
+                             if name.strip() in REPAIR_STRATEGIES] or ["reflect"]
+
+
+def select_repair_strategies(strategies=None):
+    """the strategies of a request: DEFAULT_REPAIR_STRATEGIES for None, otherwise the known names of a list of
+    strategy names, each once and in order; anything else is rejected"""
+    if strategies is None:
+        return DEFAULT_REPAIR_STRATEGIES
+    if not isinstance(strategies, list) or not all(isinstance(strategy, str) for strategy in strategies):
+        raise ValueError("repair_strategies must be a list of strategy names")
+    return list(dict.fromkeys(strategy for strategy in strategies if strategy in REPAIR_STRATEGIES)) or ["reflect"]
+
+
+def repair_instruction(strategy, error_message):
+    return REPAIR_STRATEGIES[strategy]["instruction"].format(error=error_message)
+
+
+def strategy_client(client, strategy):
+    """the client a strategy's fix is asked with; a StreamingClient only streams the strategies that keep the
+    client's temperature (with_params returns a copy of the wrapped, non-streaming client)"""
+    temperature = REPAIR_STRATEGIES[strategy]["temperature"]
+    return client if temperature is None else client.with_params(temperature=temperature)
+
+
+class RepairStats(object):
+    """per strategy: repairs it took part in, repairs it won (its fix ran first) and the time to its winning fix"""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, strategies, winner, elapsed):
+        with self._lock:
+            for strategy in strategies:
+                stats = self._stats.setdefault(strategy, {"attempts": 0, "wins": 0, "win_seconds": 0.0})
+                stats["attempts"] += 1
+                if strategy == winner:
+                    stats["wins"] += 1
+                    stats["win_seconds"] += elapsed
+
+    def stats(self):
+        with self._lock:
+            strategies = {name: dict(stats) for name, stats in self._stats.items()}
+        for stats in strategies.values():
+            stats["win_rate"] = round(stats["wins"] / stats["attempts"], 3) if stats["attempts"] else None
+            win_seconds = stats.pop("win_seconds")
+            stats["mean_win_seconds"] = round(win_seconds / stats["wins"], 3) if stats["wins"] else None
+        return {"default_strategies": DEFAULT_REPAIR_STRATEGIES, "strategies": strategies}
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+_repair_stats = RepairStats()
+
+
+def get_repair_stats():
+    return _repair_stats
+
+
+def repair_in_parallel(attempt, client, error_message, strategies=None):
+    """
+    Asks for one fix per strategy at once and returns (results, winning strategy). attempt(client, instruction)
+    runs the agent follow-up with a strategy's client and instruction and returns its selected candidates. The
+    results of the first strategy whose candidate runs ('ok') win and the sandbox executions of the other strategies
+    are cancelled; if no strategy succeeds, the results of the first strategy are returned with winner None. It only
+    returns once every strategy has finished, so their model calls stay within the request (and its admission slot)
+    and nothing uses the request's database connection after it is closed.
+    """
+    strategies = select_repair_strategies(strategies)
+    start = time.time()
+
+    def run(strategy):
+        results = attempt(strategy_client(client, strategy), repair_instruction(strategy, error_message))
+        for result in results:
+            result['repair_strategy'] = strategy
+        return results
+
+    def finish(results, winner):
+        get_repair_stats().record(strategies, winner, time.time() - start)
+        logger.info(f"repair with {strategies}: {winner or 'no strategy'} succeeded after {time.time() - start:.2f}s")
+        return results, winner
+
+    if len(strategies) == 1:
+        results = run(strategies[0])
+        return finish(results, strategies[0] if results[0]['status'] == 'ok' else None)
+
+    cancel_event = threading.Event()
+    parent_scope = py_sandbox.cancel_scope()
+
+    def run_cancellable(strategy):
+        with py_sandbox.cancel_on(cancel_event, parent_scope):
+            return run(strategy)
+
+    executor = ThreadPoolExecutor(max_workers=len(strategies))
+    try:
+        futures = {executor.submit(run_cancellable, strategy): strategy for strategy in strategies}
+        failed = {}
+        for future in as_completed(futures):
+            strategy = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.warning(f"repair strategy {strategy} failed: {e}")
+                results = [{'status': 'other error', 'content': f"An error occurred during repair. Error type: {type(e).__name__}",
+                            'repair_strategy': strategy}]
+            if results[0]['status'] == 'ok':
+                return finish(results, strategy)
+            failed[strategy] = results
+        # the next repair continues the dialog of a failed fix, the first strategy's if it got that far
+        with_dialog = [failed[strategy] for strategy in strategies if 'dialog' in failed[strategy][0]]
+        return finish(with_dialog[0] if with_dialog else failed[strategies[0]], None)
+    finally:
+        # losing strategies stop at their next sandbox execution; wait for their model calls to return
+        cancel_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
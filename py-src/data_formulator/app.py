@@ -34,6 +34,7 @@ import base64
 
 # Import authentication service
 from data_formulator.auth_service import AuthService
+from data_formulator import py_sandbox
 
 APP_ROOT = Path(os.path.join(Path(__file__).parent)).absolute()
 
@@ -405,6 +406,14 @@ def run_app():
         'disable_display_keys': args.disable_display_keys
     }
 
+    if py_sandbox.pa is None:
+        logger.warning("pyarrow is not installed: dataframes are pickled to and from the sandbox and the "
+                       "execution cache is disabled")
+
+    if args.exec_python_in_subprocess:
+        # start the sandbox workers now so the first transform does not pay for their start-up
+        py_sandbox.start_sandbox_pool()
+
     url = "http://localhost:{0}".format(args.port)
     threading.Timer(2, lambda: webbrowser.open(url, new=2)).start()
 
@@ -0,0 +1,256 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import ast
+import hashlib
+import hmac
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import data_formulator.py_sandbox as py_sandbox
+from data_formulator.data_loader.external_data_loader import sanitize_table_name
+from data_formulator.db_manager import fetch_frame
+
+logger = logging.getLogger(__name__)
+
+# rows per chunk a derivation is applied to, and chunks processed in parallel (by the sandbox pool workers)
+CONCEPT_CHUNK_ROWS = int(os.getenv("CONCEPT_CHUNK_ROWS", "200000"))
+CONCEPT_WORKERS = int(os.getenv("CONCEPT_WORKERS", str(py_sandbox.SANDBOX_POOL_SIZE)))
+# rows (taken from the start and the end of the table) on which the vectorized rewrite and the row-wise
+# behaviour of a derivation are checked
+CONCEPT_PROBE_ROWS = int(os.getenv("CONCEPT_PROBE_ROWS", "2000"))
+
+ROW_ID = "__df_row_id"
+
+
+class ConceptDeriveError(Exception):
+    """the derivation code failed on the table; the message is the sandbox error"""
+
+
+class ConceptOutputExists(Exception):
+    """the output table (or its values table) of a derivation already exists and overwriting was not asked for"""
+
+
+def derivation_signature(code, session_id, secret):
+    """
+    HMAC of a derivation the concept agent generated for a session. derive-column only runs code that
+    comes back with the signature the server gave it, never code written by the caller.
+    """
+    message = f"{session_id}\n{code}".encode("utf-8")
+    return hmac.new(str(secret).encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def verify_derivation_signature(code, session_id, secret, signature):
+    return bool(signature) and hmac.compare_digest(derivation_signature(code, session_id, secret), str(signature))
+
+
+class _ColumnArrayRewriter(ast.NodeTransformer):
+    """
+    Rewrites per-element `x.apply(f)` / `x.map(f)` and per-row `df.apply(f, axis=1)` calls into a single
+    call `f(x)` on the whole column (or frame), so that arithmetic, comparisons and .str / .dt accessors in
+    f run over column arrays. Whether the rewrite means the same is not decided here but checked on data.
+    """
+
+    def __init__(self):
+        self.rewritten = 0
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if not (isinstance(func, ast.Attribute) and func.attr in ("apply", "map")
+                and len(node.args) == 1 and isinstance(node.args[0], (ast.Lambda, ast.Name))):
+            return node
+        keywords = {keyword.arg: keyword.value for keyword in node.keywords}
+        if func.attr == "map" and keywords:
+            return node
+        if func.attr == "apply" and (set(keywords) - {"axis"}
+                                     or ("axis" in keywords and getattr(keywords["axis"], "value", None) not in (1, "columns"))):
+            return node
+        self.rewritten += 1
+        return ast.copy_location(ast.Call(func=node.args[0], args=[func.value], keywords=[]), node)
+
+
+def vectorize_derivation(code):
+    """the code with its per-row apply / map calls rewritten to column array calls, or None if it has none"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    rewriter = _ColumnArrayRewriter()
+    tree = ast.fix_missing_locations(rewriter.visit(tree))
+    return ast.unparse(tree) if rewriter.rewritten > 0 else None
+
+
+def run_derivation(code, df, exec_python_in_subprocess=False):
+    """the new column (a Series aligned with df) that the derivation code computes on df"""
+    invalid = py_sandbox.validate_code(code, 'derive_new_column')
+    if invalid is not None:
+        raise ConceptDeriveError(invalid['error_message'])
+
+    assemble_code = f'''
+import pandas as pd
+{code}
+new_column = derive_new_column(df)
+df = None
+'''
+    allowed_objects = {'df': df if exec_python_in_subprocess else df.copy(), 'new_column': None}
+    if exec_python_in_subprocess:
+        result = py_sandbox.run_in_subprocess(assemble_code, allowed_objects)
+    else:
+        result = py_sandbox.run_in_main_process(assemble_code, allowed_objects)
+    if result['status'] != 'ok':
+        raise ConceptDeriveError(result['error_message'])
+
+    # same alignment as assigning the column in run_derive_concept
+    aligned = pd.DataFrame(index=df.index)
+    aligned['value'] = result['allowed_objects']['new_column']
+    return aligned['value']
+
+
+def _same_values(left, right):
+    try:
+        pd.testing.assert_series_equal(left.reset_index(drop=True), right.reset_index(drop=True),
+                                       check_dtype=False, check_names=False)
+        return True
+    except AssertionError:
+        return False
+
+
+def probe_derivation(code, probe_df, exec_python_in_subprocess=False):
+    """
+    Checks a derivation on sample rows of the table. Returns (code to run, vectorized, row_wise): the
+    column array rewrite is used when it gives the same values as the original code, and the derivation
+    is row-wise (can be applied chunk by chunk) when applying it separately to the first row, the rest of
+    the first half and the second half gives the same values as applying it to all rows at once.
+    """
+    expected = run_derivation(code, probe_df, exec_python_in_subprocess)
+
+    vectorized = False
+    vectorized_code = vectorize_derivation(code)
+    if vectorized_code is not None:
+        try:
+            vectorized = _same_values(run_derivation(vectorized_code, probe_df, exec_python_in_subprocess), expected)
+        except ConceptDeriveError:
+            vectorized = False
+    if vectorized:
+        code = vectorized_code
+
+    half = len(probe_df) // 2
+    if half == 0:
+        return code, vectorized, True
+    try:
+        pieces = [probe_df.iloc[:1], probe_df.iloc[1:half], probe_df.iloc[half:]]
+        separately = pd.concat([run_derivation(code, piece, exec_python_in_subprocess) for piece in pieces if len(piece) > 0])
+        row_wise = _same_values(separately, expected)
+    except ConceptDeriveError:
+        row_wise = False
+    return code, vectorized, row_wise
+
+
+def _existing_kind(conn, name):
+    """'BASE TABLE' or 'VIEW' if name exists in conn, else None"""
+    row = conn.execute("SELECT table_type FROM information_schema.tables WHERE lower(table_name) = lower(?)",
+                       [name]).fetchone()
+    return row[0] if row else None
+
+
+def derive_column_to_table(conn, table_name, code, output_field, output_name=None, input_fields=None,
+                           materialize="table", overwrite=False, exec_python_in_subprocess=False,
+                           chunk_rows=CONCEPT_CHUNK_ROWS):
+    """
+    Applies an accepted derive_new_column function to the full table `table_name` of conn and stores the
+    result as `output_name` (default <table>_<field>): a table with the new column (materialize="table"), or
+    a view joining the table with the derived values (materialize="view"; it matches rows by rowid, so it is
+    only valid while the table is not modified). Row-wise derivations are applied to chunks of chunk_rows rows
+    in parallel, others to the whole table at once. Only input_fields (default all columns) are loaded.
+    Existing tables named output_name or <output_name>__values are only replaced with overwrite, raises
+    ConceptOutputExists otherwise.
+    """
+    table_name = sanitize_table_name(table_name)
+    output_name = sanitize_table_name(output_name or f"{table_name}_{output_field}")
+    values_table = f"{output_name}__values"
+    field = output_field.replace('"', '""')
+
+    if output_name.lower() == table_name.lower() or values_table.lower() == table_name.lower():
+        raise ConceptOutputExists(f"the output of a derivation cannot replace its input table {table_name}")
+    existing = {name: _existing_kind(conn, name) for name in (output_name, values_table)}
+    if not overwrite:
+        for name, kind in existing.items():
+            if kind is not None:
+                raise ConceptOutputExists(f"Table {name} already exists; set overwrite to replace it")
+    # without overwrite, a table created meanwhile by another request makes the CREATE fail instead of being replaced
+    create = "CREATE OR REPLACE" if overwrite else "CREATE"
+
+    columns = ", ".join('"{}"'.format(name.replace('"', '""')) for name in input_fields) if input_fields else "*"
+    select = f"SELECT rowid AS {ROW_ID}, {columns} FROM {table_name}"
+    row_count, max_row_id = conn.execute(f"SELECT COUNT(*), MAX(rowid) FROM {table_name}").fetchone()
+
+    def load(start=None, stop=None):
+        query = select if start is None else f"{select} WHERE rowid >= {start} AND rowid < {stop}"
+        df = fetch_frame(conn, f"{query} ORDER BY rowid")
+        return df.pop(ROW_ID), df
+
+    if max_row_id is None or max_row_id < CONCEPT_PROBE_ROWS:
+        _, probe_df = load()
+    else:
+        probe_df = pd.concat([load(0, CONCEPT_PROBE_ROWS // 2)[1],
+                              load(max_row_id + 1 - CONCEPT_PROBE_ROWS // 2, max_row_id + 1)[1]], ignore_index=True)
+    code, vectorized, row_wise = probe_derivation(code, probe_df, exec_python_in_subprocess)
+    logger.info(f"deriving {output_field} on {table_name} ({row_count} rows): vectorized={vectorized}, row_wise={row_wise}")
+
+    def derive(chunk):
+        row_ids, df = chunk
+        return pd.DataFrame({ROW_ID: row_ids.values, output_field: run_derivation(code, df, exec_python_in_subprocess).values})
+
+    def store(values, first):
+        conn.register('df_temp', values)
+        if first:
+            if existing[values_table] == "VIEW":
+                conn.execute(f"DROP VIEW {values_table}")
+            conn.execute(f"{create} TABLE {values_table} AS SELECT * FROM df_temp")
+        else:
+            conn.execute(f"INSERT INTO {values_table} SELECT * FROM df_temp")
+        conn.unregister('df_temp')
+
+    chunks = 0
+    if not row_wise or max_row_id is None or max_row_id < chunk_rows:
+        store(derive(load()), True)
+        chunks = 1
+    else:
+        # the connection is used by this thread only: chunks are loaded and stored here, derived in the pool;
+        # at most 2 * CONCEPT_WORKERS chunks are held in memory
+        starts = iter(range(0, max_row_id + 1, chunk_rows))
+        with ThreadPoolExecutor(max_workers=CONCEPT_WORKERS) as executor:
+            pending = []
+            for start in starts:
+                pending.append(executor.submit(derive, load(start, start + chunk_rows)))
+                if len(pending) >= 2 * CONCEPT_WORKERS:
+                    store(pending.pop(0).result(), chunks == 0)
+                    chunks += 1
+            for future in pending:
+                store(future.result(), chunks == 0)
+                chunks += 1
+
+    joined = (f'SELECT t.*, v."{field}" FROM {table_name} t JOIN {values_table} v ON t.rowid = v.{ROW_ID} '
+              f'ORDER BY t.rowid')
+    materialize = "view" if materialize == "view" else "table"
+    # a table cannot be replaced by a view or the other way round
+    if existing[output_name] is not None and existing[output_name] != ("VIEW" if materialize == "view" else "BASE TABLE"):
+        conn.execute(f"DROP {'VIEW' if existing[output_name] == 'VIEW' else 'TABLE'} {output_name}")
+    if materialize == "table":
+        conn.execute(f"{create} TABLE {output_name} AS {joined}")
+        conn.execute(f"DROP TABLE {values_table}")
+    else:
+        conn.execute(f"{create} VIEW {output_name} AS {joined}")
+
+    return {
+        "table_name": output_name,
+        "materialize": materialize,
+        "row_count": row_count,
+        "chunks": chunks,
+        "vectorized": vectorized,
+        "row_wise": row_wise,
+    }
@@ -1,12 +1,28 @@
 import json
 import sqlite3
 import os
+import threading
+from collections import OrderedDict
 from typing import Dict, Any, List, Optional
 from datetime import datetime
 import logging
 
+from data_formulator.data_loader.schema_retriever import invalidate_schema_retriever
+from data_formulator.data_loader.join_graph import infer_relationships, shortest_join_paths, format_join_path
+
 logger = logging.getLogger(__name__)
 
+# NLP context'leri için süreç içi LRU cache: (index_db_path, database_id, selected_tables, mode) -> context
+CONTEXT_CACHE_SIZE = 64
+_context_cache: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+_context_cache_lock = threading.Lock()
+
+
+class IndexingCancelled(Exception):
+    """progress_callback içinden fırlatılır; indeksleme işini yarıda keser (daha sonra resume edilebilir)"""
+    pass
+
+
 class DatabaseIndexer:
     """
     Database Indexer - Veritabanı şemalarını ve metadata'larını indeksler ve saklar.
@@ -28,6 +44,33 @@ class DatabaseIndexer:
         conn.execute('PRAGMA busy_timeout=60000')  # 60 second timeout
         conn.execute('PRAGMA wal_autocheckpoint=1000')
         return conn
+
+    def _invalidate_caches(self, database_id: int = None):
+        """İndeks yazıldığında bu veritabanına ait cache'lenmiş context ve retriever'ları temizle"""
+        with _context_cache_lock:
+            for key in list(_context_cache.keys()):
+                if key[0] == self.index_db_path and (database_id is None or key[1] == database_id):
+                    del _context_cache[key]
+        invalidate_schema_retriever(self.index_db_path, database_id)
+
+    def _get_cached_context(self, database_id: int, selected_tables: Optional[List[int]], mode: str, build):
+        """Context'i LRU cache'ten getir, yoksa build() ile oluşturup cache'e koy"""
+        key = (self.index_db_path, database_id, tuple(sorted(selected_tables)) if selected_tables else None, mode)
+        with _context_cache_lock:
+            if key in _context_cache:
+                _context_cache.move_to_end(key)
+                return _context_cache[key]
+
+        context = build()
+
+        # Hata sonuçlarını cache'leme (ör. veritabanı henüz indekslenmemiş olabilir)
+        if 'error' not in context:
+            with _context_cache_lock:
+                _context_cache[key] = context
+                _context_cache.move_to_end(key)
+                while len(_context_cache) > CONTEXT_CACHE_SIZE:
+                    _context_cache.popitem(last=False)
+        return context
     
     def _init_index_database(self):
         """Index veritabanını başlat"""
@@ -55,6 +98,11 @@ class DatabaseIndexer:
                 status TEXT DEFAULT 'active'
             )
         ''')
+
+        # Eski indeks dosyalarında index_version kolonu yok; NLP-SQL cache anahtarı için ekle
+        cursor.execute('PRAGMA table_info(indexed_databases)')
+        if 'index_version' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE indexed_databases ADD COLUMN index_version INTEGER DEFAULT 1')
         
         # Indexed schemas table
         cursor.execute('''
@@ -106,6 +154,33 @@ class DatabaseIndexer:
             )
         ''')
         
+        # Relationships table - Tanımlı (PK/FK) ve tahmin edilen join kenarları
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS indexed_relationships (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                database_id INTEGER,
+                from_table_id INTEGER,
+                from_column TEXT NOT NULL,
+                to_table_id INTEGER,
+                to_column TEXT NOT NULL,
+                source TEXT DEFAULT 'declared',
+                confidence REAL DEFAULT 1.0,
+                FOREIGN KEY (database_id) REFERENCES indexed_databases (id)
+            )
+        ''')
+        
+        # Join paths table - Tablo çiftleri arasındaki ön hesaplanmış en kısa join yolları
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS indexed_join_paths (
+                database_id INTEGER,
+                from_table_id INTEGER,
+                to_table_id INTEGER,
+                hops INTEGER,
+                path TEXT,
+                PRIMARY KEY (database_id, from_table_id, to_table_id)
+            )
+        ''')
+        
         conn.commit()
         conn.close()
     
@@ -240,14 +315,18 @@ class DatabaseIndexer:
                     
                     indexed_columns_count += 1
             
+            # PK/FK kısıtlarını topla ve join yollarını ön hesapla
+            self._index_relationships(conn, database_id, data_loader_instance)
+            
             # Update total counts
             cursor.execute('''
                 UPDATE indexed_databases 
-                SET total_tables = ?, total_schemas = ?
+                SET total_tables = ?, total_schemas = ?, index_version = index_version + 1
                 WHERE id = ?
             ''', (indexed_tables_count, len(schemas), database_id))
             
             conn.commit()
+            self._invalidate_caches(database_id)
             
             result = {
                 'status': 'success',
@@ -276,9 +355,17 @@ class DatabaseIndexer:
                                    data_loader_instance, 
                                    ai_client=None,
                                    progress_callback=None,
-                                   compact: bool = False) -> Dict[str, Any]:
-        """Progress tracking ile veritabanı indeksleme"""
+                                   compact: bool = False,
+                                   resume_database_id: Optional[int] = None,
+                                   on_database_created=None) -> Dict[str, Any]:
+        """Progress tracking ile veritabanı indeksleme
+
+        Her tablo ayrı commit edilir; iş progress_callback içinden IndexingCancelled ile durdurulursa
+        o ana kadar yazılan tablolar korunur ve resume_database_id verilerek kalan tablolarla devam edilir.
+        Veritabanı kaydı indeksleme bitene kadar 'indexing' durumunda kalır, bitince 'active' olur.
+        """
         conn = None
+        database_id = resume_database_id
         try:
             if progress_callback:
                 progress_callback(5, "Connecting to database...", 0, 0)
@@ -294,14 +381,28 @@ class DatabaseIndexer:
             conn = self._get_connection()
             cursor = conn.cursor()
             
-            # Insert database record
-            cursor.execute('''
-                INSERT INTO indexed_databases 
-                (data_loader_type, connection_name, connection_params, total_tables, total_schemas, status)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (data_loader_type, connection_name, json.dumps(connection_params), 0, 0, 'active'))
-            
-            database_id = cursor.lastrowid
+            already_indexed = set()
+            existing_schema_ids = {}
+            if resume_database_id is not None:
+                # Resume: önceki çalışmada yazılan şema ve tabloları tekrar işleme
+                cursor.execute('SELECT schema_name, id FROM indexed_schemas WHERE database_id = ?', (database_id,))
+                existing_schema_ids = dict(cursor.fetchall())
+                cursor.execute('SELECT full_table_name FROM indexed_tables WHERE database_id = ?', (database_id,))
+                already_indexed = {row[0] for row in cursor.fetchall()}
+                logger.info(f"Resuming indexing of database {database_id}: {len(already_indexed)} tables already indexed")
+            else:
+                # Insert database record
+                cursor.execute('''
+                    INSERT INTO indexed_databases 
+                    (data_loader_type, connection_name, connection_params, total_tables, total_schemas, status)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (data_loader_type, connection_name, json.dumps(connection_params), 0, 0, 'indexing'))
+                
+                database_id = cursor.lastrowid
+                conn.commit()
+
+            if on_database_created:
+                on_database_created(database_id)
             
             if progress_callback:
                 progress_callback(15, "Processing schemas...", total_tables, 0)
@@ -340,13 +441,17 @@ class DatabaseIndexer:
             # Insert schemas
             schema_ids = {}
             for schema_name, schema_tables in schemas.items():
+                if schema_name in existing_schema_ids:
+                    schema_ids[schema_name] = existing_schema_ids[schema_name]
+                    continue
                 cursor.execute('''
                     INSERT INTO indexed_schemas (database_id, schema_name, table_count)
                     VALUES (?, ?, ?)
                 ''', (database_id, schema_name, len(schema_tables)))
                 schema_ids[schema_name] = cursor.lastrowid
+            conn.commit()
             
-            indexed_tables_count = 0
+            indexed_tables_count = len(already_indexed)
             indexed_columns_count = 0
             
             if compact:
@@ -354,6 +459,9 @@ class DatabaseIndexer:
             
             # Process each table with progress
             for table_idx, table in enumerate(tables):
+                if table['name'] in already_indexed:
+                    continue
+
                 # Use the same logic as schema grouping to determine schema_name
                 if 'metadata' in table:
                     table_name = table['name']
@@ -483,15 +591,25 @@ class DatabaseIndexer:
                         ))
                     
                     indexed_columns_count += 1
+
+                # Tablo bazında commit: iş iptal edilirse buraya kadarki tablolar kalıcıdır
+                conn.commit()
+            
+            if progress_callback:
+                progress_callback(96, "Building join graph...", total_tables, total_tables)
+            
+            # PK/FK kısıtlarını topla ve join yollarını ön hesapla
+            self._index_relationships(conn, database_id, data_loader_instance)
             
             # Update total counts
             cursor.execute('''
                 UPDATE indexed_databases 
-                SET total_tables = ?, total_schemas = ?
+                SET total_tables = ?, total_schemas = ?, status = 'active', index_version = index_version + 1
                 WHERE id = ?
             ''', (indexed_tables_count, len(schemas), database_id))
             
             conn.commit()
+            self._invalidate_caches(database_id)
             
             if progress_callback:
                 progress_callback(100, "Database indexing completed!", total_tables, total_tables)
@@ -508,18 +626,175 @@ class DatabaseIndexer:
             logger.info(f"Database indexing completed: {result}")
             return result
             
+        except IndexingCancelled:
+            logger.info(f"Database indexing cancelled: database_id={database_id}")
+            return {
+                'status': 'cancelled',
+                'database_id': database_id,
+                'message': 'Indexing cancelled'
+            }
         except Exception as e:
             if progress_callback:
-                progress_callback(0, f"Error: {str(e)}", 0, 0)
+                try:
+                    progress_callback(0, f"Error: {str(e)}", 0, 0)
+                except IndexingCancelled:
+                    pass
             logger.error(f"Database indexing failed: {e}")
             return {
                 'status': 'error',
+                'database_id': database_id,
                 'message': str(e)
             }
         finally:
             if conn:
                 conn.close()
     
+    def _index_relationships(self, conn, database_id: int, data_loader_instance) -> Dict[str, int]:
+        """Kaynağın tanımlı PK/FK kısıtlarını al (destekliyorsa) ve join grafiğini kur"""
+        declared = {"primary_keys": [], "foreign_keys": []}
+        if hasattr(data_loader_instance, 'list_relationships'):
+            try:
+                declared = data_loader_instance.list_relationships()
+            except Exception as e:
+                logger.warning(f"Failed to list declared relationships: {e}")
+        return self._build_relationship_graph(conn, database_id, declared)
+
+    def _build_relationship_graph(self, conn, database_id: int, declared: Dict[str, List[Dict[str, Any]]]) -> Dict[str, int]:
+        """Tanımlı PK/FK'leri işaretle, olası join'leri tahmin et ve en kısa join yollarını kaydet"""
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT t.id, t.full_table_name, c.column_name, c.data_type
+            FROM indexed_tables t
+            LEFT JOIN indexed_columns c ON c.table_id = t.id
+            WHERE t.database_id = ?
+            ORDER BY t.id, c.id
+        ''', (database_id,))
+
+        tables = {}
+        for table_id, table_name, col_name, col_type in cursor.fetchall():
+            table = tables.setdefault(table_id, {'table_id': table_id, 'name': table_name, 'columns': []})
+            if col_name is not None:
+                table['columns'].append({'name': col_name, 'type': col_type, 'is_primary_key': False})
+        ids_by_name = {table['name']: table_id for table_id, table in tables.items()}
+
+        # Tanımlı primary key'ler
+        primary_keys = set()
+        for pk in declared.get('primary_keys', []):
+            table_id = ids_by_name.get(pk['table'])
+            if table_id is not None:
+                primary_keys.add((table_id, pk['column']))
+        for table_id, table in tables.items():
+            for col in table['columns']:
+                col['is_primary_key'] = (table_id, col['name']) in primary_keys
+
+        # Tanımlı foreign key'ler
+        relationships = []
+        for fk in declared.get('foreign_keys', []):
+            from_id, to_id = ids_by_name.get(fk['from_table']), ids_by_name.get(fk['to_table'])
+            if from_id is None or to_id is None:
+                continue
+            relationships.append({
+                'from_table_id': from_id, 'from_column': fk['from_column'],
+                'to_table_id': to_id, 'to_column': fk['to_column'],
+                'source': 'declared', 'confidence': 1.0
+            })
+
+        # İsim/tip eşleşmesinden tahmin edilen join'ler (tanımlı bir FK ile aynı olanlar hariç)
+        declared_edges = {(r['from_table_id'], r['from_column'], r['to_table_id'], r['to_column']) for r in relationships}
+        for rel in infer_relationships(list(tables.values())):
+            if (rel['from_table_id'], rel['from_column'], rel['to_table_id'], rel['to_column']) not in declared_edges:
+                relationships.append(rel)
+
+        cursor.execute('UPDATE indexed_columns SET is_primary_key = 0, is_foreign_key = 0 WHERE table_id IN (SELECT id FROM indexed_tables WHERE database_id = ?)', (database_id,))
+        cursor.executemany('UPDATE indexed_columns SET is_primary_key = 1 WHERE table_id = ? AND column_name = ?', list(primary_keys))
+        cursor.executemany('UPDATE indexed_columns SET is_foreign_key = 1 WHERE table_id = ? AND column_name = ?',
+                           [(r['from_table_id'], r['from_column']) for r in relationships if r['source'] == 'declared'])
+
+        cursor.execute('DELETE FROM indexed_relationships WHERE database_id = ?', (database_id,))
+        cursor.executemany('''
+            INSERT INTO indexed_relationships
+            (database_id, from_table_id, from_column, to_table_id, to_column, source, confidence)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(database_id, r['from_table_id'], r['from_column'], r['to_table_id'], r['to_column'],
+               r['source'], r['confidence']) for r in relationships])
+
+        paths = shortest_join_paths(list(tables.keys()), relationships)
+        cursor.execute('DELETE FROM indexed_join_paths WHERE database_id = ?', (database_id,))
+        cursor.executemany('''
+            INSERT INTO indexed_join_paths (database_id, from_table_id, to_table_id, hops, path)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(database_id, from_id, to_id, len(path), json.dumps(path)) for (from_id, to_id), path in paths.items()])
+
+        conn.commit()
+        logger.info(f"Join graph for database {database_id}: {len(primary_keys)} primary keys, "
+                    f"{len(relationships)} relationships, {len(paths)} join paths")
+        return {'primary_keys': len(primary_keys), 'relationships': len(relationships), 'join_paths': len(paths)}
+
+    def get_largest_tables(self, database_id: int, limit: int) -> List[Dict[str, Any]]:
+        """Satır sayısına göre en büyük limit tabloyu getir (retrieval tablo bulamadığında sınırlı yedek bağlam)"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, full_table_name FROM indexed_tables
+                WHERE database_id = ?
+                ORDER BY row_count DESC, id
+                LIMIT ?
+            ''', (database_id, limit))
+            return [{'table_id': table_id, 'name': name} for table_id, name in cursor.fetchall()]
+        finally:
+            if conn:
+                conn.close()
+
+    def get_join_paths(self, database_id: int, table_ids: List[int]) -> List[Dict[str, Any]]:
+        """Verilen tablolar arasındaki ön hesaplanmış join yollarını prompt'a uygun biçimde getir.
+
+        Ara tabloları da seçili kümede olan çok adımlı yollar tek adımlı yollardan türetilebildiği
+        için atlanır; yalnızca seçili olmayan bir köprü tablo üzerinden geçen yollar döner.
+        """
+        if not table_ids:
+            return []
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+
+            placeholders = ','.join(['?' for _ in table_ids])
+            cursor.execute(f'''
+                SELECT from_table_id, to_table_id, hops, path
+                FROM indexed_join_paths
+                WHERE database_id = ? AND from_table_id IN ({placeholders}) AND to_table_id IN ({placeholders})
+                ORDER BY hops, from_table_id, to_table_id
+            ''', [database_id, *table_ids, *table_ids])
+
+            selected = set(table_ids)
+            rows = []
+            for from_id, to_id, hops, path_json in cursor.fetchall():
+                path = json.loads(path_json)
+                bridges = {step['to_table_id'] for step in path[:-1]}
+                if hops > 1 and bridges <= selected:
+                    continue
+                rows.append((from_id, to_id, hops, path))
+
+            involved = {step[key] for *_, path in rows for step in path for key in ('from_table_id', 'to_table_id')}
+            table_names = {}
+            if involved:
+                placeholders = ','.join(['?' for _ in involved])
+                cursor.execute(f'SELECT id, full_table_name FROM indexed_tables WHERE id IN ({placeholders})', list(involved))
+                table_names = dict(cursor.fetchall())
+
+            return [{
+                'from_table': table_names.get(from_id),
+                'to_table': table_names.get(to_id),
+                'hops': hops,
+                'join': format_join_path(path, table_names)
+            } for from_id, to_id, hops, path in rows]
+        finally:
+            if conn:
+                conn.close()
+
     def _generate_table_description(self, ai_client, table_name: str, 
                                   columns: List[Dict], sample_rows: List[Dict]) -> tuple:
         """AI ile tablo açıklaması ve anahtar kelimeler üret"""
@@ -550,7 +825,7 @@ Format your response as JSON:
             {"role": "user", "content": prompt}
         ]
         
-        response = ai_client.get_completion(messages=messages)
+        response = ai_client.get_completion(messages=messages, agent="database_indexer")
         content = response.choices[0].message.content
         
         try:
@@ -589,7 +864,7 @@ Format your response as JSON:
             {"role": "user", "content": prompt}
         ]
         
-        response = ai_client.get_completion(messages=messages)
+        response = ai_client.get_completion(messages=messages, agent="database_indexer")
         content = response.choices[0].message.content
         
         try:
@@ -630,6 +905,19 @@ Format your response as JSON:
             if conn:
                 conn.close()
     
+    def get_index_version(self, database_id: int) -> Optional[int]:
+        """Veritabanı indeksinin sürümünü getir; indeks her yeniden yazıldığında artar"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT index_version FROM indexed_databases WHERE id = ?', (database_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+        finally:
+            if conn:
+                conn.close()
+    
     def get_database_schema(self, database_id: int) -> Dict[str, Any]:
         """Belirli bir veritabanının şemasını getir"""
         conn = None
@@ -777,7 +1065,17 @@ Format your response as JSON:
                 conn.close()
     
     def get_nlp_context(self, database_id: int, selected_tables: List[int] = None) -> Dict[str, Any]:
-        """NLP-to-SQL için context bilgilerini getir"""
+        """NLP-to-SQL için context bilgilerini getir.
+
+        Sonuç cache'ten paylaşıldığı için çağıran taraf dönen dict'i değiştirmemelidir.
+        """
+        return self._get_cached_context(
+            database_id, selected_tables, 'full',
+            lambda: self._build_nlp_context(database_id, selected_tables, compact=False)
+        )
+
+    def _build_nlp_context(self, database_id: int, selected_tables: Optional[List[int]], compact: bool) -> Dict[str, Any]:
+        """Tablo ve kolonları tek bir JOIN sorgusuyla çekip tablo bazında grupla"""
         conn = None
         try:
             conn = self._get_connection()
@@ -797,47 +1095,56 @@ Format your response as JSON:
                 placeholders = ','.join(['?' for _ in selected_tables])
                 table_filter = f" AND t.id IN ({placeholders})"
                 params.extend(selected_tables)
-            
-            # Get tables with detailed column information
+
+            # Full mod satır sayısına, compact mod tablo ismine göre sıralanır
+            table_order = "t.full_table_name" if compact else "t.row_count DESC"
+
             cursor.execute(f'''
-                SELECT t.id, t.full_table_name, t.business_description, t.row_count
+                SELECT t.id, t.full_table_name, t.business_description, t.row_count,
+                       c.column_name, c.data_type, c.sample_values, c.semantic_type, c.business_description
                 FROM indexed_tables t
+                LEFT JOIN indexed_columns c ON c.table_id = t.id
                 WHERE t.database_id = ? {table_filter}
-                ORDER BY t.row_count DESC
+                ORDER BY {table_order}, t.id, c.column_name
             ''', params)
-            
+
             tables = []
+            tables_by_id = {}
             for row in cursor.fetchall():
-                table_id, table_name, description, row_count = row
-                
-                # Get detailed columns for this table
-                cursor.execute('''
-                    SELECT column_name, data_type, sample_values, semantic_type, business_description
-                    FROM indexed_columns
-                    WHERE table_id = ?
-                    ORDER BY column_name
-                ''', (table_id,))
-                
-                columns = []
-                for col_row in cursor.fetchall():
-                    col_name, col_type, sample_values_json, semantic_type, col_description = col_row
+                table_id, table_name, description, row_count, col_name, col_type, sample_values_json, semantic_type, col_description = row
+
+                table = tables_by_id.get(table_id)
+                if table is None:
+                    table = {
+                        'table_id': table_id,
+                        'name': table_name,
+                        'description': description or '',
+                    }
+                    if not compact:
+                        table['row_count'] = row_count or 0
+                    table['columns'] = []
+                    tables_by_id[table_id] = table
+                    tables.append(table)
+
+                if col_name is None:
+                    continue
+
+                if compact:
+                    # Yalnızca isim, tip ve açıklama
+                    table['columns'].append({
+                        'name': col_name,
+                        'type': col_type,
+                        'description': col_description or ''
+                    })
+                else:
                     sample_values = json.loads(sample_values_json) if sample_values_json else []
-                    
-                    columns.append({
+                    table['columns'].append({
                         'name': col_name,
                         'type': col_type,
                         'semantic_type': semantic_type or '',
                         'description': col_description or '',
                         'sample_values': sample_values[:5]  # Limit to 5 sample values
                     })
-                
-                tables.append({
-                    'table_id': table_id,
-                    'name': table_name,
-                    'description': description or '',
-                    'row_count': row_count or 0,
-                    'columns': columns
-                })
             
             return {
                 'database_name': db_info[0],
@@ -848,6 +1155,45 @@ Format your response as JSON:
             if conn:
                 conn.close()
     
+    def get_retrieval_documents(self, database_id: int) -> List[Dict[str, Any]]:
+        """Tablo arama (retrieval) indeksi için tablo ve kolon metinlerini tek sorguda getir"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT t.id, t.full_table_name, t.business_description, t.keywords,
+                       c.column_name, c.business_description, c.semantic_type
+                FROM indexed_tables t
+                LEFT JOIN indexed_columns c ON c.table_id = t.id
+                WHERE t.database_id = ?
+                ORDER BY t.id, c.id
+            ''', (database_id,))
+
+            documents = {}
+            for row in cursor.fetchall():
+                table_id, table_name, description, keywords, col_name, col_desc, semantic_type = row
+                if table_id not in documents:
+                    documents[table_id] = {
+                        'table_id': table_id,
+                        'name': table_name,
+                        'description': description or '',
+                        'keywords': keywords or '',
+                        'columns': []
+                    }
+                if col_name is not None:
+                    documents[table_id]['columns'].append({
+                        'name': col_name,
+                        'description': col_desc or '',
+                        'semantic_type': semantic_type or ''
+                    })
+
+            return list(documents.values())
+        finally:
+            if conn:
+                conn.close()
+
     def delete_database_index(self, database_id: int) -> bool:
         """Veritabanı indeksini sil"""
         conn = None
@@ -856,9 +1202,10 @@ Format your response as JSON:
             cursor = conn.cursor()
             
             # Mark as deleted instead of actually deleting
-            cursor.execute('UPDATE indexed_databases SET status = ? WHERE id = ?', ('deleted', database_id))
+            cursor.execute('UPDATE indexed_databases SET status = ?, index_version = index_version + 1 WHERE id = ?', ('deleted', database_id))
             
             conn.commit()
+            self._invalidate_caches(database_id)
             return True
         except Exception as e:
             logger.error(f"Failed to delete database index: {e}")
@@ -905,66 +1252,7 @@ Format your response as JSON:
         örnek değerler vb. ağır alanlar dahil edilmez. Böylece çıktı token boyutu
         minimumda tutulur ve küçük modellerde halüsinasyon riski azalır.
         """
-        conn = None
-        try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-
-            # Veritabanı bilgisi
-            cursor.execute('SELECT connection_name, data_loader_type FROM indexed_databases WHERE id = ?', (database_id,))
-            db_info = cursor.fetchone()
-            if not db_info:
-                return {'error': 'Database not found'}
-
-            # Seçili tabloları filtrele
-            table_filter = ""
-            params = [database_id]
-            if selected_tables:
-                placeholders = ','.join(['?' for _ in selected_tables])
-                table_filter = f" AND t.id IN ({placeholders})"
-                params.extend(selected_tables)
-
-            # Tabloları al
-            cursor.execute(f'''
-                SELECT t.id, t.full_table_name, t.business_description
-                FROM indexed_tables t
-                WHERE t.database_id = ? {table_filter}
-                ORDER BY t.full_table_name
-            ''', params)
-
-            tables = []
-            for row in cursor.fetchall():
-                table_id, table_name, table_desc = row
-
-                # Kolonları al (yalnızca isim, tip ve açıklama)
-                cursor.execute('''
-                    SELECT column_name, data_type, business_description
-                    FROM indexed_columns
-                    WHERE table_id = ?
-                    ORDER BY column_name
-                ''', (table_id,))
-
-                columns = []
-                for col_row in cursor.fetchall():
-                    col_name, col_type, col_desc = col_row
-                    columns.append({
-                        'name': col_name,
-                        'type': col_type,
-                        'description': col_desc or ''
-                    })
-
-                tables.append({
-                    'table_id': table_id,
-                    'name': table_name,
-                    'description': table_desc or '',
-                    'columns': columns
-                })
-
-            return {
-                'database_name': db_info[0],
-                'data_loader_type': db_info[1],
-                'tables': tables
-            }
-        finally:
-            if conn:
-                conn.close()
\ No newline at end of file
+        return self._get_cached_context(
+            database_id, selected_tables, 'compact',
+            lambda: self._build_nlp_context(database_id, selected_tables, compact=True)
+        )
@@ -85,6 +85,12 @@ class ExternalDataLoader(ABC):
     def ingest_data(self, table_name: str, name_as: str = None, size: int = 1000000):
         pass
 
+    def list_relationships(self) -> Dict[str, List[Dict[str, Any]]]:
+        # declared constraints, table names must match the names returned by list_tables:
+        # {"primary_keys": [{table, column}], "foreign_keys": [{from_table, from_column, to_table, to_column}]}
+        # loaders without constraint metadata return nothing and rely on inferred joins
+        return {"primary_keys": [], "foreign_keys": []}
+
     @abstractmethod
     def view_query_sample(self, query: str) -> str:
         pass
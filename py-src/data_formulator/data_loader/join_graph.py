@@ -0,0 +1,154 @@
+import re
+from collections import defaultdict, deque
+from typing import Dict, Any, List, Tuple
+
+# Ön hesaplanan join yollarının en fazla kaç join (kenar) içereceği
+MAX_JOIN_HOPS = 3
+
+# Tablo isimlerindeki yaygın DW önekleri (DimCustomer -> Customer, fact_sales -> sales)
+TABLE_PREFIXES = ('dim', 'fact', 'tbl', 'vw')
+KEY_SUFFIXES = ('id', 'key', 'code', 'no')
+
+
+def type_family(data_type: str) -> str:
+    """Kolon tipini join uyumluluğu için kaba bir aileye indir"""
+    t = (data_type or '').lower()
+    if re.search(r'int|numeric|decimal|number|serial|bit', t):
+        return 'number'
+    if re.search(r'char|text|string|uuid|uniqueidentifier', t):
+        return 'string'
+    if re.search(r'date|time', t):
+        return 'datetime'
+    return ''
+
+
+def types_compatible(type_a: str, type_b: str) -> bool:
+    family_a, family_b = type_family(type_a), type_family(type_b)
+    return not family_a or not family_b or family_a == family_b
+
+
+def normalize_identifier(name: str) -> str:
+    return re.sub(r'[^a-z0-9]', '', (name or '').lower())
+
+
+def entity_names(table_name: str) -> List[str]:
+    """Tablo isminden kolon isimlerinde geçebilecek varlık adlarını çıkar (dbo.DimCustomers -> customers, customer)"""
+    base = normalize_identifier(table_name.split('.')[-1])
+    names = [base]
+    for prefix in TABLE_PREFIXES:
+        if base.startswith(prefix) and len(base) > len(prefix) + 1:
+            names.append(base[len(prefix):])
+    for name in list(names):
+        if name.endswith('ies'):
+            names.append(name[:-3] + 'y')
+        elif name.endswith('s') and not name.endswith('ss'):
+            names.append(name[:-1])
+    return list(dict.fromkeys(names))
+
+
+def infer_relationships(tables: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Kolon isim/tip eşleşmesinden olası join'leri tahmin et.
+
+    tables: [{'table_id', 'name', 'columns': [{'name', 'type', 'is_primary_key'}]}]
+    Bir tablonun anahtar kolonu (PK, 'id' veya '<tablo>id/key') başka bir tabloda aynı isimle
+    ('id' için '<tablo>id' / '<tablo>_id' olarak) ve uyumlu tiple geçiyorsa kenar eklenir.
+    """
+    # Her tablonun anahtar kolonlarını bul: (key_column, key_type, [kolon isimlerinde aranacak kalıplar])
+    keys = []
+    for table in tables:
+        entities = entity_names(table['name'])
+        candidates = {normalize_identifier(e + suffix) for e in entities for suffix in KEY_SUFFIXES}
+        for col in table.get('columns', []):
+            col_norm = normalize_identifier(col['name'])
+            if col.get('is_primary_key') or col_norm == 'id' or col_norm in candidates:
+                # Genel 'id' kolonu başka tablolarda '<tablo>id' olarak, diğer anahtarlar aynı isimle geçer
+                patterns = {normalize_identifier(e + 'id') for e in entities} if col_norm == 'id' else {col_norm}
+                keys.append((table, col, patterns))
+
+    relationships = []
+    seen = set()
+    for key_table, key_col, patterns in keys:
+        for table in tables:
+            if table['table_id'] == key_table['table_id']:
+                continue
+            for col in table.get('columns', []):
+                if normalize_identifier(col['name']) not in patterns:
+                    continue
+                if not types_compatible(col.get('type'), key_col.get('type')):
+                    continue
+                edge = (table['table_id'], col['name'], key_table['table_id'], key_col['name'])
+                if edge in seen:
+                    continue
+                seen.add(edge)
+                relationships.append({
+                    'from_table_id': table['table_id'],
+                    'from_column': col['name'],
+                    'to_table_id': key_table['table_id'],
+                    'to_column': key_col['name'],
+                    'source': 'inferred',
+                    'confidence': 0.8 if key_col.get('is_primary_key') else 0.6
+                })
+    return relationships
+
+
+def shortest_join_paths(table_ids: List[int], relationships: List[Dict[str, Any]],
+                        max_hops: int = MAX_JOIN_HOPS) -> Dict[Tuple[int, int], List[Dict[str, Any]]]:
+    """Her tablo çifti için (from_id < to_id) en kısa join yolunu BFS ile hesapla.
+
+    Kenarlar yönsüz kabul edilir; aynı tablo çifti arasında birden fazla kenar varsa en yüksek
+    confidence'lı olan kullanılır. Yol, adım listesi olarak döner: [{from_table_id, from_column, to_table_id, to_column}]
+    """
+    best_edges = {}
+    for rel in relationships:
+        pair = (rel['from_table_id'], rel['to_table_id'])
+        if pair[0] == pair[1]:
+            continue
+        key = tuple(sorted(pair))
+        if key not in best_edges or rel.get('confidence', 1.0) > best_edges[key].get('confidence', 1.0):
+            best_edges[key] = rel
+
+    adjacency = defaultdict(list)
+    for rel in best_edges.values():
+        forward = {'from_table_id': rel['from_table_id'], 'from_column': rel['from_column'],
+                   'to_table_id': rel['to_table_id'], 'to_column': rel['to_column']}
+        backward = {'from_table_id': rel['to_table_id'], 'from_column': rel['to_column'],
+                    'to_table_id': rel['from_table_id'], 'to_column': rel['from_column']}
+        adjacency[rel['from_table_id']].append(forward)
+        adjacency[rel['to_table_id']].append(backward)
+
+    paths = {}
+    for source in table_ids:
+        if source not in adjacency:
+            continue
+        previous = {source: None}
+        queue = deque([(source, 0)])
+        while queue:
+            node, depth = queue.popleft()
+            if depth == max_hops:
+                continue
+            for step in adjacency[node]:
+                target = step['to_table_id']
+                if target in previous:
+                    continue
+                previous[target] = step
+                queue.append((target, depth + 1))
+
+        for target, step in previous.items():
+            if step is None or target <= source:
+                continue
+            path = []
+            while step is not None:
+                path.append(step)
+                step = previous[step['from_table_id']]
+            paths[(source, target)] = list(reversed(path))
+    return paths
+
+
+def format_join_path(path: List[Dict[str, Any]], table_names: Dict[int, str]) -> str:
+    """Join yolunu prompt için 'A.x = B.y -> B.z = C.w' biçiminde yaz (schema prefix'i olmadan)"""
+    def short(table_id):
+        return table_names.get(table_id, str(table_id)).split('.')[-1]
+    return ' -> '.join(
+        f"{short(step['from_table_id'])}.{step['from_column']} = {short(step['to_table_id'])}.{step['to_column']}"
+        for step in path
+    )
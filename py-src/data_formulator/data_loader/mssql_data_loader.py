@@ -217,6 +217,50 @@ Microsoft SQL Server Connection Instructions:
             print(f"Error listing tables: {e}")
             return []
 
+    def list_relationships(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Read declared primary and foreign keys from the sys catalog views."""
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+
+            cursor.execute("""
+                SELECT s.name, t.name, c.name
+                FROM sys.indexes i
+                JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+                JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+                JOIN sys.tables t ON t.object_id = i.object_id
+                JOIN sys.schemas s ON s.schema_id = t.schema_id
+                WHERE i.is_primary_key = 1
+            """)
+            primary_keys = [{
+                'table': f"{schema}.{table}",
+                'column': column
+            } for schema, table, column in cursor.fetchall()]
+
+            cursor.execute("""
+                SELECT ps.name, pt.name, pc.name, rs.name, rt.name, rc.name
+                FROM sys.foreign_key_columns fkc
+                JOIN sys.tables pt ON pt.object_id = fkc.parent_object_id
+                JOIN sys.schemas ps ON ps.schema_id = pt.schema_id
+                JOIN sys.columns pc ON pc.object_id = fkc.parent_object_id AND pc.column_id = fkc.parent_column_id
+                JOIN sys.tables rt ON rt.object_id = fkc.referenced_object_id
+                JOIN sys.schemas rs ON rs.schema_id = rt.schema_id
+                JOIN sys.columns rc ON rc.object_id = fkc.referenced_object_id AND rc.column_id = fkc.referenced_column_id
+            """)
+            foreign_keys = [{
+                'from_table': f"{from_schema}.{from_table}",
+                'from_column': from_column,
+                'to_table': f"{to_schema}.{to_table}",
+                'to_column': to_column
+            } for from_schema, from_table, from_column, to_schema, to_table, to_column in cursor.fetchall()]
+
+            conn.close()
+            return {"primary_keys": primary_keys, "foreign_keys": foreign_keys}
+
+        except Exception as e:
+            print(f"Error listing relationships: {e}")
+            return {"primary_keys": [], "foreign_keys": []}
+
     def ingest_data(self, table_name: str, name_as: str = None, size: int = 1000000):
         # Create table in the main DuckDB database from SQL Server data
         if name_as is None:
@@ -105,6 +105,32 @@ MySQL Connection Instructions:
             
         return results
 
+    def list_relationships(self):
+        key_usage_df = self.duck_db_conn.execute(f"""
+            SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, CONSTRAINT_NAME,
+                   REFERENCED_TABLE_SCHEMA, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME
+            FROM mysqldb.information_schema.key_column_usage
+            WHERE table_schema NOT IN ('information_schema', 'mysql', 'performance_schema', 'sys')
+        """).fetch_df()
+
+        primary_keys = []
+        foreign_keys = []
+        for schema, table_name, column, constraint, ref_schema, ref_table, ref_column in key_usage_df.values:
+            if constraint == 'PRIMARY':
+                primary_keys.append({
+                    'table': f"mysqldb.{schema}.{table_name}",
+                    'column': column
+                })
+            elif ref_table:
+                foreign_keys.append({
+                    'from_table': f"mysqldb.{schema}.{table_name}",
+                    'from_column': column,
+                    'to_table': f"mysqldb.{ref_schema}.{ref_table}",
+                    'to_column': ref_column
+                })
+
+        return {"primary_keys": primary_keys, "foreign_keys": foreign_keys}
+
     def ingest_data(self, table_name: str, name_as: str | None = None, size: int = 1000000):
         # Create table in the main DuckDB database from MySQL data
         if name_as is None:
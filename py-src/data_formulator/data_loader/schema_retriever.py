@@ -0,0 +1,169 @@
+import math
+import re
+import threading
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Türkçe karakterleri ASCII karşılıklarına indirger (müşteri -> musteri, İl -> il)
+TURKISH_FOLD = str.maketrans({
+    'ç': 'c', 'Ç': 'c', 'ğ': 'g', 'Ğ': 'g', 'ı': 'i', 'I': 'i', 'İ': 'i',
+    'ö': 'o', 'Ö': 'o', 'ş': 's', 'Ş': 's', 'ü': 'u', 'Ü': 'u'
+})
+
+STOPWORDS = {
+    # english
+    'a', 'an', 'the', 'of', 'in', 'on', 'for', 'to', 'by', 'and', 'or', 'with', 'from',
+    'is', 'are', 'was', 'be', 'me', 'show', 'list', 'find', 'get', 'give', 'what', 'which',
+    'how', 'many', 'much', 'all', 'each', 'per', 'top', 'table', 'tables', 'data',
+    # turkish
+    've', 'ile', 'bir', 'bu', 'su', 'icin', 'gore', 'olan', 'en', 'cok', 'az', 'da', 'de',
+    'mi', 'ne', 'kac', 'goster', 'listele', 'bul', 'getir', 'tum', 'her'
+}
+
+# Alan ağırlıkları: tablo ismi eşleşmesi kolon açıklamasından daha değerlidir
+FIELD_WEIGHTS = {
+    'table_name': 3,
+    'keywords': 2,
+    'table_description': 1,
+    'column_name': 2,
+    'column_description': 1,
+    'semantic_type': 1,
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Split identifiers and free text into normalized search tokens.
+
+    camelCase / PascalCase / snake_case identifiers are split (DimCustomer -> dim, customer),
+    Turkish characters are folded and a naive plural 's' is stripped from longer tokens.
+    """
+    if not text:
+        return []
+    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', str(text))
+    text = re.sub(r'([A-Z]+)([A-Z][a-z])', r'\1 \2', text)
+    text = text.translate(TURKISH_FOLD).lower()
+
+    tokens = []
+    for token in re.split(r'[^a-z0-9]+', text):
+        if len(token) < 2 or token in STOPWORDS:
+            continue
+        if len(token) > 4 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class SchemaRetriever:
+    """
+    Schema Retriever - İndekslenmiş tablo ve kolonları doğal dil sorusuna göre BM25 ile puanlar.
+    Ağ üzerinden embedding servisine ihtiyaç duymaz; ters indeks bellekte tutulur ve sorgu süresi
+    yalnızca sorudaki terimlerin posting listelerine bağlıdır.
+    """
+
+    def __init__(self, documents: List[Dict[str, Any]], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.tables = {}
+        self.postings = defaultdict(list)   # term -> [(table_id, term_frequency)]
+        self.doc_lengths = {}
+        self.column_tokens = {}             # table_id -> [(column_name, set(tokens))]
+
+        for doc in documents:
+            table_id = doc['table_id']
+            self.tables[table_id] = doc.get('name', '')
+
+            weighted = Counter()
+            for field, text in (('table_name', doc.get('name', '').split('.')[-1]),
+                                ('keywords', doc.get('keywords', '')),
+                                ('table_description', doc.get('description', ''))):
+                for token in tokenize(text):
+                    weighted[token] += FIELD_WEIGHTS[field]
+
+            columns = []
+            for col in doc.get('columns', []):
+                name_tokens = tokenize(col.get('name', ''))
+                desc_tokens = tokenize(col.get('description', '')) + tokenize(col.get('semantic_type', ''))
+                for token in name_tokens:
+                    weighted[token] += FIELD_WEIGHTS['column_name']
+                for token in desc_tokens:
+                    weighted[token] += FIELD_WEIGHTS['column_description']
+                columns.append((col.get('name', ''), set(name_tokens) | set(desc_tokens)))
+            self.column_tokens[table_id] = columns
+
+            self.doc_lengths[table_id] = sum(weighted.values())
+            for term, tf in weighted.items():
+                self.postings[term].append((table_id, tf))
+
+        self.num_docs = len(self.tables)
+        self.avg_doc_length = (sum(self.doc_lengths.values()) / self.num_docs) if self.num_docs else 0.0
+
+    def _idf(self, term: str) -> float:
+        df = len(self.postings.get(term, []))
+        return math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, top_k: int = 15) -> List[Dict[str, Any]]:
+        """Soruya en alakalı top_k tabloyu skorlarıyla döndür"""
+        query_terms = set(tokenize(query))
+        if not query_terms or not self.num_docs:
+            return []
+
+        scores = defaultdict(float)
+        for term in query_terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self._idf(term)
+            for table_id, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[table_id] / self.avg_doc_length)
+                scores[table_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+        return [{
+            'table_id': table_id,
+            'name': self.tables[table_id],
+            'score': round(score, 4),
+            'matched_columns': self.match_columns(table_id, query_terms)
+        } for table_id, score in ranked]
+
+    def match_columns(self, table_id: int, query_terms) -> List[str]:
+        """Soru terimleriyle örtüşen kolon isimlerini örtüşme sayısına göre sıralı döndür"""
+        if isinstance(query_terms, str):
+            query_terms = set(tokenize(query_terms))
+        matches = []
+        for col_name, tokens in self.column_tokens.get(table_id, []):
+            overlap = len(tokens & query_terms)
+            if overlap:
+                matches.append((overlap, col_name))
+        return [name for _, name in sorted(matches, key=lambda m: -m[0])]
+
+
+_retriever_cache: Dict[Tuple[str, int], SchemaRetriever] = {}
+_retriever_lock = threading.Lock()
+
+
+def get_schema_retriever(database_indexer, database_id: int) -> SchemaRetriever:
+    """Veritabanı için BM25 indeksini bir kez kur, sonraki isteklerde bellekten kullan"""
+    key = (database_indexer.index_db_path, database_id)
+    with _retriever_lock:
+        retriever = _retriever_cache.get(key)
+    if retriever is not None:
+        return retriever
+
+    documents = database_indexer.get_retrieval_documents(database_id)
+    retriever = SchemaRetriever(documents)
+    logger.info(f"Built schema retriever for database {database_id}: {retriever.num_docs} tables, {len(retriever.postings)} terms")
+
+    with _retriever_lock:
+        _retriever_cache[key] = retriever
+    return retriever
+
+
+def invalidate_schema_retriever(index_db_path: str, database_id: int = None):
+    """İndeks yazıldığında bellekteki retriever'ı düşür"""
+    with _retriever_lock:
+        for key in list(_retriever_cache.keys()):
+            if key[0] == index_db_path and (database_id is None or key[1] == database_id):
+                del _retriever_cache[key]
@@ -6,6 +6,19 @@ import os
 from contextlib import contextmanager
 from dotenv import load_dotenv
 
+try:
+    import pyarrow
+except ImportError:  # without pyarrow, query results are loaded through duckdb's own dataframe conversion
+    pyarrow = None
+
+
+def fetch_frame(conn, query):
+    """Run a query on a DuckDB connection and load its result as a pandas dataframe (through Arrow if available)"""
+    result = conn.execute(query)
+    # .arrow() is a table in older duckdb versions and a record batch reader in newer ones
+    return pyarrow.table(result.arrow()).to_pandas() if pyarrow is not None else result.fetch_df()
+
+
 class DuckDBManager:
     def __init__(self, local_db_dir: str):
         # Store session db file paths
@@ -23,6 +36,12 @@ class DuckDBManager:
             if conn:
                 conn.close()
     
+    def get_db_file(self, session_id: str) -> str:
+        """Get the db file path of a session (its database is created on first connection)"""
+        if session_id not in self._db_files or self._db_files[session_id] is None:
+            self.get_connection(session_id).close()
+        return self._db_files[session_id]
+
     def get_connection(self, session_id: str) -> duckdb.DuckDBPyConnection:
         """Internal method to get or create a DuckDB connection for a session"""
         # Get or create the db file path for this session
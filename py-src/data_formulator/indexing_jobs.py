@@ -0,0 +1,224 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Callable
+
+from data_formulator.data_loader.database_indexer import IndexingCancelled
+from data_formulator.agents.llm_admission import llm_priority, BATCH
+
+logger = logging.getLogger(__name__)
+
+# İşin bitmiş sayıldığı durumlar; bunlardan sonra progress yazılmaz
+FINISHED_STATUSES = ('completed', 'error', 'cancelled', 'interrupted')
+
+# progress_callback çok sık çağrılır (kolon başına), SQLite'a en fazla bu aralıkla yazılır
+PROGRESS_WRITE_INTERVAL = 0.5
+
+
+class IndexingJobManager:
+    """
+    Indexing Job Manager - Veritabanı indeksleme işlerini request thread'i dışında bir worker pool'da çalıştırır.
+    İlerleme, ETA ve throughput bilgisi SQLite'ta tutulur; böylece farklı request'ler (ve nginx arkasındaki
+    polling istekleri) işin anlık durumunu görebilir. İşler iptal edilebilir ve kaldığı yerden devam ettirilebilir.
+    """
+
+    def __init__(self, runner: Callable, store_path: str = "flask_session/indexing_jobs.db", max_workers: int = 2):
+        """
+        runner(params, progress_callback, resume_database_id, on_database_created) -> result dict
+        """
+        self.runner = runner
+        self.store_path = store_path
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="indexing-job")
+        self._cancel_requested = set()
+        self._lock = threading.Lock()
+        self._init_store()
+
+    def _get_connection(self):
+        conn = sqlite3.connect(self.store_path, timeout=30.0)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_store(self):
+        os.makedirs(os.path.dirname(self.store_path) or ".", exist_ok=True)
+        conn = self._get_connection()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS indexing_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    progress REAL DEFAULT 0,
+                    message TEXT,
+                    total_tables INTEGER DEFAULT 0,
+                    processed_tables INTEGER DEFAULT 0,
+                    tables_per_second REAL,
+                    eta_seconds REAL,
+                    database_id INTEGER,
+                    params TEXT NOT NULL,
+                    result TEXT,
+                    created_at REAL,
+                    started_at REAL,
+                    updated_at REAL,
+                    finished_at REAL
+                )
+            ''')
+            # Süreç yeniden başladıysa yarım kalan işler artık çalışmıyor; resume edilebilir olarak işaretle
+            conn.execute('''
+                UPDATE indexing_jobs SET status = 'interrupted', message = 'Server restarted while indexing', finished_at = ?
+                WHERE status IN ('queued', 'in_progress')
+            ''', (time.time(),))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _update(self, job_id: str, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        conn = self._get_connection()
+        try:
+            conn.execute(f'UPDATE indexing_jobs SET {assignments} WHERE job_id = ?', (*fields.values(), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _row_to_dict(row) -> Dict[str, Any]:
+        job = dict(row)
+        job.pop('params', None)  # bağlantı bilgileri (şifreler) dışarı verilmez
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def submit(self, params: Dict[str, Any]) -> str:
+        """Yeni bir indeksleme işi oluştur ve kuyruğa al, job_id'yi hemen döndür"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._get_connection()
+        try:
+            conn.execute('''
+                INSERT INTO indexing_jobs (job_id, status, progress, message, params, created_at, updated_at)
+                VALUES (?, 'queued', 0, 'Waiting for an indexing worker...', ?, ?, ?)
+            ''', (job_id, json.dumps(params), now, now))
+            conn.commit()
+        finally:
+            conn.close()
+
+        self._executor.submit(self._run, job_id, params, None)
+        return job_id
+
+    def resume(self, job_id: str) -> bool:
+        """İptal edilmiş, hata almış veya yarım kalmış bir işi kaldığı tablodan devam ettir"""
+        conn = self._get_connection()
+        try:
+            row = conn.execute('SELECT status, params, database_id FROM indexing_jobs WHERE job_id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+
+        if row is None or row['status'] not in ('cancelled', 'error', 'interrupted'):
+            return False
+
+        with self._lock:
+            self._cancel_requested.discard(job_id)
+        self._update(job_id, status='queued', message='Waiting for an indexing worker to resume...', result=None, finished_at=None)
+        self._executor.submit(self._run, job_id, json.loads(row['params']), row['database_id'])
+        return True
+
+    def cancel(self, job_id: str) -> bool:
+        """İşi iptal et; çalışan iş bir sonraki progress güncellemesinde durur"""
+        job = self.get(job_id)
+        if job is None or job['status'] in FINISHED_STATUSES:
+            return False
+        with self._lock:
+            self._cancel_requested.add(job_id)
+        if job['status'] == 'queued':
+            self._update(job_id, status='cancelled', message='Indexing cancelled', finished_at=time.time())
+        return True
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._get_connection()
+        try:
+            row = conn.execute('SELECT * FROM indexing_jobs WHERE job_id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return self._row_to_dict(row) if row else None
+
+    def list_jobs(self, limit: int = 20) -> List[Dict[str, Any]]:
+        conn = self._get_connection()
+        try:
+            rows = conn.execute('SELECT * FROM indexing_jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+        finally:
+            conn.close()
+        return [self._row_to_dict(row) for row in rows]
+
+    def _run(self, job_id: str, params: Dict[str, Any], resume_database_id: Optional[int]):
+        with self._lock:
+            if job_id in self._cancel_requested:
+                return
+
+        started_at = time.time()
+        self._update(job_id, status='in_progress', message='Connecting to database...', started_at=started_at)
+
+        # Resume durumunda throughput yalnızca bu çalışmada işlenen tablolardan hesaplanır
+        state = {'first_processed': None, 'last_write': 0.0}
+
+        def progress_callback(progress, message, total_tables, processed_tables):
+            with self._lock:
+                if job_id in self._cancel_requested:
+                    raise IndexingCancelled()
+
+            now = time.time()
+            if now - state['last_write'] < PROGRESS_WRITE_INTERVAL and progress < 100:
+                return
+            state['last_write'] = now
+
+            if state['first_processed'] is None and processed_tables:
+                state['first_processed'] = (processed_tables, now)
+
+            tables_per_second = None
+            eta_seconds = None
+            if state['first_processed'] is not None:
+                first_count, first_time = state['first_processed']
+                elapsed = now - first_time
+                done = processed_tables - first_count
+                if elapsed > 0 and done > 0:
+                    tables_per_second = done / elapsed
+                    eta_seconds = max(total_tables - processed_tables, 0) / tables_per_second
+
+            self._update(job_id, progress=round(progress, 1), message=message,
+                         total_tables=total_tables, processed_tables=processed_tables,
+                         tables_per_second=tables_per_second, eta_seconds=eta_seconds)
+            logger.info(f"[job {job_id}] {progress:.1f}% - {message} ({processed_tables}/{total_tables})")
+
+        try:
+            # İndeksleme toplu (batch) iş: LLM çağrıları interaktif isteklerin arkasında sıraya girer
+            with llm_priority(BATCH, user=f"indexing:{job_id}"):
+                result = self.runner(
+                    params,
+                    progress_callback=progress_callback,
+                    resume_database_id=resume_database_id,
+                    on_database_created=lambda database_id: self._update(job_id, database_id=database_id)
+                )
+        except Exception as e:
+            logger.error(f"[job {job_id}] indexing failed: {e}")
+            result = {'status': 'error', 'message': str(e)}
+
+        status = {'success': 'completed', 'cancelled': 'cancelled'}.get(result.get('status'), 'error')
+        message = {
+            'completed': 'Database indexing completed successfully!',
+            'cancelled': 'Indexing cancelled',
+        }.get(status, f"Error: {result.get('message', 'unknown error')}")
+
+        fields = {'status': status, 'message': message, 'result': json.dumps(result), 'finished_at': time.time(), 'eta_seconds': 0 if status == 'completed' else None}
+        if status == 'completed':
+            fields.update(progress=100, processed_tables=result.get('indexed_tables', 0), total_tables=result.get('indexed_tables', 0))
+        if result.get('database_id') is not None:
+            fields['database_id'] = result['database_id']
+        self._update(job_id, **fields)
+
+        with self._lock:
+            self._cancel_requested.discard(job_id)
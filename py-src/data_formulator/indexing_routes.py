@@ -1,10 +1,12 @@
 import json
 import logging
 import os
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify
 from data_formulator.data_loader.database_indexer import DatabaseIndexer
-from data_formulator.agents.agent_nlp_sql_converter import EnhancedNLPSQLConverter
-from data_formulator.agent_routes import get_client
+from data_formulator.indexing_jobs import IndexingJobManager
+from data_formulator.nlp_query_cache import NLPQueryCache, DEFAULT_TTL_SECONDS
+from data_formulator.agents.agent_nlp_sql_converter import EnhancedNLPSQLConverter, DEFAULT_MAX_TABLES, clamp_max_tables
+from data_formulator.agent_routes import get_client, stream_agent_events, admission_controlled
 from data_formulator.data_loader.mssql_data_loader import MSSQLDataLoader
 from data_formulator.data_loader.mysql_data_loader import MySQLDataLoader
 from data_formulator.data_loader.kusto_data_loader import KustoDataLoader
@@ -60,9 +62,52 @@ def _normalize_model_config(model: Union[str, Dict[str, str]]) -> Dict[str, str]
     else:
         raise ValueError("Invalid model parameter type")
 
+def _run_indexing_job(params, progress_callback=None, resume_database_id=None, on_database_created=None):
+    """Worker thread'inde tek bir indeksleme işini çalıştır (IndexingJobManager runner'ı)"""
+    data_loader_type = params['data_loader_type']
+    
+    # Initialize database indexer - use 'default' for persistent indexing
+    indexer = DatabaseIndexer('default')
+    
+    # Get data loader class and create instance
+    data_loader_class = get_data_loader_class(data_loader_type)
+    
+    # Create data loader instance
+    # Note: We need a dummy DuckDB connection for the data loader
+    import duckdb
+    dummy_conn = duckdb.connect(':memory:')
+    try:
+        data_loader_instance = data_loader_class(params['connection_params'], dummy_conn)
+        
+        # Get AI client if descriptions are requested
+        ai_client = None
+        if params.get('use_ai_descriptions'):
+            try:
+                ai_client = get_client(_normalize_model_config(params['model']))
+            except Exception as e:
+                logger.warning(f"Failed to initialize AI client: {e}")
+        
+        return indexer.index_database_with_progress(
+            data_loader_type=data_loader_type,
+            connection_name=params['connection_name'],
+            connection_params=params['connection_params'],
+            data_loader_instance=data_loader_instance,
+            ai_client=ai_client,
+            progress_callback=progress_callback,
+            compact=params.get('compact', False),
+            resume_database_id=resume_database_id,
+            on_database_created=on_database_created
+        )
+    finally:
+        dummy_conn.close()
+
+indexing_job_manager = IndexingJobManager(_run_indexing_job, max_workers=int(os.getenv('INDEXING_MAX_WORKERS', '2')))
+
+nlp_query_cache = NLPQueryCache(ttl_seconds=int(os.getenv('NLP_QUERY_CACHE_TTL', str(DEFAULT_TTL_SECONDS))))
+
 @indexing_bp.route('/index-database', methods=['POST'])
 def index_database():
-    """Veritabanını indeksle"""
+    """Veritabanı indeksleme işini başlat, job_id'yi hemen döndür"""
     try:
         if not request.is_json:
             return jsonify({'status': 'error', 'message': 'Invalid request format'}), 400
@@ -72,10 +117,6 @@ def index_database():
         # Required parameters
         data_loader_type = content.get('data_loader_type')
         connection_name = content.get('connection_name')
-        connection_params = content.get('connection_params', {})
-        use_ai_descriptions = content.get('use_ai_descriptions', False)
-        compact_index = content.get('compact', False)
-        model = content.get('model', 'gpt-3.5-turbo')
         
         if not data_loader_type or not connection_name:
             return jsonify({
@@ -83,114 +124,51 @@ def index_database():
                 'message': 'data_loader_type and connection_name are required'
             }), 400
         
-        # Initialize database indexer - use 'default' for persistent indexing
-        session_id = 'default'  # Use fixed session for database indexing
-        indexer = DatabaseIndexer(session_id)
-        
-        # Get data loader class and create instance
-        data_loader_class = get_data_loader_class(data_loader_type)
-        if not data_loader_class:
+        if not get_data_loader_class(data_loader_type):
             return jsonify({
                 'status': 'error',
                 'message': f'Unsupported data loader type: {data_loader_type}'
             }), 400
         
-        # Create data loader instance
-        # Note: We need a dummy DuckDB connection for the data loader
-        import duckdb
-        dummy_conn = duckdb.connect(':memory:')
-        data_loader_instance = data_loader_class(connection_params, dummy_conn)
-        
-        # Get AI client if descriptions are requested
-        ai_client = None
-        if use_ai_descriptions:
-            try:
-                ai_client = get_client(_normalize_model_config(model))
-            except Exception as e:
-                logger.warning(f"Failed to initialize AI client: {e}")
-        
-        # Progress tracking için session'a kaydet
-        progress_key = f"indexing_progress_{session_id}"
-        session[progress_key] = {
-            'status': 'starting',
-            'progress': 0,
-            'message': 'Initializing database indexing...',
-            'total_tables': 0,
-            'processed_tables': 0
-        }
-        
-        # Perform indexing with progress tracking
-        result = indexer.index_database_with_progress(
-            data_loader_type=data_loader_type,
-            connection_name=connection_name,
-            connection_params=connection_params,
-            data_loader_instance=data_loader_instance,
-            ai_client=ai_client,
-            progress_callback=lambda progress, message, total, processed: update_progress(
-                progress_key, progress, message, total, processed
-            ),
-            compact=compact_index
-        )
-        
-        # Final progress update
-        session[progress_key] = {
-            'status': 'completed',
-            'progress': 100,
-            'message': 'Database indexing completed successfully!',
-            'total_tables': result.get('indexed_tables', 0),
-            'processed_tables': result.get('indexed_tables', 0)
-        }
-        
-        dummy_conn.close()
+        job_id = indexing_job_manager.submit({
+            'data_loader_type': data_loader_type,
+            'connection_name': connection_name,
+            'connection_params': content.get('connection_params', {}),
+            'use_ai_descriptions': content.get('use_ai_descriptions', False),
+            'compact': content.get('compact', False),
+            'model': content.get('model', 'gpt-3.5-turbo')
+        })
         
-        return jsonify(result)
+        return jsonify({
+            'status': 'accepted',
+            'job_id': job_id
+        }), 202
         
     except Exception as e:
-        logger.error(f"Database indexing failed: {e}")
-        
-        # Error progress update
-        progress_key = f"indexing_progress_{session.get('session_id', 'default')}"
-        session[progress_key] = {
-            'status': 'error',
-            'progress': 0,
-            'message': f'Error: {str(e)}',
-            'total_tables': 0,
-            'processed_tables': 0
-        }
-        
+        logger.error(f"Failed to start database indexing: {e}")
         return jsonify({
             'status': 'error',
             'message': str(e)
         }), 500
 
-def update_progress(progress_key, progress, message, total_tables, processed_tables):
-    """Progress callback function"""
-    # Always update progress to ensure real-time feedback
-    session[progress_key] = {
-        'status': 'in_progress',
-        'progress': round(progress, 1),  # Round to 1 decimal place
-        'message': message,
-        'total_tables': total_tables,
-        'processed_tables': processed_tables
-    }
-    
-    # Log progress for debugging
-    logger.info(f"Progress update: {progress:.1f}% - {message} ({processed_tables}/{total_tables})")
-
 @indexing_bp.route('/indexing-progress', methods=['GET'])
 def get_indexing_progress():
-    """İndeksleme ilerlemesini getir"""
+    """İndeksleme ilerlemesini getir (job_id verilmezse en son iş)"""
     try:
-        session_id = session.get('session_id', 'default')
-        progress_key = f"indexing_progress_{session_id}"
+        job_id = request.args.get('job_id')
+        if job_id:
+            job = indexing_job_manager.get(job_id)
+        else:
+            jobs = indexing_job_manager.list_jobs(limit=1)
+            job = jobs[0] if jobs else None
         
-        progress_data = session.get(progress_key, {
+        progress_data = job or {
             'status': 'idle',
             'progress': 0,
             'message': 'No indexing in progress',
             'total_tables': 0,
             'processed_tables': 0
-        })
+        }
         
         return jsonify({
             'status': 'success',
@@ -204,6 +182,36 @@ def get_indexing_progress():
             'message': str(e)
         }), 500
 
+@indexing_bp.route('/indexing-jobs', methods=['GET'])
+def list_indexing_jobs():
+    """Son indeksleme işlerini listele"""
+    try:
+        limit = request.args.get('limit', 20, type=int)
+        return jsonify({
+            'status': 'success',
+            'jobs': indexing_job_manager.list_jobs(limit)
+        })
+    except Exception as e:
+        logger.error(f"Failed to list indexing jobs: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@indexing_bp.route('/indexing-jobs/<job_id>/cancel', methods=['POST'])
+def cancel_indexing_job(job_id):
+    """Çalışan veya kuyruktaki indeksleme işini iptal et"""
+    if indexing_job_manager.cancel(job_id):
+        return jsonify({'status': 'success', 'message': 'Cancellation requested'})
+    return jsonify({'status': 'error', 'message': 'Job not found or already finished'}), 404
+
+@indexing_bp.route('/indexing-jobs/<job_id>/resume', methods=['POST'])
+def resume_indexing_job(job_id):
+    """İptal edilmiş veya yarım kalmış indeksleme işini kaldığı yerden devam ettir"""
+    if indexing_job_manager.resume(job_id):
+        return jsonify({'status': 'accepted', 'job_id': job_id}), 202
+    return jsonify({'status': 'error', 'message': 'Job not found or not resumable'}), 404
+
 @indexing_bp.route('/list-indexed-databases', methods=['GET'])
 def list_indexed_databases():
     """İndekslenmiş veritabanlarını listele"""
@@ -281,6 +289,7 @@ def search_tables(database_id):
         }), 500
 
 @indexing_bp.route('/enhanced-nlp-to-sql', methods=['POST'])
+@admission_controlled()
 def enhanced_nlp_to_sql():
     """Enhanced NLP to SQL conversion"""
     try:
@@ -298,6 +307,8 @@ def enhanced_nlp_to_sql():
         selected_tables = content.get('selected_tables', [])
         context_hints = content.get('context_hints', {})
         context_mode = content.get('context_mode', 'full')
+        max_tables = clamp_max_tables(content.get('max_tables', DEFAULT_MAX_TABLES))
+        use_cache = content.get('use_cache', True)
         
         if not database_id or not natural_query:
             return jsonify({
@@ -328,8 +339,23 @@ def enhanced_nlp_to_sql():
             logger.error(f"Traceback: {traceback.format_exc()}")
             raise e
         
+        # Aynı soru aynı indeks sürümünde daha önce cevaplandıysa LLM'e gitme
+        index_version = indexer.get_index_version(database_id)
+        cache_key = nlp_query_cache.make_key(
+            'nlp_to_sql', natural_query, model_config['model'],
+            database_id=database_id,
+            selected_tables=selected_tables,
+            index_version=index_version,
+            options={'context_mode': context_mode, 'max_tables': max_tables, 'context_hints': context_hints}
+        )
+        if use_cache:
+            cached_result = nlp_query_cache.get(cache_key)
+            if cached_result is not None:
+                logger.info(f"NLP-to-SQL cache hit: db_id={database_id}, query='{natural_query}'")
+                return jsonify({**cached_result, 'cached': True})
+        
         try:
-            converter = EnhancedNLPSQLConverter(ai_client, indexer)
+            converter = EnhancedNLPSQLConverter(ai_client, indexer, max_tables=max_tables)
             logger.info("EnhancedNLPSQLConverter initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize EnhancedNLPSQLConverter: {e}")
@@ -349,6 +375,9 @@ def enhanced_nlp_to_sql():
                 context_mode=context_mode
             )
             logger.info("NLP-to-SQL conversion completed successfully")
+            if result.get('status') == 'success':
+                nlp_query_cache.put(cache_key, result, 'nlp_to_sql', natural_query, model_config['model'],
+                                    database_id=database_id, index_version=index_version)
         except Exception as e:
             logger.error(f"Failed during convert_query: {e}")
             import traceback
@@ -364,7 +393,64 @@ def enhanced_nlp_to_sql():
             'message': str(e)
         }), 500
 
+@indexing_bp.route('/enhanced-nlp-to-sql-stream', methods=['POST'])
+@admission_controlled()
+def enhanced_nlp_to_sql_stream():
+    """Enhanced NLP to SQL - SQL token'larını geldikçe NDJSON olarak gönderen streaming varyant"""
+    if not request.is_json:
+        return jsonify({'status': 'error', 'message': 'Invalid request format'}), 400
+    
+    content = request.get_json()
+    database_id = content.get('database_id')
+    natural_query = content.get('natural_query')
+    selected_tables = content.get('selected_tables', [])
+    context_hints = content.get('context_hints', {})
+    context_mode = content.get('context_mode', 'full')
+    max_tables = clamp_max_tables(content.get('max_tables', DEFAULT_MAX_TABLES))
+    
+    if not database_id or not natural_query:
+        return jsonify({
+            'status': 'error',
+            'message': 'database_id and natural_query are required'
+        }), 400
+    
+    indexer = DatabaseIndexer('default')
+    model_config = _normalize_model_config(content.get('model', 'gpt-4'))
+    ai_client = get_client(model_config)
+    
+    index_version = indexer.get_index_version(database_id)
+    cache_key = nlp_query_cache.make_key(
+        'nlp_to_sql', natural_query, model_config['model'],
+        database_id=database_id,
+        selected_tables=selected_tables,
+        index_version=index_version,
+        options={'context_mode': context_mode, 'max_tables': max_tables, 'context_hints': context_hints}
+    )
+    
+    def run(wrap_client, emit):
+        if content.get('use_cache', True):
+            cached_result = nlp_query_cache.get(cache_key)
+            if cached_result is not None:
+                return {**cached_result, 'cached': True}
+        
+        converter = EnhancedNLPSQLConverter(wrap_client(ai_client), indexer, max_tables=max_tables)
+        result = converter.convert_query(
+            database_id=database_id,
+            natural_query=natural_query,
+            selected_tables=selected_tables if selected_tables else None,
+            context_hints=context_hints if context_hints else None,
+            model=model_config["model"],
+            context_mode=context_mode
+        )
+        if result.get('status') == 'success':
+            nlp_query_cache.put(cache_key, result, 'nlp_to_sql', natural_query, model_config['model'],
+                                database_id=database_id, index_version=index_version)
+        return result
+    
+    return stream_agent_events(run, lambda result: result)
+
 @indexing_bp.route('/explain-sql', methods=['POST'])
+@admission_controlled()
 def explain_sql():
     """SQL sorgusunu açıkla"""
     try:
@@ -406,6 +492,7 @@ def explain_sql():
         }), 500
 
 @indexing_bp.route('/suggest-sql-improvements', methods=['POST'])
+@admission_controlled()
 def suggest_sql_improvements():
     """SQL iyileştirme önerileri"""
     try:
@@ -453,6 +540,7 @@ def delete_database_index(database_id):
         success = indexer.delete_database_index(database_id)
         
         if success:
+            nlp_query_cache.invalidate(database_id)
             return jsonify({
                 'status': 'success',
                 'message': 'Database index deleted successfully'
@@ -568,6 +656,7 @@ def get_compact_nlp_context(database_id):
         }), 500
 
 @indexing_bp.route('/translate-query', methods=['POST'])
+@admission_controlled()
 def translate_query():
     """Translate Turkish text to English using LLM for data analysis queries"""
     try:
@@ -601,13 +690,19 @@ def translate_query():
                 'message': f'Failed to initialize AI client: {str(e)}'
             }), 500
         
+        cache_key = nlp_query_cache.make_key('translate', query, model_config['model'])
+        if content.get('use_cache', True):
+            cached_result = nlp_query_cache.get(cache_key)
+            if cached_result is not None:
+                return jsonify({**cached_result, 'original_text': original_text, 'cached': True})
+        
         try:
             # Get translation from LLM with a very strict prompt
             messages = [
                 {"role": "user", "content": f"Turkish: {query}\nEnglish:"}
             ]
             
-            response = ai_client.get_completion(messages=messages)
+            response = ai_client.get_completion(messages=messages, agent="query_translation")
             full_response = response.choices[0].message.content.strip()
             
             # Extract clean English translation from LLM response
@@ -683,12 +778,14 @@ def translate_query():
             
             logger.info(f"Translation completed: '{original_text}' -> '{translated_text}'")
             
-            return jsonify({
+            result = {
                 'status': 'success',
                 'translated_text': translated_text,
                 'original_text': original_text,
                 'confidence': 0.9  # High confidence for LLM translations
-            })
+            }
+            nlp_query_cache.put(cache_key, result, 'translate', query, model_config['model'])
+            return jsonify(result)
             
         except Exception as e:
             logger.error(f"Translation failed: {e}")
@@ -702,4 +799,36 @@ def translate_query():
         return jsonify({
             'status': 'error',
             'message': str(e)
-        }), 500
\ No newline at end of file
+        }), 500
+
+@indexing_bp.route('/nlp-cache-stats', methods=['GET'])
+def get_nlp_cache_stats():
+    """NLP-to-SQL / çeviri cache'inin hit/miss istatistiklerini getir"""
+    try:
+        return jsonify({
+            'status': 'success',
+            'stats': nlp_query_cache.stats()
+        })
+    except Exception as e:
+        logger.error(f"Failed to get NLP cache stats: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@indexing_bp.route('/nlp-cache/clear', methods=['POST'])
+def clear_nlp_cache():
+    """NLP-to-SQL cache'ini temizle (database_id verilirse yalnızca o veritabanı için)"""
+    try:
+        content = request.get_json(silent=True) or {}
+        removed = nlp_query_cache.invalidate(content.get('database_id'))
+        return jsonify({
+            'status': 'success',
+            'removed_entries': removed
+        })
+    except Exception as e:
+        logger.error(f"Failed to clear NLP cache: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
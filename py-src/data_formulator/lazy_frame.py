@@ -0,0 +1,830 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import atexit
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import namedtuple, OrderedDict
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# tables with at least this many rows are handed to python transforms as LazyFrames (when a request opts in)
+LAZY_FRAME_MIN_ROWS = int(os.getenv("LAZY_FRAME_MIN_ROWS", "1000000"))
+# rows of a lazy table loaded as a regular dataframe for the data summary shown to the model
+LAZY_FRAME_SAMPLE_ROWS = int(os.getenv("LAZY_FRAME_SAMPLE_ROWS", "10000"))
+# at most this many rows of a lazy transform result are materialized (like the SQL agents' output limit);
+# a longer result is cut and reported as truncated
+LAZY_FRAME_MAX_RESULT_ROWS = int(os.getenv("LAZY_FRAME_MAX_RESULT_ROWS", "100000"))
+
+# lazy tables are read from snapshot databases, never from the live session database: the sandbox opens them
+# read-only and disables file / network access before the transform runs (see open_snapshots).
+# A snapshot is reused by the requests on the same table until the session database changes; at most this many
+# snapshots no request uses are kept
+LAZY_SNAPSHOT_CACHE_SIZE = int(os.getenv("LAZY_SNAPSHOT_CACHE_SIZE", "8"))
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _literal(value):
+    """SQL for a python value"""
+    if isinstance(value, LazyColumn):
+        raise TypeError("lazy columns cannot be used inside lists or as values of other columns' functions")
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return "NULL"
+    if isinstance(value, (bool, np.bool_)):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)):
+        value = float(value)
+        return f"'{value}'::DOUBLE" if np.isinf(value) else repr(value)
+    if isinstance(value, (pd.Timestamp, datetime.datetime)):
+        return f"TIMESTAMP '{pd.Timestamp(value).isoformat(sep=' ')}'"
+    if isinstance(value, datetime.date):
+        return f"DATE '{value.isoformat()}'"
+    if isinstance(value, (list, tuple, set, np.ndarray, pd.Series)):
+        return "(" + ", ".join(_literal(v) for v in value) + ")"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+# pandas aggregation names -> duckdb aggregate functions
+AGGREGATES = {
+    "sum": "sum", "mean": "avg", "average": "avg", "min": "min", "max": "max", "count": "count",
+    "size": "count", "nunique": "count_distinct", "median": "median", "std": "stddev_samp", "var": "var_samp",
+    "first": "first", "last": "last", "prod": "product",
+}
+
+# pandas dtype names -> duckdb types, for astype
+CAST_TYPES = {
+    "int": "BIGINT", "int64": "BIGINT", "int32": "INTEGER", "float": "DOUBLE", "float64": "DOUBLE",
+    "float32": "FLOAT", "str": "VARCHAR", "string": "VARCHAR", "object": "VARCHAR", "bool": "BOOLEAN",
+    "datetime64[ns]": "TIMESTAMP", "datetime64": "TIMESTAMP", "date": "DATE",
+}
+
+
+def _aggregate_sql(func, expr):
+    if callable(func):
+        func = getattr(func, "__name__", str(func))
+    name = AGGREGATES.get(func)
+    if name is None:
+        raise NotImplementedError(f"aggregation '{func}' is not supported on lazy frames")
+    if name == "count_distinct":
+        return f"count(DISTINCT {expr})"
+    if func == "size":
+        return "count(*)"
+    return f"{name}({expr})"
+
+
+def _unsupported(kind, name):
+    return AttributeError(
+        f"'{name}' is not supported on lazy {kind}s (large tables backed by DuckDB). Use the supported operations "
+        f"(filters, assign, groupby/agg, merge, sort_values, head) to reduce the data first, then call .to_pandas() "
+        f"on the reduced frame to continue with pandas")
+
+
+class _Rows(object):
+    """identity of a frame's row set; filtering or limiting a frame gives a subset of its rows"""
+    __slots__ = ("parent",)
+
+    def __init__(self, parent=None):
+        self.parent = parent
+
+    def within(self, other):
+        rows = self
+        while rows is not None:
+            if rows is other:
+                return True
+            rows = rows.parent
+        return False
+
+
+# The state of lazy objects (relations, the connection, SQL expressions) is kept out of reach of the transform
+# code: the objects it gets have no attributes, and every method building SQL from a state is a module function
+_FrameState = namedtuple("_FrameState", "relation connection index series schema rows")
+_ColumnState = namedtuple("_ColumnState", "frame expr name")
+_GroupState = namedtuple("_GroupState", "frame keys selection as_index sort dropna")
+# keyed by id: lazy columns overload ==, so they cannot be dictionary keys themselves
+_states = {}
+
+
+def _state(obj):
+    return _states[id(obj)]
+
+
+def _set_state(obj, state):
+    if id(obj) not in _states:
+        weakref.finalize(obj, _states.pop, id(obj), None)
+    _states[id(obj)] = state
+
+
+def _new(cls, state):
+    obj = object.__new__(cls)
+    _set_state(obj, state)
+    return obj
+
+
+def _new_frame(relation, connection):
+    return _new(LazyFrame, _FrameState(relation, connection, (), False, object(), _Rows()))
+
+
+def _frame_columns(frame):
+    return [c for c in frame.relation.columns if c not in frame.index]
+
+
+def _check_columns(frame, columns):
+    missing = [c for c in columns if c not in frame.relation.columns]
+    if missing:
+        raise KeyError(f"{missing} not in columns")
+
+
+def _derive_frame(frame, relation, **changes):
+    return _new(LazyFrame, frame._replace(relation=relation, **changes))
+
+
+def _subset(frame, relation):
+    # a frame of some of the frame's rows
+    return _derive_frame(frame, relation, rows=_Rows(frame.rows))
+
+
+def _column_sql(value, frame):
+    """SQL of a value used with a frame: lazy columns must come from the same rows (or a superset of them) with the
+    same column definitions, like an index-aligned pandas assignment that leaves no row empty"""
+    if not isinstance(value, LazyColumn):
+        return _literal(value)
+    column = _state(value)
+    if column.frame.schema is not frame.schema or not frame.rows.within(column.frame.rows):
+        raise ValueError("a lazy column can only be combined with the frame it was taken from, or with a filtered / "
+                         "sorted frame of it; columns of merged, grouped, renamed or reassigned frames do not align")
+    return column.expr
+
+
+def _with_column(frame, name, value):
+    if isinstance(value, (pd.Series, pd.DataFrame, np.ndarray, list, LazyFrame)):
+        raise NotImplementedError("only expressions of the lazy frame's columns and scalars can be assigned")
+    expr = f"{_column_sql(value, frame)} AS {_quote(name)}"
+    if name in frame.relation.columns:
+        # the column changes meaning: columns taken before no longer align with the frame
+        return frame._replace(relation=frame.relation.project(f"* REPLACE ({expr})"), schema=object())
+    return frame._replace(relation=frame.relation.project(f"*, {expr}"))
+
+
+def _to_pandas(frame, df):
+    if frame.index:
+        df = df.set_index(list(frame.index))
+    return df.iloc[:, 0] if frame.series else df
+
+
+def _derive_column(column, expr):
+    return _new(LazyColumn, column._replace(expr=expr))
+
+
+def _binary(value, op, other, reverse=False):
+    column = _state(value)
+    if isinstance(other, LazyColumn):
+        other_column = _state(other)
+        if other_column.frame.schema is not column.frame.schema or other_column.frame.rows is not column.frame.rows:
+            raise ValueError("lazy columns of different frames cannot be combined")
+        other_sql = other_column.expr
+    else:
+        other_sql = _literal(other)
+    left, right = (other_sql, column.expr) if reverse else (column.expr, other_sql)
+    return _derive_column(column, f"({left} {op} {right})")
+
+
+def _unary(value, template, *args):
+    column = _state(value)
+    return _derive_column(column, template.format(column.expr, *[_literal(arg) for arg in args]))
+
+
+def _scalar(value, aggregate_sql):
+    return _state(value).frame.relation.aggregate(aggregate_sql).fetchone()[0]
+
+
+def _column_relation(column):
+    index = [_quote(c) for c in column.frame.index]
+    return column.frame.relation.project(", ".join(index + [f"{column.expr} AS {_quote(column.name or 'value')}"]))
+
+
+def _to_series(column, df):
+    if column.frame.index:
+        df = df.set_index(list(column.frame.index))
+    return df.iloc[:, 0].rename(column.name)
+
+
+class LazyTableRef(object):
+    """picklable reference to a table of a snapshot database file (see snapshot_table), opened as a LazyFrame"""
+    __slots__ = ("db_file", "table_name")
+
+    def __init__(self, db_file, table_name):
+        self.db_file = db_file
+        self.table_name = table_name
+
+    def open(self, connections):
+        """LazyFrame of the table; frames combined by one transform (e.g. merged) must share their connection, so the
+        snapshots of a transform are opened together with open_snapshots first"""
+        if self.db_file not in connections:
+            open_snapshots([self], connections)
+        conn, catalog = connections[self.db_file]
+        table = _quote(self.table_name) if catalog is None else f"{catalog}.{_quote(self.table_name)}"
+        return _new_frame(conn.table(table), conn)
+
+
+def open_snapshots(refs, connections):
+    """opens the snapshot files of refs on one read-only connection: the first one is its database, the others are
+    attached to it. File and network access is then disabled on the connection, it cannot attach anything else.
+    connections maps db file -> (connection, catalog), close it with close_all"""
+    db_files = list(dict.fromkeys(ref.db_file for ref in refs if ref.db_file not in connections))
+    if not db_files:
+        return
+    conn = duckdb.connect(database=db_files[0], read_only=True)
+    try:
+        connections[db_files[0]] = (conn, None)
+        for i, db_file in enumerate(db_files[1:], 1):
+            conn.execute("ATTACH '{}' AS snapshot_{} (READ_ONLY)".format(db_file.replace("'", "''"), i))
+            connections[db_file] = (conn, f"snapshot_{i}")
+        conn.execute("SET enable_external_access = false")
+    except Exception:
+        for db_file in db_files:
+            connections.pop(db_file, None)
+        conn.close()
+        raise
+
+
+def close_all(connections):
+    for conn in {id(conn): conn for conn, _ in connections.values()}.values():
+        try:
+            conn.close()
+        except duckdb.Error:
+            pass
+    connections.clear()
+
+
+def _file_version(db_file):
+    """changes whenever the database file is written: duckdb appends every change to the wal file first and later
+    checkpoints it into the database file (reads change neither)"""
+    def stat(path):
+        try:
+            info = os.stat(path)
+            return info.st_mtime_ns, info.st_size
+        except OSError:
+            return None
+    return stat(db_file), stat(db_file + ".wal")
+
+
+def _copy_table(conn, table_name):
+    """copies a table of conn into a new snapshot database file"""
+    snapshot_dir = tempfile.mkdtemp(prefix="df-lazy-")
+    db_file = os.path.join(snapshot_dir, "snapshot.duckdb")
+    try:
+        conn.execute("ATTACH '{}' AS lazy_snapshot".format(db_file.replace("'", "''")))
+        try:
+            conn.execute(f"CREATE TABLE lazy_snapshot.{_quote(table_name)} AS SELECT * FROM {_quote(table_name)}")
+        finally:
+            # detached, the file is no longer locked by this (read-write) connection
+            conn.execute("DETACH lazy_snapshot")
+    except Exception:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        raise
+    return LazyTableRef(db_file, table_name)
+
+
+def _remove_snapshot_file(ref):
+    shutil.rmtree(os.path.dirname(ref.db_file), ignore_errors=True)
+
+
+class _Snapshot(object):
+    __slots__ = ("ref", "version", "users", "current")
+
+    def __init__(self, ref, version):
+        self.ref = ref
+        self.version = version
+        self.users = 1
+        self.current = True
+
+
+class SnapshotCache(object):
+    """
+    Snapshots of session tables by (session db file, table name), shared by the requests on the same table.
+    A snapshot is replaced once the session database file changed since it was taken, and removed when no
+    request uses it anymore; up to max_idle current snapshots no request uses are kept, least recently used first.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._entries = OrderedDict()  # (db file, table name) -> current _Snapshot, least recently used first
+        self._snapshots = {}  # snapshot db file -> _Snapshot, current or still used
+        self._lock = threading.Lock()
+
+    def acquire(self, conn, db_file, table_name):
+        """LazyTableRef to a snapshot of table_name of conn (the connection of db_file); release it with release"""
+        key = (db_file, table_name)
+        # taken before copying: a change made while copying makes the next request copy again
+        version = _file_version(db_file)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version:
+                entry.users += 1
+                self._entries.move_to_end(key)
+                return entry.ref
+
+        ref = _copy_table(conn, table_name)
+        removed = []
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                entry.current = False
+                if entry.users == 0:
+                    removed.append(self._snapshots.pop(entry.ref.db_file).ref)
+            self._entries[key] = self._snapshots[ref.db_file] = _Snapshot(ref, version)
+        for old in removed:
+            _remove_snapshot_file(old)
+        return ref
+
+    def release(self, ref):
+        removed = []
+        with self._lock:
+            entry = self._snapshots.get(ref.db_file)
+            if entry is None:
+                return
+            entry.users -= 1
+            if entry.users == 0 and not entry.current:
+                removed.append(self._snapshots.pop(ref.db_file).ref)
+            idle = [key for key, entry in self._entries.items() if entry.users == 0]
+            for key in idle[:max(len(idle) - self.max_idle, 0)]:
+                removed.append(self._snapshots.pop(self._entries.pop(key).ref.db_file).ref)
+        for old in removed:
+            _remove_snapshot_file(old)
+
+    def clear(self):
+        with self._lock:
+            snapshots = [entry.ref for entry in self._snapshots.values()]
+            self._entries.clear()
+            self._snapshots.clear()
+        for ref in snapshots:
+            _remove_snapshot_file(ref)
+
+
+_snapshot_cache = SnapshotCache(LAZY_SNAPSHOT_CACHE_SIZE)
+atexit.register(_snapshot_cache.clear)
+
+
+def snapshot_table(conn, db_file, table_name):
+    """LazyTableRef to a snapshot of a table of conn (the connection of the session database db_file), reused
+    while the session database is unchanged; release it with release_snapshot once the request is done"""
+    return _snapshot_cache.acquire(conn, db_file, table_name)
+
+
+def release_snapshot(ref):
+    _snapshot_cache.release(ref)
+
+
+class LazyColumn(object):
+    """a column expression of a LazyFrame; operators build SQL, reductions run it"""
+    __slots__ = ("__weakref__",)
+
+    __add__ = lambda self, other: _binary(self, "+", other)
+    __radd__ = lambda self, other: _binary(self, "+", other, True)
+    __sub__ = lambda self, other: _binary(self, "-", other)
+    __rsub__ = lambda self, other: _binary(self, "-", other, True)
+    __mul__ = lambda self, other: _binary(self, "*", other)
+    __rmul__ = lambda self, other: _binary(self, "*", other, True)
+    __truediv__ = lambda self, other: _binary(self, "/", other)
+    __rtruediv__ = lambda self, other: _binary(self, "/", other, True)
+    __floordiv__ = lambda self, other: _binary(self, "//", other)
+    __mod__ = lambda self, other: _binary(self, "%", other)
+    __pow__ = lambda self, other: _binary(self, "**", other)
+    __gt__ = lambda self, other: _binary(self, ">", other)
+    __ge__ = lambda self, other: _binary(self, ">=", other)
+    __lt__ = lambda self, other: _binary(self, "<", other)
+    __le__ = lambda self, other: _binary(self, "<=", other)
+    __eq__ = lambda self, other: _binary(self, "=", other) if other is not None else self.isna()
+    __ne__ = lambda self, other: _binary(self, "<>", other) if other is not None else self.notna()
+    __and__ = lambda self, other: _binary(self, "AND", other)
+    __rand__ = lambda self, other: _binary(self, "AND", other, True)
+    __or__ = lambda self, other: _binary(self, "OR", other)
+    __ror__ = lambda self, other: _binary(self, "OR", other, True)
+    __invert__ = lambda self: _unary(self, "(NOT {})")
+    __neg__ = lambda self: _unary(self, "(-{})")
+    __abs__ = lambda self: _unary(self, "abs({})")
+    __hash__ = object.__hash__
+
+    def __bool__(self):
+        raise ValueError("The truth value of a lazy column is ambiguous. Use a.any() or a.all(), or & / | to combine conditions")
+
+    @property
+    def name(self):
+        return _state(self).name
+
+    def isin(self, values):
+        return _unary(self, "({} IN {})", list(values))
+
+    def isna(self):
+        return _unary(self, "({} IS NULL)")
+
+    def notna(self):
+        return _unary(self, "({} IS NOT NULL)")
+
+    isnull = isna
+    notnull = notna
+
+    def between(self, left, right):
+        return _unary(self, "({} BETWEEN {} AND {})", left, right)
+
+    def fillna(self, value):
+        return _unary(self, "coalesce({}, {})", value)
+
+    def astype(self, dtype):
+        dtype = getattr(dtype, "__name__", str(dtype))
+        if dtype not in CAST_TYPES:
+            raise TypeError(f"astype('{dtype}') is not supported on lazy columns, supported types: {', '.join(CAST_TYPES)}")
+        return _unary(self, "CAST({} AS " + CAST_TYPES[dtype] + ")")
+
+    def abs(self):
+        return abs(self)
+
+    def round(self, decimals=0):
+        return _unary(self, "round({}, {})", int(decimals))
+
+    def rename(self, name):
+        return _new(LazyColumn, _state(self)._replace(name=name))
+
+    @property
+    def str(self):
+        return _StringAccessor(self)
+
+    @property
+    def dt(self):
+        return _DatetimeAccessor(self)
+
+    def _reduce(self, func):
+        return _scalar(self, _aggregate_sql(func, _state(self).expr))
+
+    sum = lambda self: self._reduce("sum")
+    mean = lambda self: self._reduce("mean")
+    min = lambda self: self._reduce("min")
+    max = lambda self: self._reduce("max")
+    count = lambda self: self._reduce("count")
+    nunique = lambda self: self._reduce("nunique")
+    median = lambda self: self._reduce("median")
+    std = lambda self: self._reduce("std")
+
+    def any(self):
+        return bool(_scalar(self, f"coalesce(bool_or({_state(self).expr}), FALSE)"))
+
+    def all(self):
+        return bool(_scalar(self, f"coalesce(bool_and({_state(self).expr}), TRUE)"))
+
+    def value_counts(self):
+        column = _state(self)
+        name = column.name or "value"
+        counts = column.frame.relation.aggregate(f"{column.expr} AS {_quote(name)}, count(*) AS count", column.expr)
+        return counts.order("count DESC").df().set_index(name)["count"]
+
+    def to_pandas(self):
+        """the column as a pandas Series (all its rows)"""
+        column = _state(self)
+        return _to_series(column, _column_relation(column).df())
+
+    def __len__(self):
+        return _scalar(self, "count(*)")
+
+    def __iter__(self):
+        raise TypeError("lazy columns cannot be iterated, reduce them first or call .to_pandas()")
+
+    def __getattr__(self, name):
+        raise _unsupported("column", name)
+
+
+class _StringAccessor(object):
+    __slots__ = ("column",)
+
+    def __init__(self, column):
+        self.column = column
+
+    lower = lambda self: _unary(self.column, "lower({})")
+    upper = lambda self: _unary(self.column, "upper({})")
+    len = lambda self: _unary(self.column, "length({})")
+    strip = lambda self: _unary(self.column, "trim({})")
+    startswith = lambda self, prefix: _unary(self.column, "starts_with({}, {})", prefix)
+    endswith = lambda self, suffix: _unary(self.column, "ends_with({}, {})", suffix)
+
+    def contains(self, pat, case=True, regex=True):
+        if regex:
+            return _unary(self.column, "regexp_matches({}, {})" if case else "regexp_matches({}, {}, 'i')", pat)
+        if case:
+            return _unary(self.column, "contains({}, {})", pat)
+        return _unary(self.column, "contains(lower({}), lower({}))", pat)
+
+    def replace(self, pat, repl, regex=False):
+        if regex:
+            return _unary(self.column, "regexp_replace({}, {}, {}, 'g')", pat, repl)
+        return _unary(self.column, "replace({}, {}, {})", pat, repl)
+
+    def slice(self, start=None, stop=None):
+        start = int(start or 0) + 1
+        return _unary(self.column, "{}[{}:" + ("" if stop is None else str(int(stop))) + "]", start)
+
+    def __getattr__(self, name):
+        raise _unsupported("column", f"str.{name}")
+
+
+class _DatetimeAccessor(object):
+    __slots__ = ("column",)
+
+    def __init__(self, column):
+        self.column = column
+
+    year = property(lambda self: _unary(self.column, "date_part('year', {})"))
+    quarter = property(lambda self: _unary(self.column, "date_part('quarter', {})"))
+    month = property(lambda self: _unary(self.column, "date_part('month', {})"))
+    day = property(lambda self: _unary(self.column, "date_part('day', {})"))
+    hour = property(lambda self: _unary(self.column, "date_part('hour', {})"))
+    minute = property(lambda self: _unary(self.column, "date_part('minute', {})"))
+    # pandas counts Monday as 0, duckdb's isodow Monday as 1
+    dayofweek = property(lambda self: _unary(self.column, "(isodow({}) - 1)"))
+    date = property(lambda self: _unary(self.column, "CAST({} AS DATE)"))
+
+    def __getattr__(self, name):
+        raise _unsupported("column", f"dt.{name}")
+
+
+def _aggregate(group, aggregates, series):
+    key_sql = ", ".join(_quote(k) for k in group.keys)
+    relation = group.frame.relation
+    if group.dropna:
+        relation = relation.filter(" AND ".join(f"{_quote(k)} IS NOT NULL" for k in group.keys))
+    relation = relation.aggregate(f"{key_sql}, {aggregates}", key_sql)
+    if group.sort:
+        relation = relation.order(key_sql)
+    index = tuple(group.keys) if group.as_index else ()
+    return _new(LazyFrame, _FrameState(relation, group.frame.connection, index, series, object(), _Rows()))
+
+
+class LazyGroupBy(object):
+    __slots__ = ("__weakref__",)
+
+    def __getitem__(self, columns):
+        group = _state(self)
+        _check_columns(group.frame, [columns] if isinstance(columns, str) else list(columns))
+        return _new(LazyGroupBy, group._replace(selection=columns))
+
+    def agg(self, spec=None, **named):
+        """
+        agg("sum") / agg(["sum", "max"]) on a selected column, agg("sum") on the selected columns, agg({"col": "sum"})
+        or agg(name=("col", "sum")); like pandas, the group keys become the index unless groupby(as_index=False)
+        """
+        group = _state(self)
+        columns = group.selection if group.selection is not None else [c for c in _frame_columns(group.frame) if c not in group.keys]
+        single = isinstance(columns, str)
+
+        if named:
+            outputs = [(name, column, func) for name, (column, func) in named.items()]
+        elif isinstance(spec, dict):
+            if any(isinstance(funcs, (list, tuple)) for funcs in spec.values()):
+                raise NotImplementedError("lists of aggregations per column are not supported on lazy frames, use named aggregation")
+            outputs = [(column, column, func) for column, func in spec.items()]
+        elif isinstance(spec, (list, tuple)):
+            if not single:
+                raise NotImplementedError("lists of aggregations are only supported on a single selected column, use named aggregation")
+            outputs = [(getattr(func, "__name__", func), columns, func) for func in spec]
+        else:
+            outputs = [(column, column, spec) for column in ([columns] if single else columns)]
+        _check_columns(group.frame, [column for _, column, _ in outputs])
+
+        # a single selected column with a single aggregation is a Series, like in pandas
+        series = single and not named and not isinstance(spec, (dict, list, tuple)) and group.as_index
+        aggregates = ", ".join(f"{_aggregate_sql(func, _quote(column))} AS {_quote(name)}" for name, column, func in outputs)
+        return _aggregate(group, aggregates, series)
+
+    aggregate = agg
+
+    sum = lambda self: self.agg("sum")
+    mean = lambda self: self.agg("mean")
+    min = lambda self: self.agg("min")
+    max = lambda self: self.agg("max")
+    count = lambda self: self.agg("count")
+    nunique = lambda self: self.agg("nunique")
+    median = lambda self: self.agg("median")
+    std = lambda self: self.agg("std")
+    first = lambda self: self.agg("first")
+    last = lambda self: self.agg("last")
+
+    def size(self):
+        group = _state(self)
+        return _aggregate(group, "count(*) AS size", group.as_index)
+
+    def __getattr__(self, name):
+        raise _unsupported("groupby", name)
+
+
+class LazyFrame(object):
+    """
+    DataFrame-like wrapper of a duckdb relation: selections, filters, assignments, group-bys, merges,
+    sorting and limits are pushed down to duckdb and evaluated only when the result is materialized.
+    Other pandas attributes raise; to_pandas() loads the frame for them explicitly.
+    """
+    __slots__ = ("__weakref__",)
+
+    @property
+    def columns(self):
+        return pd.Index(_frame_columns(_state(self)))
+
+    @property
+    def shape(self):
+        return (len(self), len(self.columns))
+
+    def __len__(self):
+        return _state(self).relation.aggregate("count(*)").fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __bool__(self):
+        raise ValueError("The truth value of a lazy frame is ambiguous")
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, key):
+        frame = _state(self)
+        if isinstance(key, LazyColumn):
+            return _subset(frame, frame.relation.filter(_column_sql(key, frame)))
+        if isinstance(key, (list, tuple, pd.Index)):
+            key = list(key)
+            _check_columns(frame, key)
+            return _derive_frame(frame, frame.relation.project(", ".join(_quote(c) for c in list(frame.index) + key)))
+        if not isinstance(key, str) or key not in _frame_columns(frame):
+            raise KeyError(key)
+        return _new(LazyColumn, _ColumnState(frame, _quote(key), key))
+
+    def __getattr__(self, name):
+        if not name.startswith("_") and name in _frame_columns(_state(self)):
+            return self[name]
+        raise _unsupported("frame", name)
+
+    def __setitem__(self, name, value):
+        if not isinstance(name, str):
+            raise NotImplementedError("lazy frames only support assigning a single column")
+        _set_state(self, _with_column(_state(self), name, value(self) if callable(value) else value))
+
+    def assign(self, **columns):
+        frame = _state(self)
+        for name, value in columns.items():
+            frame = _with_column(frame, name, value(_new(LazyFrame, frame)) if callable(value) else value)
+        return _new(LazyFrame, frame)
+
+    def groupby(self, by, as_index=True, sort=True, dropna=True):
+        frame = _state(self)
+        keys = [by] if isinstance(by, str) else list(by)
+        if not all(isinstance(key, str) for key in keys):
+            raise NotImplementedError("lazy frames can only be grouped by column names")
+        _check_columns(frame, keys)
+        return _new(LazyGroupBy, _GroupState(frame, keys, None, as_index, sort, dropna))
+
+    def merge(self, right, how="inner", on=None, left_on=None, right_on=None, suffixes=("_x", "_y")):
+        frame = _state(self)
+        if isinstance(right, pd.DataFrame):
+            right = _new_frame(frame.connection.from_df(right), frame.connection)
+        if not isinstance(right, LazyFrame):
+            raise TypeError("lazy frames can only be merged with lazy frames or pandas DataFrames")
+        other = _state(right)
+        if frame.index or other.index:
+            raise NotImplementedError("merging grouped lazy frames is not supported, call reset_index() first")
+        if other.connection is not frame.connection:
+            raise NotImplementedError("lazy frames of different databases cannot be merged")
+        if how not in ("inner", "left", "right", "outer"):
+            raise ValueError(f"merge how='{how}' is not supported on lazy frames")
+
+        if on is not None:
+            left_on = right_on = [on] if isinstance(on, str) else list(on)
+        elif left_on is None:
+            left_on = right_on = [c for c in self.columns if c in right.columns]
+        left_on = [left_on] if isinstance(left_on, str) else list(left_on)
+        right_on = [right_on] if isinstance(right_on, str) else list(right_on)
+        _check_columns(frame, left_on)
+        _check_columns(other, right_on)
+
+        condition = " AND ".join(f"l.{_quote(a)} = r.{_quote(b)}" for a, b in zip(left_on, right_on))
+        joined = frame.relation.set_alias("l").join(other.relation.set_alias("r"), condition, how=how)
+
+        # pandas column naming: shared keys once, other clashing columns suffixed
+        shared_keys = [a for a, b in zip(left_on, right_on) if a == b]
+        projection = []
+        for c in self.columns:
+            if c in shared_keys:
+                projection.append(f"coalesce(l.{_quote(c)}, r.{_quote(c)}) AS {_quote(c)}" if how in ("right", "outer")
+                                  else f"l.{_quote(c)} AS {_quote(c)}")
+            elif c in right.columns:
+                projection.append(f"l.{_quote(c)} AS {_quote(str(c) + suffixes[0])}")
+            else:
+                projection.append(f"l.{_quote(c)} AS {_quote(c)}")
+        for c in right.columns:
+            if c in shared_keys:
+                continue
+            name = str(c) + suffixes[1] if c in self.columns else c
+            projection.append(f"r.{_quote(c)} AS {_quote(name)}")
+        return _derive_frame(frame, joined.project(", ".join(projection)), schema=object(), rows=_Rows())
+
+    def sort_values(self, by=None, ascending=True):
+        frame = _state(self)
+        if by is None:
+            if not frame.series:
+                raise TypeError("sort_values() missing 1 required argument: 'by'")
+            # a grouped single-column result is used like a Series: sort by its values
+            by = _frame_columns(frame)[-1]
+        by = [by] if isinstance(by, str) else list(by)
+        _check_columns(frame, by)
+        ascending = [ascending] * len(by) if isinstance(ascending, bool) else list(ascending)
+        order = ", ".join(f"{_quote(c)} {'ASC' if asc else 'DESC'}" for c, asc in zip(by, ascending))
+        return _derive_frame(frame, frame.relation.order(order))
+
+    def head(self, n=5):
+        n = int(n)
+        if n < 0:
+            raise NotImplementedError("head() with a negative n is not supported on lazy frames")
+        frame = _state(self)
+        return _subset(frame, frame.relation.limit(n))
+
+    def nlargest(self, n, columns=None):
+        return self.sort_values(columns, ascending=False).head(n)
+
+    def nsmallest(self, n, columns=None):
+        return self.sort_values(columns).head(n)
+
+    def rename(self, columns=None):
+        frame = _state(self)
+        columns = columns or {}
+        new_name = columns if callable(columns) else (lambda c: columns.get(c, c))
+        projection = ", ".join(f"{_quote(c)} AS {_quote(c if c in frame.index else new_name(c))}" for c in frame.relation.columns)
+        return _derive_frame(frame, frame.relation.project(projection), schema=object())
+
+    def drop(self, labels=None, axis=0, columns=None):
+        if labels is not None:
+            if axis not in (1, "columns"):
+                raise NotImplementedError("lazy frames can only drop columns (axis=1 or columns=...)")
+            columns = labels
+        columns = [columns] if isinstance(columns, str) else list(columns or [])
+        _check_columns(_state(self), columns)
+        return self[[c for c in self.columns if c not in columns]]
+
+    def drop_duplicates(self, subset=None):
+        if subset is not None:
+            raise NotImplementedError("drop_duplicates(subset=...) is not supported on lazy frames, use groupby(...).agg(...)")
+        frame = _state(self)
+        return _subset(frame, frame.relation.project(", ".join(_quote(c) for c in frame.relation.columns)).distinct())
+
+    def dropna(self, subset=None):
+        frame = _state(self)
+        subset = subset or _frame_columns(frame)
+        subset = [subset] if isinstance(subset, str) else list(subset)
+        _check_columns(frame, subset)
+        return _subset(frame, frame.relation.filter(" AND ".join(f"{_quote(c)} IS NOT NULL" for c in subset)))
+
+    def reset_index(self, drop=False, name=None):
+        frame = _state(self)
+        if name is not None:
+            if not frame.series:
+                raise TypeError("reset_index() got an unexpected keyword argument 'name'")
+            frame = _state(self.rename(columns={_frame_columns(frame)[-1]: name}))
+        if not frame.index:
+            if not drop:
+                raise NotImplementedError("lazy frames have no row positions, use reset_index(drop=True)")
+            return _new(LazyFrame, frame._replace(series=False))
+        if drop:
+            relation = frame.relation.project(", ".join(_quote(c) for c in _frame_columns(frame)))
+            return _new(LazyFrame, frame._replace(relation=relation, index=(), series=False))
+        # the group keys are already the first columns
+        return _new(LazyFrame, frame._replace(index=(), series=False))
+
+    def copy(self, deep=True):
+        return _new(LazyFrame, _state(self))
+
+    def to_pandas(self):
+        """the frame as a pandas DataFrame (all its rows), or a Series for a grouped single-column result"""
+        frame = _state(self)
+        return _to_pandas(frame, frame.relation.df())
+
+
+def materialize(value):
+    """(pandas object, truncated) of a lazy frame / column, e.g. the result of a transform, with at most
+    LAZY_FRAME_MAX_RESULT_ROWS rows; other values are returned unchanged"""
+    if isinstance(value, LazyColumn):
+        column = _state(value)
+        df = _column_relation(column).limit(LAZY_FRAME_MAX_RESULT_ROWS + 1).df()
+        return _to_series(column, df.head(LAZY_FRAME_MAX_RESULT_ROWS)), len(df) > LAZY_FRAME_MAX_RESULT_ROWS
+    if isinstance(value, LazyFrame):
+        frame = _state(value)
+        df = frame.relation.limit(LAZY_FRAME_MAX_RESULT_ROWS + 1).df()
+        return _to_pandas(frame, df.head(LAZY_FRAME_MAX_RESULT_ROWS)), len(df) > LAZY_FRAME_MAX_RESULT_ROWS
+    return value, False
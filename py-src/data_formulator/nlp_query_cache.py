@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import logging
+from typing import Dict, Any, List, Optional
+
+# soru normalizasyonu şema aramasıyla aynı Türkçe karakter indirgemesini kullanır
+from data_formulator.data_loader.schema_retriever import TURKISH_FOLD
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+# Anlamı değiştirmeyen cümle noktalaması; operatörler (>, <=, =, !=), işaretler (-, +) ve %
+# gibi diğer semboller ayrı token olarak korunur ("sales > 1000" ile "sales < 1000" farklıdır)
+SENTENCE_PUNCTUATION = set('.,;:!?\'"`()[]{}«»“”‘’…')
+
+# ondalık sayı, kelime, iki karakterli operatör ya da tek sembol
+_TOKEN_PATTERN = re.compile(r'\d+\.\d+|\w+|[<>!=]=|<>|[^\w\s]')
+
+
+def _normalize_number(match) -> str:
+    """Sayı yazımını tekilleştir: '1,000' / '1.000' -> '1000', '10.0' -> '10', '007' -> '7'"""
+    text = match.group(0)
+    if re.fullmatch(r'\d{1,3}([.,]\d{3})+', text):
+        text = re.sub(r'[.,]', '', text)
+    elif ',' in text and '.' in text:
+        # '1,000.5' / '1.000,5': son ayraç ondalık, diğerleri binlik ayraç
+        head, _, decimals = text.replace(',', '.').rpartition('.')
+        text = head.replace('.', '') + '.' + decimals
+    text = text.replace(',', '.')
+    try:
+        value = float(text)
+    except ValueError:
+        return text
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def normalize_question(question: str) -> str:
+    """Soruyu cache anahtarı için normalize et.
+
+    Büyük/küçük harf, boşluklar, cümle noktalaması ve Türkçe karakterler tekilleştirilir; sayılar
+    kanonik yazıma çevrilir ama korunur ("top 10" ile "top 5" farklı sorgulardır). Operatörler ve
+    işaretler ayrı token olarak kalır ("price = -5" ile "price = 5" farklı sorgulardır).
+    """
+    text = (question or '').translate(TURKISH_FOLD).lower()
+    text = re.sub(r'\d+(?:[.,]\d+)*', _normalize_number, text)
+    tokens = _TOKEN_PATTERN.findall(text)
+    return ' '.join(token for token in tokens if token not in SENTENCE_PUNCTUATION)
+
+
+class NLPQueryCache:
+    """
+    NLP Query Cache - NLP-to-SQL ve çeviri sonuçlarını SQLite'ta saklar.
+    Anahtar; normalize edilmiş soru, database_id, seçili tablolar, model ve indeks sürümünden oluşur.
+    İndeks yeniden yazıldığında sürüm değiştiği için eski kayıtlar kendiliğinden kullanılmaz olur.
+    """
+
+    def __init__(self, store_path: str = "flask_session/nlp_query_cache.db",
+                 ttl_seconds: int = DEFAULT_TTL_SECONDS):
+        self.store_path = store_path
+        self.ttl_seconds = ttl_seconds
+        self._stats = {'hits': 0, 'misses': 0, 'writes': 0}
+        self._lock = threading.Lock()
+        self._init_store()
+
+    def _get_connection(self):
+        conn = sqlite3.connect(self.store_path, timeout=30.0)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        return conn
+
+    def _init_store(self):
+        os.makedirs(os.path.dirname(self.store_path) or ".", exist_ok=True)
+        conn = self._get_connection()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS nlp_query_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    database_id INTEGER,
+                    index_version INTEGER,
+                    model TEXT,
+                    normalized_question TEXT,
+                    result TEXT NOT NULL,
+                    created_at REAL,
+                    expires_at REAL,
+                    hit_count INTEGER DEFAULT 0,
+                    last_hit_at REAL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_nlp_query_cache_db ON nlp_query_cache (database_id)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(kind: str, question: str, model: str, database_id: Optional[int] = None,
+                 selected_tables: Optional[List] = None, index_version: Optional[int] = None,
+                 options: Optional[Dict[str, Any]] = None) -> str:
+        key_data = {
+            'kind': kind,
+            'question': normalize_question(question),
+            'model': model,
+            'database_id': database_id,
+            'selected_tables': sorted(str(t) for t in selected_tables) if selected_tables else None,
+            'index_version': index_version,
+            'options': options or {},
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        conn = self._get_connection()
+        try:
+            row = conn.execute('SELECT result FROM nlp_query_cache WHERE cache_key = ? AND expires_at > ?',
+                               (cache_key, now)).fetchone()
+            if row:
+                conn.execute('UPDATE nlp_query_cache SET hit_count = hit_count + 1, last_hit_at = ? WHERE cache_key = ?',
+                             (now, cache_key))
+                conn.commit()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._stats['hits' if row else 'misses'] += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, cache_key: str, result: Dict[str, Any], kind: str, question: str, model: str,
+            database_id: Optional[int] = None, index_version: Optional[int] = None):
+        now = time.time()
+        conn = self._get_connection()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO nlp_query_cache
+                (cache_key, kind, database_id, index_version, model, normalized_question, result, created_at, expires_at, hit_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+            ''', (cache_key, kind, database_id, index_version, model, normalize_question(question),
+                  json.dumps(result), now, now + self.ttl_seconds))
+            # Aynı veritabanının eski indeks sürümlerine ait ve süresi dolmuş kayıtları temizle
+            if database_id is not None and index_version is not None:
+                conn.execute('DELETE FROM nlp_query_cache WHERE database_id = ? AND index_version != ?',
+                             (database_id, index_version))
+            conn.execute('DELETE FROM nlp_query_cache WHERE expires_at <= ?', (now,))
+            conn.commit()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._stats['writes'] += 1
+
+    def invalidate(self, database_id: Optional[int] = None) -> int:
+        """Bir veritabanına (veya database_id verilmezse tümüne) ait kayıtları sil"""
+        conn = self._get_connection()
+        try:
+            if database_id is None:
+                cursor = conn.execute('DELETE FROM nlp_query_cache')
+            else:
+                cursor = conn.execute('DELETE FROM nlp_query_cache WHERE database_id = ?', (database_id,))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._get_connection()
+        try:
+            entries, total_hits = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(hit_count), 0) FROM nlp_query_cache WHERE expires_at > ?',
+                (time.time(),)
+            ).fetchone()
+        finally:
+            conn.close()
+
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats.update(
+            hit_rate=round(stats['hits'] / lookups, 3) if lookups else None,
+            entries=entries,
+            stored_hits=total_hits,
+            ttl_seconds=self.ttl_seconds,
+        )
+        return stats
@@ -1,17 +1,352 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-from multiprocessing import Process, Pipe
+import multiprocessing
 from sys import addaudithook
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import ast
+import ctypes
+import functools
+import hashlib
+import json
+import os
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import time
 import traceback
 import warnings
+import weakref
+import logging
 import pandas as pd
 
-def subprocess_execute(code, allowed_objects, conn):
-    """run the code in a subprocess with some sort of safety measure
-    code: script to execute
-    allowed_objects: objects exposed to the target code
-    conn: children connection
+from data_formulator.lazy_frame import LazyTableRef, LAZY_FRAME_MAX_RESULT_ROWS, materialize, open_snapshots, close_all
+
+try:
+    import resource
+except ImportError:  # not available on Windows, workers are then only recycled by job count
+    resource = None
+
+try:
+    import pyarrow as pa
+except ImportError:  # without pyarrow, dataframes are pickled through the pipe
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# sandbox workers are not forked from the (multithreaded) app process, whose heap (DuckDB buffers, loaded frames)
+# would count toward their memory limit: they are forked from a fork server that only preloads this module,
+# or spawned where fork servers are not available (Windows)
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _worker_context = multiprocessing.get_context("forkserver")
+    _worker_context.set_forkserver_preload([__name__])
+else:
+    _worker_context = multiprocessing.get_context("spawn")
+
+# warm sandbox worker pool used by run_in_subprocess
+SANDBOX_POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+# a worker is replaced after this many jobs (1 = a fresh process for every job, still started ahead of time).
+# Jobs of a worker share its module state (pandas options, numpy's random state, patched classes), so values
+# above 1 let one user's code affect the next user's job: only raise it for single-user deployments
+SANDBOX_MAX_JOBS_PER_WORKER = max(1, int(os.getenv("SANDBOX_MAX_JOBS_PER_WORKER", "1")))
+# ... or once its peak memory grew this much (MB) above its footprint after start-up
+SANDBOX_MAX_MEMORY_GROWTH_MB = float(os.getenv("SANDBOX_MAX_MEMORY_GROWTH_MB", "512"))
+
+# per-execution resource limits: wall clock (subprocess and main process), CPU seconds and memory (subprocess, Linux / macOS)
+SANDBOX_JOB_TIMEOUT = float(os.getenv("SANDBOX_JOB_TIMEOUT", "120"))
+SANDBOX_CPU_TIME_LIMIT = int(os.getenv("SANDBOX_CPU_TIME_LIMIT", "60"))
+SANDBOX_MEMORY_LIMIT_MB = int(os.getenv("SANDBOX_MEMORY_LIMIT_MB", "4096"))
+
+# dataframes with at least this many rows travel to / from the sandbox as Arrow IPC files instead of pickles
+SANDBOX_ARROW_MIN_ROWS = int(os.getenv("SANDBOX_ARROW_MIN_ROWS", "10000"))
+# tmpfs when available, so the exchanged files live in shared memory
+ARROW_EXCHANGE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# results of successful executions, reused when the same code runs again on the same inputs (needs pyarrow)
+SANDBOX_CACHE_ENABLED = os.getenv("SANDBOX_CACHE_ENABLED", "true").lower() == "true"
+SANDBOX_CACHE_DIR = os.getenv("SANDBOX_CACHE_DIR", "flask_session/sandbox_cache")
+SANDBOX_CACHE_MAX_MB = float(os.getenv("SANDBOX_CACHE_MAX_MB", "512"))
+
+
+# List of allowed modules for import
+ALLOWED_MODULES = {
+    'pandas', 'numpy', 'math', 'datetime', 'json', 
+    'statistics', 'random', 'collections', 're',
+    'itertools', 'functools', 'operator'
+}
+
+# builtins and attributes that generated code has no business using, rejected before execution
+FORBIDDEN_CALLS = {'eval', 'exec', 'compile', 'open', '__import__', 'globals', 'locals', 'vars',
+                   'breakpoint', 'input', 'exit', 'quit', 'help', 'memoryview'}
+FORBIDDEN_ATTRIBUTES = {'__globals__', '__builtins__', '__subclasses__', '__bases__', '__base__', '__mro__',
+                        '__code__', '__closure__', '__dict__', '__class__', '__getattribute__', '__traceback__',
+                        'f_globals', 'f_locals', 'f_back', 'tb_frame', 'gi_frame', 'cr_frame'}
+
+
+class ResourceLimitExceeded(BaseException):
+    """
+    raised inside the sandbox when the executed code runs into one of its resource limits; not an
+    Exception, so a bare `except Exception` in the executed code does not swallow it
+    """
+
+    def __init__(self, resource_name, limit):
+        super().__init__(resource_name)
+        self.resource_name = resource_name
+        self.limit = limit
+
+
+# what the model should change when its code runs into a limit, sent back to it by the repair loop
+RESOURCE_LIMIT_HINTS = {
+    'wall_time': ("wall-clock time", "s", "Avoid unbounded loops and row-by-row Python loops or .apply over large tables; "
+                  "use vectorized pandas operations."),
+    'cpu_time': ("CPU time", "s", "Avoid cross joins, nested loops and repeated work over the full table; filter and "
+                 "aggregate before merging and use vectorized pandas operations."),
+    'memory': ("memory", "MB", "Avoid cross joins or merges on non-unique keys that multiply rows, and large intermediate "
+               "copies; filter and aggregate before merging and keep only the needed columns."),
+}
+
+
+def resource_exceeded_result(resource_name, limit):
+    """structured error result of an execution stopped by a resource limit"""
+    name, unit, hint = RESOURCE_LIMIT_HINTS[resource_name]
+    return {
+        'status': 'error',
+        'error_type': 'resource_exceeded',
+        'resource': resource_name,
+        'limit': limit,
+        'error_message': f"Error: ResourceLimitExceeded - the code exceeded the {name} limit of {limit:g}{unit} and was stopped. {hint}",
+    }
+
+
+class _WallTimeExceeded(ResourceLimitExceeded):
+    # raised asynchronously in the executing thread, which can only instantiate it without arguments
+    def __init__(self):
+        super().__init__('wall_time', SANDBOX_JOB_TIMEOUT)
+
+
+class _WallClockDeadline(object):
+    """
+    Raises _WallTimeExceeded in the current thread once `seconds` passed. The exception is delivered
+    between Python bytecodes, so it does not interrupt a long running call into C code.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.thread_id = threading.get_ident()
+        self.fired = False
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(seconds, self._fire)
+        self._timer.daemon = True
+
+    def _fire(self):
+        with self._lock:
+            if self._timer is not None:
+                self.fired = True
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.thread_id), ctypes.py_object(_WallTimeExceeded))
+
+    def __enter__(self):
+        if self.seconds > 0:
+            self._timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self._timer.cancel()
+            self._timer = None
+            if self.fired:
+                # the exception may still be pending if the code finished right at the deadline
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.thread_id), None)
+        return False
+
+
+def error_result(err):
+    """error result of an exception raised by the executed code"""
+    if isinstance(err, ResourceLimitExceeded):
+        return resource_exceeded_result(err.resource_name, err.limit)
+    if isinstance(err, MemoryError):
+        return resource_exceeded_result('memory', SANDBOX_MEMORY_LIMIT_MB)
+    return {'status': 'error', 'error_message': f"Error: {type(err).__name__} - {str(err)}"}
+
+
+class ArrowFrameRef(object):
+    """placeholder for a dataframe stored as an Arrow IPC file at path"""
+    __slots__ = ("path",)
+
+    def __init__(self, path):
+        self.path = path
+
+
+def _write_arrow_frame(df, path):
+    table = pa.Table.from_pandas(df)
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return ArrowFrameRef(path)
+
+
+def _read_arrow_frame(ref):
+    # the file is memory-mapped rather than read into a buffer, but to_pandas still copies (most) columns into
+    # pandas blocks; the mapping is not closed here as Arrow-backed columns (e.g. strings) may keep pointing into it
+    source = pa.memory_map(ref.path, 'r')
+    return pa.ipc.open_file(source).read_all().to_pand# Arrow files of input frames, written once per frame object and shared (read-only) by all jobs it is passed to
+_shared_input_files = {}  # id(df) -> (weakref to df, ArrowFrameRef, or an Event while the file is being written)
+_shared_input_files_lock = threading.Lock()
+# (key, weakref) of collected frames whose file could not be removed right away, see _remove_shared_input
+_pending_input_removals = deque()
+
+
+def _remove_shared_input(key, ref):
+    # weakref callback: it may run on a thread holding the lock (when garbage collection is triggered there),
+    # so it never waits for it; the removal is then left to the next _write_shared_input
+    _pending_input_removals.append((key, ref))
+    _remove_pending_inputs()
+
+
+def _remove_pending_inputs():
+    if not _shared_input_files_lock.acquire(blocking=False):
+        return
+    paths = []
+    try:
+        while _pending_input_removals:
+            key, ref = _pending_input_removals.popleft()
+            entry = _shared_input_files.get(key)
+            if entry is not None and entry[0] is ref:
+                del _shared_input_files[key]
+                if isinstance(entry[1], ArrowFrameRef):
+                    paths.append(entry[1].path)
+    finally:
+        _shared_input_files_lock.release()
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _write_shared_input(df, exchange_dir, name):
+    """Arrow file of an input frame, exported on its first job and reused by the following ones (the candidates
+    and repairs of a request share their input frames); it is removed once the frame is garbage collected.
+    The file is written outside the lock: jobs of other frames do not wait, jobs of the same frame wait for it"""
+    if _pending_input_removals:
+        _remove_pending_inputs()
+    key = id(df)
+    while True:
+        with _shared_input_files_lock:
+            entry = _shared_input_files.get(key)
+            if entry is None or entry[0]() is not df:
+                written = threading.Event()
+                ref = weakref.ref(df, lambda ref: _remove_shared_input(key, ref))
+                _shared_input_files[key] = (ref, written)
+                break
+        if isinstance(entry[1], ArrowFrameRef):
+            return entry[1]
+        # being written by another job: use its file, or write it here if that failed
+        entry[1].wait()
+
+    try:
+        fd, path = tempfile.mkstemp(prefix="df-input-", suffix=".arrow", dir=ARROW_EXCHANGE_DIR)
+        os.close(fd)
+        try:
+            frame_ref = _write_arrow_frame(df, path)
+        except BaseException:
+            os.remove(path)
+            raise
+    except BaseException:
+        with _shared_input_files_lock:
+            if _shared_input_files.get(key, (None,))[0] is ref:
+                del _shared_input_files[key]
+        written.set()
+        raise
+    with _shared_input_files_lock:
+        _shared_input_files[key] = (ref, frame_ref)
+    written.set()
+    return frame_ref
+
+
+def _write_exchange_frame(df, exchange_dir, name):
+    return _write_arrow_frame(df, os.path.join(exchange_dir, f"{name}.arrow"))
+
+
+def export_frames(objects, exchange_dir, prefix, write=_write_exchange_frame):
+    """replaces large dataframes (also inside lists) by Arrow files written by write(df, exchange_dir, name),
+    by default into exchange_dir; frames Arrow cannot represent (e.g. mixed-type object columns) are left as
+    they are and get pickled"""
+    if pa is None or exchange_dir is None:
+        return objects
+
+    def export(value, name):
+        if isinstance(value, pd.DataFrame) and len(value) >= SANDBOX_ARROW_MIN_ROWS:
+            try:
+                return write(value, exchange_dir, name)
+            except (pa.ArrowException, TypeError, ValueError, OSError):
+                return value
+        if isinstance(value, list):
+            return [export(item, f"{name}_{i}") for i, item in enumerate(value)]
+        return value
+
+    return {key: export(value, f"{prefix}_{key}") for key, value in objects.items()}
+
+
+def import_frames(objects, connections=None):
+    """inverse of export_frames; lazy table references are opened as LazyFrames on connections (see close_all)"""
+    refs = [item for value in objects.values() for item in (value if isinstance(value, list) else [value])
+            if isinstance(item, LazyTableRef)]
+    if refs:
+        open_snapshots(refs, connections)
+
+    def load(value):
+        if isinstance(value, ArrowFrameRef):
+            return _read_arrow_frame(value)
+        if isinstance(value, LazyTableRef):
+            return value.open(connections)
+        if isinstance(value, list):
+            return [load(item) for item in value]
+        return value
+
+    return {key: load(value) for key, value in objects.items()}
+
+
+def _peak_memory_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+
+
+def _limit_memory():
+    """caps the data segment (heap and private mappings) of this process; allocations beyond it raise MemoryError.
+    Workers are forked from the fork server, so the limit covers their own data, not the app's heap"""
+    if resource is None or SANDBOX_MEMORY_LIMIT_MB <= 0 or not hasattr(resource, "RLIMIT_DATA"):
+        return
+    limit = SANDBOX_MEMORY_LIMIT_MB * 1024 * 1024
+    _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, limit if hard == resource.RLIM_INFINITY else min(limit, hard)))
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _set_cpu_limit(seconds):
+    """soft CPU limit `seconds` from now (None lifts it); the kernel then sends SIGXCPU, once a second"""
+    if resource is None or SANDBOX_CPU_TIME_LIMIT <= 0:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = resource.RLIM_INFINITY if seconds is None else int(_cpu_seconds() + seconds) + 1
+    if hard != resource.RLIM_INFINITY:
+        soft = hard if soft == resource.RLIM_INFINITY else min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _raise_cpu_limit_exceeded(signum, frame):
+    raise ResourceLimitExceeded('cpu_time', SANDBOX_CPU_TIME_LIMIT)
+
+
+def sandbox_worker(conn):
+    """main loop of a warm sandbox process: pandas / numpy are imported and the audit hook is installed
+    once, then every job's code runs in a fresh namespace and its result is sent back through conn; module
+    state is not reset between jobs, which is why a worker runs a single job by default
     """
     warnings.filterwarnings('ignore')
 
@@ -31,32 +366,228 @@ def subprocess_execute(code, allowed_objects, conn):
     addaudithook(block_mischief)
     del(block_mischief)  ## No way to remove or circumwent audit hooks from python. No access to this function. 
 
-    extended_allowed_objects = { **allowed_objects, 'conn': conn }  # automatically add the communication pipe to objects accessible from the sandbox
+    _limit_memory()
+    if resource is not None and hasattr(signal, "SIGXCPU"):
+        signal.signal(signal.SIGXCPU, _raise_cpu_limit_exceeded)
+
+    conn.send({'status': 'ready', 'peak_memory_kb': _peak_memory_kb()})
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+
+        code, allowed_objects, exchange_dir = job
+        connections = {}
+        try:
+            # the pipe is not exposed to the code: a job must not be able to answer for the next one
+            sandbox_globals = import_frames(allowed_objects, connections)
+            _set_cpu_limit(SANDBOX_CPU_TIME_LIMIT)
+            try:
+                exec(compile_code(code), sandbox_globals)
+            finally:
+                _set_cpu_limit(None)
+            materialized = {key: materialize(sandbox_globals[key]) for key in allowed_objects}
+            output_objects = {key: value for key, (value, _) in materialized.items()}
+            result = {'status': 'ok', 'allowed_objects': export_frames(output_objects, exchange_dir, 'out'),
+                      'truncated': [key for key, (_, truncated) in materialized.items() if truncated]}
+        except (Exception, MemoryError, ResourceLimitExceeded) as err:
+            result = error_result(err)
+        finally:
+            close_all(connections)
+        sandbox_globals = output_objects = materialized = None
+
+        try:
+            conn.send({**result, 'peak_memory_kb': _peak_memory_kb()})
+        except Exception as err:
+            # e.g. the output objects cannot be pickled
+            conn.send({'status': 'error', 'error_message': f"Error: {type(err).__name__} - {str(err)}", 'peak_memory_kb': _peak_memory_kb()})
+
+
+class SandboxWorker(object):
+    def __init__(self):
+        self.conn, child_conn = _worker_context.Pipe()
+        self.process = _worker_context.Process(target=sandbox_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.baseline_memory_kb = self.conn.recv()['peak_memory_kb']
+
+    def worn_out(self, peak_memory_kb):
+        if self.jobs >= SANDBOX_MAX_JOBS_PER_WORKER:
+            return True
+        return (peak_memory_kb is not None and self.baseline_memory_kb is not None
+                and peak_memory_kb - self.baseline_memory_kb > SANDBOX_MAX_MEMORY_GROWTH_MB * 1024)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+            self.conn.close()
+        except Exception:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class SandboxPool(object):
+    """
+    Pool of pre-started sandbox processes. Jobs wait for an idle worker; workers are replaced (in the
+    background, off the request path) after SANDBOX_MAX_JOBS_PER_WORKER jobs, on memory growth, on
+    timeout or when they crash.
+    """
+
+    def __init__(self, size=SANDBOX_POOL_SIZE):
+        self.size = size
+        self._idle = queue.Queue()
+        self._started = False
+        self._lock = threading.Lock()
+        self.stats = {'jobs': 0, 'recycled': 0, 'timeouts': 0, 'crashes': 0, 'cancelled': 0}
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for _ in range(self.size):
+            self._replace_worker()
+
+    def _replace_worker(self):
+        def start_worker():
+            try:
+                self._idle.put(SandboxWorker())
+            except Exception as e:
+                logger.error(f"Failed to start sandbox worker: {e}")
+        threading.Thread(target=start_worker, daemon=True).start()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _retire(self, worker, reason):
+        self._count(reason)
+        threading.Thread(target=worker.stop, daemon=True).start()
+        self._replace_worker()
+
+    def _acquire_worker(self, cancel_event):
+        deadline = time.time() + SANDBOX_JOB_TIMEOUT
+        while time.time() < deadline:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            try:
+                return self._idle.get(timeout=0.1 if cancel_event is not None else SANDBOX_JOB_TIMEOUT)
+            except queue.Empty:
+                pass
+        return None
+
+    def run(self, code, allowed_objects):
+        self.start()
+        cancel_event = getattr(_job_context, 'cancel_event', None)
+        worker = self._acquire_worker(cancel_event)
+        if worker is None:
+            if cancel_event is not None and cancel_event.is_set():
+                return dict(CANCELLED_RESULT)
+            return {'status': 'error', 'error_message': "Error: TimeoutError - no sandbox worker became available"}
+        self._count('jobs')
+        exchange_dir = tempfile.mkdtemp(prefix="df-sandbox-", dir=ARROW_EXCHANGE_DIR) if pa is not None else None
+        try:
+            # input frames are exported once and shared by the jobs they are passed to, the exchange
+            # directory of a job only receives its output frames
+            inputs = export_frames(allowed_objects, exchange_dir, 'in', write=_write_shared_input)
+            return self._run_job(worker, code, inputs, exchange_dir, cancel_event)
+        finally:
+            if exchange_dir is not None:
+                shutil.rmtree(exchange_dir, ignore_errors=True)
+
+    def _run_job(self, worker, code, allowed_objects, exchange_dir, cancel_event=None):
+        try:
+            worker.conn.send((code, allowed_objects, exchange_dir))
+            deadline = time.time() + SANDBOX_JOB_TIMEOUT
+            while not worker.conn.poll(0.1 if cancel_event is not None else SANDBOX_JOB_TIMEOUT):
+                if cancel_event is not None and cancel_event.is_set():
+                    # the result is no longer wanted, free the cpu for the jobs that are
+                    worker.process.kill()
+                    self._retire(worker, 'cancelled')
+                    return dict(CANCELLED_RESULT)
+                if time.time() >= deadline:
+                    worker.process.kill()
+                    self._retire(worker, 'timeouts')
+                    return resource_exceeded_result('wall_time', SANDBOX_JOB_TIMEOUT)
+            result = worker.conn.recv()
+        except (EOFError, OSError, BrokenPipeError) as err:
+            worker.process.join(timeout=1)
+            exitcode = worker.process.exitcode
+            self._retire(worker, 'crashes')
+            # killed by the CPU hard limit, or (SIGKILL) most likely by the kernel OOM killer
+            if exitcode == -getattr(signal, "SIGXCPU", 0):
+                return resource_exceeded_result('cpu_time', SANDBOX_CPU_TIME_LIMIT)
+            if exitcode == -getattr(signal, "SIGKILL", 0):
+                return resource_exceeded_result('memory', SANDBOX_MEMORY_LIMIT_MB)
+            return {'status': 'error', 'error_message': f"Error: {type(err).__name__} - sandbox process exited unexpectedly"}
+
+        worker.jobs += 1
+        if worker.worn_out(result.pop('peak_memory_kb', None)):
+            self._retire(worker, 'recycled')
+        else:
+            self._idle.put(worker)
+
+        if result['status'] == 'ok':
+            try:
+                result['allowed_objects'] = import_frames(result['allowed_objects'])
+            except Exception as err:
+                return {'status': 'error', 'error_message': f"Error: {type(err).__name__} - {str(err)}"}
+        return result
+
+
+_sandbox_pool = SandboxPool()
+_job_context = threading.local()
+
+CANCELLED_RESULT = {'status': 'error', 'error_message': "Error: Cancelled - the result of this execution was no longer needed"}
+
+
+class CancelScope(object):
+    """the cancel events of a thread's sandbox jobs: a job is abandoned once any of them is set"""
+
+    def __init__(self, events):
+        self.events = tuple(events)
+
+    def is_set(self):
+        return any(event.is_set() for event in self.events)
+
+
+def cancel_scope():
+    """the cancel scope of this thread (None outside cancel_on), to hand over to threads it starts"""
+    return getattr(_job_context, 'cancel_event', None)
+
+
+@contextmanager
+def cancel_on(cancel_event, parent=None):
+    """sandbox jobs started by this thread are abandoned (and their worker process killed) once cancel_event is set,
+    or an enclosing cancel_on / the parent scope (see cancel_scope) is cancelled; only subprocess execution can be
+    cancelled, code running in the main process runs to completion"""
+    previous = cancel_scope()
+    _job_context.cancel_event = CancelScope([scope for scope in (previous, parent) if scope is not None] + [cancel_event])
     try:
-        exec(code, extended_allowed_objects)
-    except Exception as err:
-        error_message = f"Error: {type(err).__name__} - {str(err)}"
-        conn.send({'status': 'error', 'error_message': error_message})
-        conn.close()
-        return {key: extended_allowed_objects[key] for key in allowed_objects}
+        yield
+    finally:
+        _job_context.cancel_event = previous
 
-    conn.send({'status': 'ok', 'allowed_objects': {key: extended_allowed_objects[key] for key in allowed_objects}})
-    conn.close()
 
+def start_sandbox_pool():
+    """start the sandbox workers ahead of the first job (e.g. when the app starts with exec_python_in_subprocess)"""
+    _sandbox_pool.start()
 
-def run_in_subprocess(code, allowed_objects):
-    sandbox_locals = { **allowed_objects }
-    parent_conn, child_conn = Pipe()
-    p = Process(target=subprocess_execute, args=(code, sandbox_locals, child_conn))
-    p.start()
 
+def run_in_subprocess(code, allowed_objects):
+    """run the code in a warm sandbox process (see SandboxPool), returns {status, allowed_objects | error_message}"""
     ## NOTE: The sandbox is probably safe against file writing, as well as against access into the main process.
     ## Yet the objects returned from it as results could have been manipulated. Asserting the output objects to be 
     ## of expected data types is an extra safety measure. But be careful whenever your main program flow is 
     ## controlled by the returned objects' attributes, e.g. file paths could change. 
-    result = parent_conn.recv()
-    p.join()
-    return result
+    return _sandbox_pool.run(code, { **allowed_objects })
 
 
 def run_in_main_process(code, allowed_objects):
@@ -78,16 +609,9 @@ def run_in_main_process(code, allowed_objects):
         if name in __builtins__:
             safe_builtins[name] = __builtins__[name]
 
-    # List of allowed modules for import
-    ALLOWED_MODULES = {
-        'pandas', 'numpy', 'math', 'datetime', 'json', 
-        'statistics', 'random', 'collections', 're',
-        'itertools', 'functools', 'operator'
-    }
-
     # Custom import function that only allows safe modules
     def safe_import(name, *args, **kwargs):
-        if name not in ALLOWED_MODULES:
+        if name.split('.')[0] not in ALLOWED_MODULES:
             raise ImportError(f"Import of module '{name}' is not allowed for security reasons. "
                            f"Allowed modules are: {', '.join(sorted(ALLOWED_MODULES))}")
         return __import__(name, *args, **kwargs)
@@ -101,17 +625,234 @@ def run_in_main_process(code, allowed_objects):
         **allowed_objects
     }
 
+    # only the wall-clock limit can be enforced without a separate process
     try:
-        exec(code, restricted_globals)
-    except Exception as err:
-        error_message = f"Error: {type(err).__name__} - {str(err)}"
-        return {'status': 'error', 'error_message': error_message}
+        with _WallClockDeadline(SANDBOX_JOB_TIMEOUT):
+            exec(compile_code(code), restricted_globals)
+    except (Exception, MemoryError, ResourceLimitExceeded) as err:
+        return error_result(err)
 
     return {'status': 'ok', 'allowed_objects': {key: restricted_globals[key] for key in allowed_objects}}
 
 
+_frame_fingerprints = {}
+
+
+def frame_fingerprint(df):
+    """content hash of a dataframe (columns, dtypes, index and values), or None if it holds unhashable values;
+    memoized per frame object, as the input frames of a request are shared by its candidates and repairs"""
+    cached = _frame_fingerprints.get(id(df))
+    if cached is not None and cached[0]() is df:
+        return cached[1]
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=True).values
+    except TypeError:  # e.g. lists or dicts in object columns
+        return None
+    digest = hashlib.sha256(json.dumps([[str(c) for c in df.columns], [str(t) for t in df.dtypes]]).encode("utf-8"))
+    digest.update(row_hashes.tobytes())
+    fingerprint = digest.hexdigest()
+    key = id(df)
+    _frame_fingerprints[key] = (weakref.ref(df, lambda _: _frame_fingerprints.pop(key, None)), fingerprint)
+    return fingerprint
+
+
+def execution_cache_key(kind, code, frames):
+    """hash of the code (ignoring formatting and comments) and the input frames' fingerprints, None if not cacheable"""
+    try:
+        normalized_code = ast.dump(ast.parse(code))
+    except SyntaxError:
+        normalized_code = code.strip()
+    if not all(isinstance(df, pd.DataFrame) for df in frames):
+        return None
+    fingerprints = [frame_fingerprint(df) for df in frames]
+    if None in fingerprints:
+        return None
+    return hashlib.sha256(json.dumps([kind, normalized_code, fingerprints]).encode("utf-8")).hexdigest()
+
+
+class ExecutionCache(object):
+    """
+    Output frames of successful executions, stored as Arrow IPC files in cache_dir under their
+    execution_cache_key, with size-bounded LRU eviction. Entries survive restarts.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # key -> file size, least recently used first
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        files = [entry for entry in os.scandir(cache_dir) if entry.name.endswith('.arrow')]
+        for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+            self._entries[entry.name[:-len('.arrow')]] = entry.stat().st_size
+            self.total_bytes += entry.stat().st_size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.arrow")
+
+    def _drop(self, key):
+        # called with the lock held
+        self.total_bytes -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        with self._lock:
+            hit = key in self._entries
+            self._stats['hits' if hit else 'misses'] += 1
+            if not hit:
+                return None
+            self._entries.move_to_end(key)
+        try:
+            os.utime(self._path(key))
+            return _read_arrow_frame(ArrowFrameRef(self._path(key)))
+        except (OSError, pa.ArrowException):
+            with self._lock:
+                self._drop(key)
+            return None
+
+    def put(self, key, df):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            _write_arrow_frame(df, tmp_path)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except (pa.ArrowException, TypeError, ValueError, OSError):
+            # frames Arrow cannot represent are not cached
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self.total_bytes += size - self._entries.get(key, 0)
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._stats['stores'] += 1
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                'entries': len(self._entries),
+                'size_mb': round(self.total_bytes / 1024 / 1024, 2),
+                'max_size_mb': round(self.max_bytes / 1024 / 1024, 2),
+                **self._stats,
+                'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else None,
+            }
+
+
+_execution_cache = None
+_execution_cache_lock = threading.Lock()
+
+
+def get_execution_cache():
+    """process-wide execution cache, or None when disabled with SANDBOX_CACHE_ENABLED=false or without pyarrow"""
+    global _execution_cache
+    if not SANDBOX_CACHE_ENABLED or pa is None:
+        return None
+    with _execution_cache_lock:
+        if _execution_cache is None:
+            _execution_cache = ExecutionCache(SANDBOX_CACHE_DIR, int(SANDBOX_CACHE_MAX_MB * 1024 * 1024))
+        return _execution_cache
+
+
+def sandbox_stats():
+    """worker pool counters and execution cache metrics"""
+    execution_cache = get_execution_cache()
+    with _sandbox_pool._lock:
+        pool_stats = dict(_sandbox_pool.stats)
+    return {
+        'pool': {'size': _sandbox_pool.size, 'idle': _sandbox_pool._idle.qsize(), **pool_stats},
+        'execution_cache': execution_cache.stats() if execution_cache is not None else None,
+    }
+
+
+@functools.lru_cache(maxsize=256)
+def _check_code(code, entry_function):
+    # (error type, message) of the first problem found, or None
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as err:
+        return 'SyntaxError', f"{err.msg} (line {err.lineno})"
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            if isinstance(node, ast.ImportFrom) and node.level > 0:
+                return 'ImportError', "Relative imports are not allowed"
+            names = [alias.name for alias in node.names] if isinstance(node, ast.Import) else [node.module]
+            for name in names:
+                if name.split('.')[0] not in ALLOWED_MODULES:
+                    return 'ImportError', (f"Import of module '{name}' is not allowed for security reasons. "
+                                           f"Allowed modules are: {', '.join(sorted(ALLOWED_MODULES))}")
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FORBIDDEN_CALLS:
+            return 'PermissionError', f"Calling {node.func.id}() is not allowed in the sandbox"
+        elif isinstance(node, ast.Attribute) and node.attr in FORBIDDEN_ATTRIBUTES:
+            return 'PermissionError', f"Accessing {node.attr} is not allowed in the sandbox"
+        elif isinstance(node, ast.Name) and node.id in FORBIDDEN_ATTRIBUTES:
+            return 'PermissionError', f"Accessing {node.id} is not allowed in the sandbox"
+        elif isinstance(node, ast.Constant) and node.value in FORBIDDEN_ATTRIBUTES:
+            # e.g. getattr(f, '__globals__')
+            return 'PermissionError', f"Accessing {node.value} is not allowed in the sandbox"
+
+    if not any(isinstance(node, ast.FunctionDef) and node.name == entry_function for node in tree.body):
+        return 'NameError', f"The code must define a function {entry_function}(...) at the top level"
+    return None
+
+
+def validate_code(code, entry_function):
+    """
+    static checks of generated code before it is sent to the sandbox: it parses, imports only allowed
+    modules, does not call builtins like eval / open or reach into interpreter internals, and defines
+    entry_function; returns an error result for the repair loop, or None if the code can run
+    """
+    problem = _check_code(code, entry_function)
+    if problem is None:
+        return None
+    error_type, message = problem
+    return {'status': 'error', 'error_type': 'invalid_code', 'error_message': f"Error: {error_type} - {message}"}
+
+
+@functools.lru_cache(maxsize=256)
+def compile_code(source):
+    """code object of an assembled sandbox script; repairs and candidates often run the same source again"""
+    return compile(source, '<sandbox>', 'exec')
+
+
+def resource_limit_details(result):
+    """error_type (and resource / limit, if stopped by a resource limit) of a failed execution, to pass on to the caller"""
+    return {key: result[key] for key in ('error_type', 'resource', 'limit') if key in result}
+
+
 def run_transform_in_sandbox2020(code, df_list, exec_python_in_subprocess=False):
     
+    invalid = validate_code(code, 'transform_data')
+    if invalid is not None:
+        return {'status': 'error', 'content': invalid['error_message'], **resource_limit_details(invalid)}
+
+    execution_cache = get_execution_cache()
+    cache_key = execution_cache_key('transform', code, df_list) if execution_cache is not None else None
+    if cache_key is not None:
+        cached_df = execution_cache.get(cache_key)
+        if cached_df is not None:
+            return {'status': 'ok', 'content': cached_df}
+
+    connections = {}
+    if not exec_python_in_subprocess:
+        # the input frames are shared by all candidates and repairs of a request, the code may modify them in place
+        open_snapshots([df for df in df_list if isinstance(df, LazyTableRef)], connections)
+        df_list = [df.open(connections) if isinstance(df, LazyTableRef) else df.copy() for df in df_list]
+
     allowed_objects = {
         'df_list': df_list,
         'output_df': None
@@ -122,15 +863,27 @@ import pandas as pd
 import json
 {code}
 output_df = transform_data(*df_list)
+df_list = None
 '''
 
-    if exec_python_in_subprocess:
-        result = run_in_subprocess(assemble_code, allowed_objects)
-    else:
-        result = run_in_main_process(assemble_code, allowed_objects)
+    try:
+        if exec_python_in_subprocess:
+            result = run_in_subprocess(assemble_code, allowed_objects)
+        else:
+            result = run_in_main_process(assemble_code, allowed_objects)
+
+        if result['status'] == 'ok':
+            result_df, truncated = materialize(result['allowed_objects']['output_df'])
+    finally:
+        close_all(connections)
 
     if result['status'] == 'ok':
-        result_df = result['allowed_objects']['output_df']
+        if truncated or 'output_df' in result.get('truncated', ()):
+            # a lazy transform result longer than LAZY_FRAME_MAX_RESULT_ROWS rows, cut to its first rows
+            logger.info(f"transform result truncated to {LAZY_FRAME_MAX_RESULT_ROWS} rows")
+            return {'status': 'ok', 'content': result_df, 'truncated': True, 'max_rows': LAZY_FRAME_MAX_RESULT_ROWS}
+        if cache_key is not None and isinstance(result_df, pd.DataFrame):
+            execution_cache.put(cache_key, result_df)
         return {
             'status': 'ok',
             'content': result_df
@@ -138,12 +891,13 @@ output_df = transform_data(*df_list)
     else:
         return {
             'status': 'error',
-            'content': result['error_message']
+            'content': result['error_message'],
+            **resource_limit_details(result)
         }
 
 
 def run_derive_concept(code, output_field_name, table_rows, exec_python_in_subprocess=False):
-    """given a concept derivation function, execute the function on inputs to generate a new dataframe"""
+    """given a concept derivation function, execute the function on inputs (a dataframe or its rows) to generate a new dataframe"""
     
     assemble_code = f'''
 import pandas as pd
@@ -151,8 +905,21 @@ import pandas as pd
 new_column = derive_new_column(df)
 '''
 
+    invalid = validate_code(code, 'derive_new_column')
+    if invalid is not None:
+        return { 'status': 'error', 'content': invalid['error_message'], **resource_limit_details(invalid) }
+
+    input_df = table_rows if isinstance(table_rows, pd.DataFrame) else pd.DataFrame.from_records(table_rows)
+
+    execution_cache = get_execution_cache()
+    cache_key = execution_cache_key(f'derive:{output_field_name}', code, [input_df]) if execution_cache is not None else None
+    if cache_key is not None:
+        cached_df = execution_cache.get(cache_key)
+        if cached_df is not None:
+            return {'status': 'ok', 'content': cached_df}
+
     allowed_objects = {
-        'df': pd.DataFrame.from_records(table_rows),
+        'df': input_df.copy(),
         'new_column': None # the return value of the derive_new_column function
     }
 
@@ -164,6 +931,8 @@ new_column = derive_new_column(df)
     if result['status'] == 'ok':
         result_df = result['allowed_objects']['df']
         result_df[output_field_name] = result['allowed_objects']['new_column']
+        if cache_key is not None:
+            execution_cache.put(cache_key, result_df)
         return { 'status': 'ok', 'content': result_df }
     else:
-        return { 'status': 'error', 'content': result['error_message'] }
\ No newline at end of file
+        return { 'status': 'error', 'content': result['error_message'], **resource_limit_details(result) }
\ No newline at end of file
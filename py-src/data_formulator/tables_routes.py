@@ -9,7 +9,7 @@ mimetypes.add_type('application/javascript', '.js')
 mimetypes.add_type('application/javascript', '.mjs')
 import json
 import traceback
-from flask import request, send_from_directory, session, jsonify, Blueprint
+from flask import request, send_from_directory, session, jsonify, Blueprint, current_app
 import pandas as pd
 import random
 import string
@@ -18,6 +18,8 @@ from pathlib import Path
 from data_formulator.db_manager import db_manager
 from data_formulator.data_loader import DATA_LOADERS
 from data_formulator.data_loader.external_data_loader import sanitize_table_name
+from data_formulator.concept_engine import derive_column_to_table, verify_derivation_signature, ConceptDeriveError, ConceptOutputExists
+from data_formulator.agent_routes import admission_controlled
 
 import re
 from typing import Tuple
@@ -767,6 +769,46 @@ def analyze_table():
             "message": safe_msg
         }), status_code
 
+@tables_bp.route('/derive-column', methods=['POST'])
+@admission_controlled()
+def derive_column():
+    """Apply an accepted python concept derivation (derive_new_column, with the code_signature returned by
+    /api/agent/derive-py-concept) to a full table, server side"""
+    try:
+        data = request.get_json()
+        table_name = data.get('table_name')
+        code = data.get('code')
+        output_field = data.get('output_field')
+
+        if not table_name or not code or not output_field:
+            return jsonify({"status": "error", "message": "table_name, code and output_field are required"}), 400
+        if not verify_derivation_signature(code, session.get('session_id'), current_app.secret_key, data.get('code_signature')):
+            return jsonify({"status": "error", "message": "only derivations generated by the concept agent in this session can be applied"}), 403
+
+        with db_manager.connection(session['session_id']) as db:
+            result = derive_column_to_table(
+                db, table_name, code, output_field,
+                output_name=data.get('output_name'),
+                input_fields=data.get('input_fields'),
+                materialize=data.get('materialize', 'table'),
+                overwrite=data.get('overwrite') is True,
+                exec_python_in_subprocess=current_app.config['CLI_ARGS']['exec_python_in_subprocess'])
+
+        return jsonify({"status": "success", **result})
+
+    except ConceptOutputExists as e:
+        return jsonify({"status": "error", "message": str(e)}), 409
+    except ConceptDeriveError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error deriving column: {str(e)}")
+        safe_msg, status_code = sanitize_db_error_message(e)
+        return jsonify({
+            "status": "error",
+            "message": safe_msg
+        }), status_code
+
+
 def sanitize_db_error_message(error: Exception) -> Tuple[str, int]:
     """
     Sanitize error messages before sending to client.
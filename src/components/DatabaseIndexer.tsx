@@ -185,8 +185,8 @@ const DatabaseIndexerContent: React.FC = () => {
         setProcessedTables(0);
         
         try {
-            // Start indexing process
-            const indexingPromise = fetch(`/api/indexing/index-database`, {
+            // Start indexing job, the server returns a job id right away
+            const submitResponse = await fetch(`/api/indexing/index-database`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -201,36 +201,42 @@ const DatabaseIndexerContent: React.FC = () => {
                 })
             });
             
-            // Start progress polling
-            const progressInterval = setInterval(async () => {
-                try {
-                    const progressResponse = await fetch('/api/indexing/indexing-progress');
-                    const progressData = await progressResponse.json();
-                    
-                    if (progressData.status === 'success') {
-                        const prog = progressData.progress;
-                        setProgress(prog.progress);
-                        setProgressMessage(prog.message);
-                        setTotalTables(prog.total_tables);
-                        setProcessedTables(prog.processed_tables);
+            const submitData = await submitResponse.json();
+            if (submitData.status !== 'accepted') {
+                throw new Error(submitData.message || 'Failed to start indexing');
+            }
+            
+            // Poll job progress until the job finishes
+            const job = await new Promise<any>((resolve) => {
+                const progressInterval = setInterval(async () => {
+                    try {
+                        const progressResponse = await fetch(`/api/indexing/indexing-progress?job_id=${submitData.job_id}`);
+                        const progressData = await progressResponse.json();
                         
-                        // Stop polling when completed or error
-                        if (prog.status === 'completed' || prog.status === 'error') {
-                            clearInterval(progressInterval);
+                        if (progressData.status === 'success') {
+                            const prog = progressData.progress;
+                            setProgress(prog.progress);
+                            setProgressMessage(prog.eta_seconds
+                                ? `${prog.message} (~${Math.ceil(prog.eta_seconds)}s left)`
+                                : prog.message);
+                            setTotalTables(prog.total_tables);
+                            setProcessedTables(prog.processed_tables);
+                            
+                            // Stop polling when the job has finished
+                            if (['completed', 'error', 'cancelled', 'interrupted'].includes(prog.status)) {
+                                clearInterval(progressInterval);
+                                resolve(prog);
+                            }
                         }
+                    } catch (error) {
+                        console.error('Failed to fetch progress:', error);
                     }
-                } catch (error) {
-                    console.error('Failed to fetch progress:', error);
-                }
-            }, 1000); // Poll every second
-            
-            // Wait for indexing to complete
-            const response = await indexingPromise;
-            clearInterval(progressInterval);
+                }, 1000); // Poll every second
+            });
             
-            const data = await response.json();
+            const data = job.result || {};
             
-            if (data.status === 'success') {
+            if (job.status === 'completed') {
                 setProgress(100);
                 setProgressMessage('Database indexing completed successfully!');
                 setMessage({
@@ -246,7 +252,7 @@ const DatabaseIndexerContent: React.FC = () => {
             } else {
                 setProgress(0);
                 setProgressMessage('Indexing failed');
-                setMessage({type: 'error', text: data.message || 'Failed to index database'});
+                setMessage({type: 'error', text: data.message || job.message || 'Failed to index database'});
             }
         } catch (error) {
             setProgress(0);